@@ -3,11 +3,14 @@
 import contextlib
 import dataclasses
 import datetime
+import functools
 import hashlib
 import itertools
 import json
 import logging
+import mmap
 import os
+import re
 import resource
 import shlex
 import shutil
@@ -17,16 +20,23 @@ import tempfile
 import textwrap
 import uuid
 from collections.abc import Iterator, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, TextIO, Union
+from typing import TYPE_CHECKING, Any, Optional
 
 import mkosi.resources
 from mkosi.architecture import Architecture
-from mkosi.archive import extract_tar, make_cpio, make_tar
-from mkosi.burn import run_burn
+from mkosi.archive import (
+    compressor_command,
+    extract_tar,
+    hashing_writer,
+    make_cpio,
+    make_tar,
+)
 from mkosi.config import (
     BiosBootloader,
     Bootloader,
+    CacheLayer,
     Compression,
     ConfigFeature,
     DocFormat,
@@ -37,36 +47,49 @@ from mkosi.config import (
     OutputFormat,
     SecureBootSignTool,
     Verb,
+    cache_manifest_key,
     format_bytes,
     format_tree,
     parse_config,
     summary,
 )
 from mkosi.distributions import Distribution
-from mkosi.installer import clean_package_manager_metadata, package_manager_scripts
-from mkosi.kmod import gen_required_kernel_modules, process_kernel_modules
-from mkosi.log import ARG_DEBUG, complete_step, die, log_notice, log_step
-from mkosi.manifest import Manifest
+from mkosi.log import (
+    ARG_DEBUG,
+    StepProfile,
+    complete_step,
+    die,
+    log_notice,
+    log_step,
+    record_steps,
+)
 from mkosi.mounts import mount, mount_overlay, mount_passwd, mount_usr
 from mkosi.pager import page
 from mkosi.partition import Partition, finalize_root, finalize_roothash
-from mkosi.qemu import QemuDeviceNode, copy_ephemeral, run_qemu, run_ssh
+from mkosi.pool import (
+    gc_package_pool,
+    pool_entries,
+    populate_package_cache,
+    sync_package_pool,
+)
 from mkosi.run import (
     become_root,
     bwrap,
     chroot_cmd,
     find_binary,
     fork_and_wait,
+    fork_and_wait_graph,
     init_mount_namespace,
     run,
 )
 from mkosi.state import MkosiState
-from mkosi.tree import copy_tree, install_tree, move_tree, rmtree
+from mkosi.tree import copy_tree, glob_tree, install_tree, move_tree, rmtree, walk_tree
 from mkosi.types import _FILE, CompletedProcess, PathString
 from mkosi.util import (
     INVOKING_USER,
     chdir,
     flatten,
+    flock,
     format_rlimit,
     make_executable,
     one_zero,
@@ -79,6 +102,9 @@ from mkosi.util import (
 )
 from mkosi.versioncomp import GenericVersion
 
+if TYPE_CHECKING:
+    from mkosi.manifest import Manifest
+
 MKOSI_AS_CALLER = (
     "setpriv",
     f"--reuid={INVOKING_USER.uid}",
@@ -123,9 +149,10 @@ def remove_files(state: MkosiState) -> None:
         return
 
     with complete_step("Removing files…"):
-        for pattern in state.config.remove_files:
-            for p in state.root.glob(pattern.lstrip("/")):
-                rmtree(p)
+        paths = glob_tree(state.root, [pattern.lstrip("/") for pattern in state.config.remove_files])
+        # Remove the matches in batches so we don't run into the command line length limit.
+        for i in range(0, len(paths), 1000):
+            rmtree(*paths[i:i + 1000])
 
 
 def install_distribution(state: MkosiState) -> None:
@@ -320,14 +347,12 @@ def configure_autologin(state: MkosiState) -> None:
 
 @contextlib.contextmanager
 def mount_cache_overlay(state: MkosiState) -> Iterator[None]:
-    if not state.config.incremental or not any(state.root.iterdir()):
+    # The cache-overlay directory is created by reuse_cache() if we have a base tree.
+    d = state.workspace / "cache-overlay"
+    if not state.config.incremental or not d.exists():
         yield
         return
 
-    d = state.workspace / "cache-overlay"
-    with umask(~0o755):
-        d.mkdir(exist_ok=True)
-
     with mount_overlay([state.root], d, state.root):
         yield
 
@@ -409,6 +434,8 @@ def finalize_host_scripts(
     state: MkosiState,
     helpers: dict[str, Sequence[PathString]],  # FIXME: change dict to Mapping when PyRight is fixed
 ) -> contextlib.AbstractContextManager[Path]:
+    from mkosi.installer import package_manager_scripts
+
     scripts: dict[str, Sequence[PathString]] = {}
     if find_binary("git"):
         scripts["git"] = ("git", "-c", "safe.directory=*")
@@ -1141,10 +1168,6 @@ def install_build_dest(state: MkosiState) -> None:
         copy_tree(state.install_dir, state.root, use_subvolumes=state.config.use_subvolumes)
 
 
-def gzip_binary() -> str:
-    return "pigz" if shutil.which("pigz") else "gzip"
-
-
 def gen_kernel_images(state: MkosiState) -> Iterator[tuple[str, Path]]:
     if not (state.root / "usr/lib/modules").exists():
         return
@@ -1185,11 +1208,28 @@ def build_initrd(state: MkosiState) -> Path:
         *(["--compress-output", str(state.config.compress_output)] if state.config.compress_output else []),
         "--with-network", str(state.config.with_network),
         "--cache-only", str(state.config.cache_only),
+        *(
+            ["--repository-metadata-max-age", str(state.config.repository_metadata_max_age)]
+            if state.config.repository_metadata_max_age is not None
+            else []
+        ),
         "--output-dir", str(state.workspace / "initrd"),
         *(["--workspace-dir", str(state.config.workspace_dir)] if state.config.workspace_dir else []),
         "--cache-dir", str(state.cache_dir),
+        *(["--package-pool-directory", str(pool)] if (pool := state.config.package_pool_dir_or_default()) else []),
+        *(
+            ["--package-pool-size", str(state.config.package_pool_size)]
+            if state.config.package_pool_size is not None
+            else []
+        ),
         *(["--local-mirror", str(state.config.local_mirror)] if state.config.local_mirror else []),
         "--incremental", str(state.config.incremental),
+        *(
+            ["--incremental-cache-size", str(state.config.incremental_cache_size)]
+            if state.config.incremental_cache_size is not None
+            else []
+        ),
+        "--incremental-overlay", str(state.config.incremental_overlay),
         "--acl", str(state.config.acl),
         "--format", "cpio",
         "--package", "systemd",
@@ -1262,16 +1302,21 @@ def build_microcode_initrd(state: MkosiState) -> Optional[Path]:
             for p in intel.iterdir():
                 f.write(p.read_bytes())
 
-    make_cpio(root, microcode)
+    make_cpio(root, microcode, mtime=state.config.source_date_epoch)
 
     return microcode
 
 
 def build_kernel_modules_initrd(state: MkosiState, kver: str) -> Path:
+    from mkosi.kmod import gen_required_kernel_modules
+
     kmods = state.workspace / f"initrd-kernel-modules-{kver}.img"
     if kmods.exists():
         return kmods
 
+    # Debian/Ubuntu do not compress their kernel modules, so we compress the initramfs instead. Note that
+    # this is not ideal since the compressed kernel modules will all be decompressed on boot which
+    # requires significant memory.
     make_cpio(
         state.root, kmods,
         gen_required_kernel_modules(
@@ -1279,15 +1324,12 @@ def build_kernel_modules_initrd(state: MkosiState, kver: str) -> Path:
             state.config.kernel_modules_initrd_include,
             state.config.kernel_modules_initrd_exclude,
             state.config.kernel_modules_initrd_include_host,
-        )
+            state.config.cache_dir,
+        ),
+        compression=Compression.zstd if state.config.distribution.is_apt_distribution() else Compression.none,
+        mtime=state.config.source_date_epoch,
     )
 
-    # Debian/Ubuntu do not compress their kernel modules, so we compress the initramfs instead. Note that
-    # this is not ideal since the compressed kernel modules will all be decompressed on boot which
-    # requires significant memory.
-    if state.config.distribution.is_apt_distribution():
-        maybe_compress(state.config, Compression.zstd, kmods, kmods)
-
     return kmods
 
 
@@ -1502,8 +1544,11 @@ def install_uki(state: MkosiState, partitions: Sequence[Partition]) -> None:
 
 def make_uki(state: MkosiState, output: Path) -> None:
     microcode = build_microcode_initrd(state)
-    make_cpio(state.root, state.workspace / "initrd")
-    maybe_compress(state.config, state.config.compress_output, state.workspace / "initrd", state.workspace / "initrd")
+    make_cpio(
+        state.root, state.workspace / "initrd",
+        compression=state.config.compress_output,
+        mtime=state.config.source_date_epoch,
+    )
 
     initrds = [microcode] if microcode else []
     initrds += [state.workspace / "initrd"]
@@ -1518,20 +1563,13 @@ def make_uki(state: MkosiState, output: Path) -> None:
     extract_pe_section(state, output, ".initrd", state.staging / state.config.output_split_initrd)
 
 
-def compressor_command(compression: Compression) -> list[PathString]:
-    """Returns a command suitable for compressing archives."""
-
-    if compression == Compression.gz:
-        return [gzip_binary(), "--fast", "--stdout", "-"]
-    elif compression == Compression.xz:
-        return ["xz", "--check=crc32", "--fast", "-T0", "--stdout", "-"]
-    elif compression == Compression.zstd:
-        return ["zstd", "-q", "-T0", "--stdout", "-"]
-    else:
-        die(f"Unknown compression {compression}")
-
-
-def maybe_compress(config: MkosiConfig, compression: Compression, src: Path, dst: Optional[Path] = None) -> None:
+def maybe_compress(
+    config: MkosiConfig,
+    compression: Compression,
+    src: Path,
+    dst: Optional[Path] = None,
+    digests: Optional[dict[Path, str]] = None,
+) -> None:
     if not compression or src.is_dir():
         if dst:
             move_tree(src, dst, use_subvolumes=config.use_subvolumes)
@@ -1544,7 +1582,8 @@ def maybe_compress(config: MkosiConfig, compression: Compression, src: Path, dst
         with src.open("rb") as i:
             src.unlink() # if src == dst, make sure dst doesn't truncate the src file but creates a new file.
 
-            with dst.open("wb") as o:
+            with dst.open("wb") as f, contextlib.ExitStack() as stack:
+                o = stack.enter_context(hashing_writer(f, dst, digests)) if digests is not None else f
                 run(compressor_command(compression), stdin=i, stdout=o)
 
 
@@ -1557,15 +1596,25 @@ def copy_vmlinuz(state: MkosiState) -> None:
         break
 
 
-def hash_file(of: TextIO, path: Path) -> None:
-    bs = 16 * 1024**2
+def hash_file(path: Path) -> str:
     h = hashlib.sha256()
 
-    with path.open("rb") as sf:
-        while (buf := sf.read(bs)):
-            h.update(buf)
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()
+
+        # hashlib releases the GIL while hashing large buffers, so mapping the whole file and hashing it in one
+        # go allows hashing multiple files in parallel from a thread pool.
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            m.madvise(mmap.MADV_SEQUENTIAL)
+            h.update(m)
+
+    return h.hexdigest()
 
-    of.write(h.hexdigest() + " *" + path.name + "\n")
+
+def output_digests(state: MkosiState) -> Optional[dict[Path, str]]:
+    """Returns the dict to record the digests of outputs in while they are written, if checksums are enabled."""
+    return state.digests if state.config.checksum else None
 
 
 def calculate_sha256sum(state: MkosiState) -> None:
@@ -1576,9 +1625,16 @@ def calculate_sha256sum(state: MkosiState) -> None:
         return None
 
     with complete_step("Calculating SHA256SUMS…"):
+        paths = sorted(state.staging.iterdir())
+        # Outputs that were hashed while they were written don't need to be read again.
+        missing = [p for p in paths if p not in state.digests]
+
+        with ThreadPoolExecutor() as pool:
+            digests = {**state.digests, **dict(zip(missing, pool.map(hash_file, missing)))}
+
         with open(state.workspace / state.config.output_checksum, "w") as f:
-            for p in state.staging.iterdir():
-                hash_file(f, p)
+            for p in paths:
+                f.write(f"{digests[p]} *{p.name}\n")
 
         (state.workspace / state.config.output_checksum).rename(state.staging / state.config.output_checksum)
 
@@ -1614,22 +1670,29 @@ def calculate_signature(state: MkosiState) -> None:
         )
 
 
-def dir_size(path: Union[Path, os.DirEntry[str]]) -> int:
+def dir_size(path: Path) -> int:
     dir_sum = 0
-    for entry in os.scandir(path):
+
+    def visit(dirfd: int, entry: os.DirEntry[str], context: bool) -> Optional[bool]:
+        nonlocal dir_sum
+
+        # We can ignore symlinks because they either point into our tree,
+        # in which case we'll include the size of target directory anyway,
+        # or outside, in which case we don't need to.
         if entry.is_symlink():
-            # We can ignore symlinks because they either point into our tree,
-            # in which case we'll include the size of target directory anyway,
-            # or outside, in which case we don't need to.
-            continue
+            return None
         elif entry.is_file():
             dir_sum += entry.stat().st_blocks * 512
         elif entry.is_dir():
-            dir_sum += dir_size(entry)
+            return True
+
+        return None
+
+    walk_tree(path, visit, True)
     return dir_sum
 
 
-def save_manifest(state: MkosiState, manifest: Optional[Manifest]) -> None:
+def save_manifest(state: MkosiState, manifest: Optional["Manifest"]) -> None:
     if not manifest:
         return
 
@@ -1683,10 +1746,13 @@ def unlink_output(args: MkosiArgs, config: MkosiConfig) -> None:
 
     if remove_build_cache:
         if config.cache_dir:
-            for p in cache_tree_paths(config):
-                if p.exists():
-                    with complete_step(f"Removing cache entry {p}…"):
-                        rmtree(p)
+            remove_legacy_cache_trees(config)
+
+            for entry in cache_tree_entries(config.cache_dir, cache_tree_prefix(config)):
+                for p in entry:
+                    if p.exists():
+                        with complete_step(f"Removing cache entry {p}…"):
+                            rmtree(p)
 
         if config.build_dir and config.build_dir.exists() and any(config.build_dir.iterdir()):
             with complete_step("Clearing out build directory…"):
@@ -1698,22 +1764,125 @@ def unlink_output(args: MkosiArgs, config: MkosiConfig) -> None:
                 empty_directory(config.cache_dir)
 
 
-def cache_tree_paths(config: MkosiConfig) -> tuple[Path, Path, Path]:
+def cache_tree_prefix(config: MkosiConfig) -> str:
     fragments = [config.distribution, config.release, config.architecture]
 
     if config.image:
         fragments += [config.image]
 
-    key = '~'.join(str(s) for s in fragments)
+    return '~'.join(str(s) for s in fragments)
+
+
+def cache_tree_paths(config: MkosiConfig, manifest: dict[str, Any]) -> tuple[Path, Path]:
+    key = f"{cache_tree_prefix(config)}~{cache_manifest_key(manifest)}"
 
     assert config.cache_dir
     return (
         config.cache_dir / f"{key}.cache",
-        config.cache_dir / f"{key}.build.cache",
         config.cache_dir / f"{key}.manifest",
     )
 
 
+def remove_legacy_cache_trees(config: MkosiConfig) -> None:
+    """
+    Remove the cache entries of this image that were saved before cache entries were keyed on a hash of their
+    inputs. These can't be reused, counted or evicted anymore.
+    """
+    assert config.cache_dir
+    prefix = cache_tree_prefix(config)
+
+    for p in (f"{prefix}.cache", f"{prefix}.build.cache", f"{prefix}.manifest"):
+        if (config.cache_dir / p).exists():
+            with complete_step(f"Removing obsolete cache entry {config.cache_dir / p}…"):
+                rmtree(config.cache_dir / p)
+
+
+def cache_tree_entries(cache_dir: Path, prefix: Optional[str] = None) -> list[tuple[Path, Path]]:
+    """
+    Return the (tree, manifest) paths of all incremental cache entries in the given cache directory, optionally
+    restricted to the entries for a single image, ordered from least to most recently used.
+    """
+    if not cache_dir.exists():
+        return []
+
+    entries = []
+
+    for p in cache_dir.iterdir():
+        if not (m := re.fullmatch(r"(.+)~([0-9a-f]{16})\.manifest", p.name)):
+            continue
+        if prefix is not None and m.group(1) != prefix:
+            continue
+
+        key = p.name.removesuffix(".manifest")
+        entries += [(p.stat().st_mtime, cache_dir / f"{key}.cache", p)]
+
+    return [(tree, manifest) for _, tree, manifest in sorted(entries)]
+
+
+def cache_tree_size(tree: Path, manifest: Path) -> int:
+    """
+    Return the size of a cache entry as recorded in its manifest when it was saved. Entries saved before sizes were
+    recorded are measured once and their manifest is updated.
+    """
+    m = json.loads(manifest.read_text())
+    if "size" not in m:
+        m["size"] = dir_size(tree) if tree.exists() else 0
+        manifest.write_text(json.dumps(m, indent=4, sort_keys=True))
+
+    return int(m["size"])
+
+
+def evict_cache(config: MkosiConfig, keep: Sequence[Path]) -> None:
+    if config.incremental_cache_size is None:
+        return
+
+    assert config.cache_dir
+
+    entries = cache_tree_entries(config.cache_dir)
+    sizes = [cache_tree_size(tree, manifest) for tree, manifest in entries]
+    total = sum(sizes)
+
+    for (tree, manifest), size in zip(entries, sizes):
+        if total <= config.incremental_cache_size:
+            break
+
+        # Never evict the cache entries used by the current build, even if they alone exceed the budget.
+        if manifest in keep:
+            continue
+
+        with complete_step(f"Evicting cache entry {tree}…"):
+            # Remove the manifest first so a partially removed entry is never considered valid.
+            manifest.unlink()
+            rmtree(tree)
+
+        total -= size
+
+
+@contextlib.contextmanager
+def package_pool(state: MkosiState) -> Iterator[None]:
+    """
+    Make the packages in the package pool available to the package manager and add any packages it downloads
+    to the pool afterwards.
+    """
+    if not (pool := state.config.package_pool_dir_or_default()):
+        yield
+        return
+
+    # The package cache directory might be shared with images that are built in parallel, so take the same lock
+    # that is taken around package manager invocations to make sure we don't pick up partially downloaded packages.
+    with flock(state.cache_dir):
+        populate_package_cache(pool, state.cache_dir, state.config.distribution.package_type())
+
+    try:
+        yield
+    finally:
+        with complete_step("Syncing package pool…"), flock(state.cache_dir):
+            sync_package_pool(pool, state.cache_dir)
+
+            if state.config.package_pool_size is not None:
+                gc_package_pool(pool, state.config.package_pool_size, caches=[state.cache_dir])
+
+
 def check_inputs(config: MkosiConfig) -> None:
     """
     Make sure all the inputs exist that aren't checked during config parsing because they might be created by an
@@ -1864,6 +2033,8 @@ def configure_clock(state: MkosiState) -> None:
 
 
 def run_depmod(state: MkosiState) -> None:
+    from mkosi.kmod import process_kernel_modules
+
     if state.config.overlay or state.config.output_format.is_extension_image():
         return
 
@@ -1886,6 +2057,7 @@ def run_depmod(state: MkosiState) -> None:
             state.config.kernel_modules_include,
             state.config.kernel_modules_exclude,
             state.config.kernel_modules_include_host,
+            state.config.cache_dir,
         )
 
         with complete_step(f"Running depmod for {kver}"):
@@ -2005,64 +2177,158 @@ def need_build_overlay(config: MkosiConfig) -> bool:
     return bool(config.build_scripts and (config.build_packages or config.prepare_scripts))
 
 
-def save_cache(state: MkosiState) -> None:
+def cache_layers(config: MkosiConfig) -> list[CacheLayer]:
+    layers = [CacheLayer.install]
+
+    # Without prepare scripts the prepare layer would be identical to the install layer so we skip it.
+    if config.prepare_scripts:
+        layers += [CacheLayer.prepare]
+
+    if need_build_overlay(config):
+        layers += [CacheLayer.build]
+
+    return layers
+
+
+def cache_manifests(config: MkosiConfig) -> dict[CacheLayer, dict[str, Any]]:
+    """
+    Return the manifest of each cache layer of the image, in the form it is stored in on disk. Computing these
+    hashes the package manager trees and prepare scripts, so this is done once per build and the result is passed
+    to the functions that need it.
+    """
+    return {
+        layer: json.loads(json.dumps(config.cache_manifest(layer), cls=MkosiJsonEncoder))
+        for layer in cache_layers(config)
+    }
+
+
+def have_cache_layer(config: MkosiConfig, manifest: dict[str, Any]) -> bool:
+    tree, path = cache_tree_paths(config, manifest)
+    if not tree.exists() or not path.exists():
+        return False
+
+    prev = json.loads(path.read_text())
+    # The size of the entry is recorded in its manifest as well but is not one of its inputs.
+    prev.pop("size", None)
+    if prev != manifest:
+        return False
+
+    # Either we're running as root and the cache is owned by root or we're running unprivileged inside a user
+    # namespace and we'll think the cache is owned by root. However, if we're running as root and the cache was
+    # generated by an unprivileged build, the cache will not be owned by root and we should not use it.
+    return tree.stat().st_uid == 0
+
+
+def build_cache_layer(state: MkosiState, layer: CacheLayer) -> None:
+    with mount_cache_overlay(state):
+        if layer == CacheLayer.install:
+            install_distribution(state)
+        elif layer == CacheLayer.prepare:
+            run_prepare_scripts(state, build=False)
+        elif layer == CacheLayer.build:
+            install_build_packages(state)
+            run_prepare_scripts(state, build=True)
+
+
+def save_cache(state: MkosiState, layer: CacheLayer, manifests: dict[CacheLayer, dict[str, Any]]) -> None:
     if not state.config.incremental:
         return
 
-    final, build, manifest = cache_tree_paths(state.config)
+    tree, manifest = cache_tree_paths(state.config, manifests[layer])
+
+    with complete_step(f"Installing {layer} cache layer"):
+        rmtree(tree, manifest)
 
-    with complete_step("Installing cache copies"):
-        rmtree(final)
+        if layer == CacheLayer.build:
+            if not (state.workspace / "build-overlay").exists():
+                return
 
+            move_tree(state.workspace / "build-overlay", tree, use_subvolumes=state.config.use_subvolumes)
+            (state.workspace / "build-overlay").symlink_to(tree)
         # We only use the cache-overlay directory for caching if we have a base tree, otherwise we just
         # cache the root directory.
-        if (state.workspace / "cache-overlay").exists():
-            move_tree(state.workspace / "cache-overlay", final, use_subvolumes=state.config.use_subvolumes)
+        elif (state.workspace / "cache-overlay").exists():
+            copy_tree(state.workspace / "cache-overlay", tree, use_subvolumes=state.config.use_subvolumes)
         else:
-            move_tree(state.root, final, use_subvolumes=state.config.use_subvolumes)
-
-        if need_build_overlay(state.config) and (state.workspace / "build-overlay").exists():
-            rmtree(build)
-            move_tree(state.workspace / "build-overlay", build, use_subvolumes=state.config.use_subvolumes)
+            copy_tree(state.root, tree, use_subvolumes=state.config.use_subvolumes)
 
         manifest.write_text(
             json.dumps(
-                state.config.cache_manifest(),
+                {**manifests[layer], "size": dir_size(tree)},
                 cls=MkosiJsonEncoder,
                 indent=4,
                 sort_keys=True,
             )
         )
 
+    evict_cache(state.config, keep=[cache_tree_paths(state.config, m)[1] for m in manifests.values()])
 
-def reuse_cache(state: MkosiState) -> bool:
+
+def reuse_cache(
+    state: MkosiState,
+    stack: contextlib.ExitStack,
+    manifests: dict[CacheLayer, dict[str, Any]],
+) -> list[CacheLayer]:
+    """
+    Restore the deepest cache layer whose inputs (and those of all the layers below it) are unchanged and return
+    the list of layers that do not have to be built again. If the cached tree is mounted instead of copied, the
+    mount is registered with the given exit stack.
+    """
     if not state.config.incremental:
-        return False
+        return []
 
-    final, build, manifest = cache_tree_paths(state.config)
-    if not final.exists() or (need_build_overlay(state.config) and not build.exists()):
-        return False
+    remove_legacy_cache_trees(state.config)
 
-    if manifest.exists():
-        prev = json.loads(manifest.read_text())
-        if prev != json.loads(json.dumps(state.config.cache_manifest(), cls=MkosiJsonEncoder)):
-            return False
-    else:
-        return False
+    layers = cache_layers(state.config)
+    cached = list(itertools.takewhile(lambda layer: have_cache_layer(state.config, manifests[layer]), layers))
+    overlay = state.workspace / "cache-overlay"
+    empty = not any(state.root.iterdir())
 
-    # Either we're running as root and the cache is owned by root or we're running unprivileged inside a user
-    # namespace and we'll think the cache is owned by root. However, if we're running as root and the cache was
-    # generated by an unprivileged build, the cache will not be owned by root and we should not use it.
-    for p in (final, build):
-        if p.exists() and p.stat().st_uid != 0:
-            return False
+    # If we have a base tree and still have to build some layers, restore the cached layer into the cache-overlay
+    # directory so that the layers we build on top of it are cached as the difference to the base tree as well.
+    if cached != layers and not empty:
+        with umask(~0o755):
+            overlay.mkdir()
+
+    if (root := [layer for layer in cached if layer != CacheLayer.build]):
+        tree, _ = cache_tree_paths(state.config, manifests[root[-1]])
+
+        if overlay.exists():
+            with complete_step(f"Copying cached {root[-1]} layer"):
+                # Using a btrfs subvolume as the upperdir in an overlayfs results in EXDEV.
+                copy_tree(tree, overlay)
+        # The directory output format is produced by renaming the root directory which we can't do if it's a
+        # mountpoint, so we always copy the cached tree in that case.
+        elif state.config.incremental_overlay and empty and state.config.output_format != OutputFormat.directory:
+            with complete_step(f"Mounting cached {root[-1]} layer"):
+                upper = state.workspace / "cache-upper"
+                with umask(~0o755):
+                    upper.mkdir()
+
+                stack.enter_context(mount_overlay([tree], upper, state.root))
+        else:
+            with complete_step(f"Copying cached {root[-1]} layer"):
+                copy_tree(tree, state.root, use_subvolumes=state.config.use_subvolumes)
 
-    with complete_step("Copying cached trees"):
-        copy_tree(final, state.root, use_subvolumes=state.config.use_subvolumes)
-        if need_build_overlay(state.config):
-            (state.workspace / "build-overlay").symlink_to(build)
+    if CacheLayer.build in cached:
+        tree, _ = cache_tree_paths(state.config, manifests[CacheLayer.build])
+        (state.workspace / "build-overlay").symlink_to(tree)
 
-    return True
+    # Bump the manifests' modification time so that least recently used entries are evicted first.
+    for layer in cached:
+        os.utime(cache_tree_paths(state.config, manifests[layer])[1])
+
+    return cached
+
+
+def merge_cache_overlay(state: MkosiState) -> None:
+    overlay = state.workspace / "cache-overlay"
+    if not overlay.exists():
+        return
+
+    with complete_step("Merging cache overlay into image"):
+        copy_tree(overlay, state.root, use_subvolumes=state.config.use_subvolumes)
+        rmtree(overlay)
 
 
 def make_image(
@@ -2130,7 +2396,8 @@ def make_image(
     if split:
         for p in partitions:
             if p.split_path:
-                maybe_compress(state.config, state.config.compress_output, p.split_path)
+                maybe_compress(state.config, state.config.compress_output, p.split_path,
+                               digests=output_digests(state))
 
     return partitions
 
@@ -2310,10 +2577,15 @@ def normalize_mtime(root: Path, mtime: Optional[int], directory: Optional[Path]
 
     directory = directory or Path("")
 
+    times = (mtime, mtime)
+
+    def visit(dirfd: int, entry: os.DirEntry[str], context: bool) -> Optional[bool]:
+        os.utime(entry.name, times, dir_fd=dirfd, follow_symlinks=False)
+        return True if entry.is_dir(follow_symlinks=False) else None
+
     with complete_step(f"Normalizing modification times of /{directory}"):
-        os.utime(root / directory, (mtime, mtime), follow_symlinks=False)
-        for p in (root / directory).rglob("*"):
-            os.utime(p, (mtime, mtime), follow_symlinks=False)
+        os.utime(root / directory, times, follow_symlinks=False)
+        walk_tree(root / directory, visit, True, parallel=True)
 
 
 @contextlib.contextmanager
@@ -2334,30 +2606,88 @@ def setup_workspace(args: MkosiArgs, config: MkosiConfig) -> Iterator[Path]:
                 raise
 
 
+def write_trace(steps: Sequence[StepProfile], path: Path) -> None:
+    origin = min((step.start for step in steps), default=0)
+
+    events = [
+        {
+            "name": step.text,
+            "cat": "step",
+            "ph": "X",
+            "ts": round((step.start - origin) * 1_000_000),
+            "dur": round(step.duration * 1_000_000),
+            "pid": os.getpid(),
+            "tid": 1,
+            "args": {
+                "cpu": step.cpu,
+                "child_cpu": step.child_cpu,
+                "maxrss": step.maxrss,
+                "written": step.written,
+            },
+        }
+        for step in steps
+    ]
+
+    path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, indent=4))
+    os.chown(path, INVOKING_USER.uid, INVOKING_USER.gid)
+
+
+def format_steps(steps: Sequence[StepProfile]) -> str:
+    lines = [f"{'WALL':>9} {'CPU':>9} {'CHILDREN':>9} {'PEAK RSS':>9} {'WRITTEN':>9}  STEP"]
+
+    for step in sorted(steps, key=lambda s: s.duration, reverse=True):
+        lines += [
+            f"{step.duration:>8.2f}s {step.cpu:>8.2f}s {step.child_cpu:>8.2f}s "
+            f"{format_bytes(step.maxrss):>9} {format_bytes(step.written):>9}  {'  ' * step.level}{step.text}"
+        ]
+
+    return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def trace_build(args: MkosiArgs, config: MkosiConfig) -> Iterator[None]:
+    if not args.trace:
+        yield
+        return
+
+    with record_steps() as steps:
+        yield
+
+    path = config.output_dir_or_cwd() / f"{config.output_with_version}.trace.json"
+    write_trace(steps, path)
+    log_step(f"Build steps of {config.name()} image (trace written to {path}):")
+    logging.info(format_steps(steps))
+
+
 def build_image(args: MkosiArgs, config: MkosiConfig) -> None:
+    from mkosi.installer import clean_package_manager_metadata
+    from mkosi.manifest import Manifest
+
     manifest = Manifest(config) if config.manifest_format else None
 
-    with setup_workspace(args, config) as workspace:
+    with (
+        trace_build(args, config),
+        setup_workspace(args, config) as workspace,
+        contextlib.ExitStack() as stack,
+    ):
         state = MkosiState(args, config, workspace)
         install_package_manager_trees(state)
 
         with mount_base_trees(state):
             install_base_trees(state)
             install_skeleton_trees(state)
-            cached = reuse_cache(state)
+            manifests = cache_manifests(state.config) if state.config.incremental else {}
+            cached = reuse_cache(state, stack, manifests)
 
             state.config.distribution.setup(state)
 
-            if not cached:
-                with mount_cache_overlay(state):
-                    install_distribution(state)
-                    run_prepare_scripts(state, build=False)
-                    install_build_packages(state)
-                    run_prepare_scripts(state, build=True)
-
-                save_cache(state)
-                reuse_cache(state)
+            with package_pool(state):
+                for layer in cache_layers(state.config):
+                    if layer not in cached:
+                        build_cache_layer(state, layer)
+                        save_cache(state, layer, manifests)
 
+            merge_cache_overlay(state)
             check_root_populated(state)
             run_build_scripts(state)
 
@@ -2394,13 +2724,21 @@ def build_image(args: MkosiArgs, config: MkosiConfig) -> None:
             run_selinux_relabel(state)
             run_finalize_scripts(state)
 
-        normalize_mtime(state.root, state.config.source_date_epoch)
+        # The tar and cpio writers (the latter is also used for the initrd embedded in UKIs) clamp modification
+        # times to SourceDateEpoch= themselves, so we only have to normalize them for the other output formats.
+        mtime = (
+            None
+            if state.config.output_format in (OutputFormat.tar, OutputFormat.cpio, OutputFormat.uki, OutputFormat.esp)
+            else state.config.source_date_epoch
+        )
+
+        normalize_mtime(state.root, mtime)
         partitions = make_disk(state, skip=("esp", "xbootldr"), msg="Generating disk image")
         install_uki(state, partitions)
         prepare_grub_efi(state)
         prepare_grub_bios(state, partitions)
-        normalize_mtime(state.root, state.config.source_date_epoch, directory=Path("boot"))
-        normalize_mtime(state.root, state.config.source_date_epoch, directory=Path("efi"))
+        normalize_mtime(state.root, mtime, directory=Path("boot"))
+        normalize_mtime(state.root, mtime, directory=Path("efi"))
         partitions = make_disk(state, msg="Formatting ESP/XBOOTLDR partitions")
         install_grub_bios(state, partitions)
 
@@ -2410,9 +2748,19 @@ def build_image(args: MkosiArgs, config: MkosiConfig) -> None:
         copy_vmlinuz(state)
 
         if state.config.output_format == OutputFormat.tar:
-            make_tar(state.root, state.staging / state.config.output_with_format)
+            make_tar(
+                state.root, state.staging / state.config.output_with_compression,
+                compression=state.config.compress_output,
+                mtime=state.config.source_date_epoch,
+                digests=output_digests(state),
+            )
         elif state.config.output_format == OutputFormat.cpio:
-            make_cpio(state.root, state.staging / state.config.output_with_format)
+            make_cpio(
+                state.root, state.staging / state.config.output_with_compression,
+                compression=state.config.compress_output,
+                mtime=state.config.source_date_epoch,
+                digests=output_digests(state),
+            )
         elif state.config.output_format == OutputFormat.uki:
             make_uki(state, state.staging / state.config.output_with_format)
         elif state.config.output_format == OutputFormat.esp:
@@ -2423,10 +2771,11 @@ def build_image(args: MkosiArgs, config: MkosiConfig) -> None:
         elif state.config.output_format == OutputFormat.directory:
             state.root.rename(state.staging / state.config.output_with_format)
 
-        if config.output_format not in (OutputFormat.uki, OutputFormat.esp):
+        if config.output_format not in (OutputFormat.tar, OutputFormat.cpio, OutputFormat.uki, OutputFormat.esp):
             maybe_compress(state.config, state.config.compress_output,
                            state.staging / state.config.output_with_format,
-                           state.staging / state.config.output_with_compression)
+                           state.staging / state.config.output_with_compression,
+                           digests=output_digests(state))
 
         calculate_sha256sum(state)
         calculate_signature(state)
@@ -2517,6 +2866,8 @@ def acl_toggle_boot(config: MkosiConfig, uid: int) -> Iterator[None]:
 
 
 def run_shell(args: MkosiArgs, config: MkosiConfig) -> None:
+    from mkosi.qemu import copy_ephemeral
+
     cmdline: list[PathString] = ["systemd-nspawn", "--quiet"]
 
     # If we copied in a .nspawn file, make sure it's actually honoured
@@ -2683,6 +3034,61 @@ def bump_image_version() -> None:
     os.chown("mkosi.version", INVOKING_USER.uid, INVOKING_USER.gid)
 
 
+def run_cache(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
+    if len(args.cmdline) != 1 or args.cmdline[0] not in ("gc", "stats"):
+        die("The cache verb takes exactly one of \"gc\" or \"stats\" as its argument")
+
+    pools: dict[Path, MkosiConfig] = {}
+    for config in images:
+        if (pool := config.package_pool_dir_or_default()):
+            pools.setdefault(pool, config)
+
+    if not pools:
+        die("No package pool configured", hint="Configure CacheDirectory= or PackagePoolDirectory=")
+
+    if args.cmdline[0] == "stats":
+        for pool in pools:
+            entries = pool_entries(pool)
+            shared = [e for e in entries if e.nlink > 1]
+
+            print(
+                textwrap.dedent(
+                    f"""\
+                    Package Pool: {pool}
+                        Packages: {len(entries)}
+                            Size: {format_bytes(sum(e.size for e in entries))}
+                          Linked: {len(shared)} ({format_bytes(sum(e.size for e in shared))})
+                    """
+                )
+            )
+
+        return
+
+    for pool, config in pools.items():
+        if config.package_pool_size is None:
+            die(f"No size limit configured for package pool {pool}", hint="Configure PackagePoolSize=")
+
+    # The package caches of the tools tree are stored in a subdirectory of the cache directory.
+    caches = [
+        p
+        for config in images if config.cache_dir
+        for p in (config.cache_dir, config.cache_dir / "tools")
+    ]
+
+    def target() -> None:
+        become_root()
+
+        for pool, config in pools.items():
+            assert config.package_pool_size is not None
+
+            with complete_step(f"Removing least recently used packages from {pool}…"):
+                removed = gc_package_pool(pool, config.package_pool_size, caches)
+
+            logging.info(f"Removed {len(removed)} packages ({format_bytes(sum(e.size for e in removed))})")
+
+    fork_and_wait(target)
+
+
 def show_docs(args: MkosiArgs) -> None:
     if args.doc_format == DocFormat.auto:
         formats = [DocFormat.man, DocFormat.pandoc, DocFormat.markdown, DocFormat.system]
@@ -2784,10 +3190,27 @@ def finalize_tools(args: MkosiArgs, images: Sequence[MkosiConfig]) -> Sequence[M
             *(["--mirror", mirror] if mirror else []),
             "--repository-key-check", str(p.repository_key_check),
             "--cache-only", str(p.cache_only),
+            *(
+                ["--repository-metadata-max-age", str(p.repository_metadata_max_age)]
+                if p.repository_metadata_max_age is not None
+                else []
+            ),
             *(["--output-dir", str(p.output_dir)] if p.output_dir else []),
             *(["--workspace-dir", str(p.workspace_dir)] if p.workspace_dir else []),
             *(["--cache-dir", str(cache)] if cache else []),
+            *(["--package-pool-directory", str(pool)] if (pool := p.package_pool_dir_or_default()) else []),
+            *(
+                ["--package-pool-size", str(p.package_pool_size)]
+                if p.package_pool_size is not None
+                else []
+            ),
             "--incremental", str(p.incremental),
+            *(
+                ["--incremental-cache-size", str(p.incremental_cache_size)]
+                if p.incremental_cache_size is not None
+                else []
+            ),
+            "--incremental-overlay", str(p.incremental_overlay),
             "--acl", str(p.acl),
             "--format", "directory",
             *flatten(
@@ -2832,7 +3255,7 @@ def mount_tools(tree: Optional[Path]) -> Iterator[None]:
         # into permission errors.
 
         tmp = stack.enter_context(tempfile.TemporaryDirectory(dir="/var/tmp"))
-        stack.enter_context(mount_overlay([Path("/etc")], Path(tmp), Path("/etc")))
+        stack.enter_context(mount_overlay([Path("/etc")], Path(tmp), Path("/etc"), delete_whiteouts=False))
 
         for subdir in ("etc/pki", "etc/ssl", "etc/crypto-policies", "etc/ca-certificates"):
             if not (tree / subdir).exists():
@@ -2877,10 +3300,49 @@ def check_workspace_directory(config: MkosiConfig) -> None:
                 hint="Use WorkspaceDirectory= to configure a different workspace directory")
 
 
+def image_key(config: MkosiConfig) -> str:
+    return config.image or config.name()
+
+
+def run_build(args: MkosiArgs, config: MkosiConfig) -> None:
+    become_root()
+    init_mount_namespace()
+
+    # For extra safety when running as root, remount a bunch of stuff read-only.
+    for d in ("/usr", "/etc", "/opt", "/srv", "/boot", "/efi", "/media", "/mnt"):
+        if Path(d).exists():
+            run(["mount", "--rbind", d, d, "--options", "ro"])
+
+    with (
+        complete_step(f"Building {config.name()} image"),
+        mount_tools(config.tools_tree),
+        hide_host_directories(),
+        prepend_to_environ_path(config),
+    ):
+        # After tools have been mounted, check if we have what we need
+        check_tools(args, config)
+
+        # Create these as the invoking user to make sure they're owned by the user running mkosi.
+        for p in (
+            config.output_dir,
+            config.cache_dir,
+            config.build_dir,
+            config.workspace_dir,
+        ):
+            if p:
+                run(["mkdir", "--parents", p], user=INVOKING_USER.uid, group=INVOKING_USER.gid)
+
+        with acl_toggle_build(config, INVOKING_USER.uid):
+            build_image(args, config)
+
+
 def run_verb(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
     if args.verb.needs_root() and os.getuid() != 0:
         die(f"Must be root to run the {args.verb} command")
 
+    if args.jobs < 1:
+        die(f"--jobs= must be at least 1, got {args.jobs}")
+
     if args.verb == Verb.documentation:
         return show_docs(args)
 
@@ -2908,6 +3370,9 @@ def run_verb(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
         page(text, args.pager)
         return
 
+    if args.verb == Verb.cache:
+        return run_cache(args, images)
+
     for config in images:
         check_workspace_directory(config)
 
@@ -2940,16 +3405,30 @@ def run_verb(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
     for config in images:
         try_import(f"mkosi.distributions.{config.distribution}")
 
+    # Modules that are only needed by some verbs are imported on demand to keep mkosi's startup time low, so
+    # they have to be loaded here as well.
+    if any(needs_build(args, config) for config in images):
+        for module in ("concurrent.futures.thread", "mkosi.installer", "mkosi.kmod", "mkosi.manifest"):
+            try_import(module)
+    if args.verb in (Verb.shell, Verb.boot, Verb.qemu, Verb.ssh):
+        try_import("mkosi.qemu")
+    if args.verb == Verb.burn:
+        try_import("mkosi.burn")
+
     # After we unshare the user namespace, we might not have access to /dev/kvm or related device nodes anymore as
     # access to these might be gated behind the kvm group and we won't be part of the kvm group anymore after unsharing
     # the user namespace. To get around this, open all those device nodes now while we still can so we can pass them as
     # file descriptors to qemu later. Note that we can't pass the kvm file descriptor to qemu until
     # https://gitlab.com/qemu-project/qemu/-/issues/1936 is resolved.
-    qemu_device_fds = {
-        d: d.open()
-        for d in QemuDeviceNode
-        if args.verb == Verb.qemu and d.feature(last) != ConfigFeature.disabled and d.available(log=True)
-    }
+    qemu_device_fds = {}
+    if args.verb == Verb.qemu:
+        from mkosi.qemu import QemuDeviceNode
+
+        qemu_device_fds = {
+            d: d.open()
+            for d in QemuDeviceNode
+            if d.feature(last) != ConfigFeature.disabled and d.available(log=True)
+        }
 
     # First, process all directory removals because otherwise if different images share directories a later
     # image build could end up deleting the output generated by an earlier image build.
@@ -2967,48 +3446,29 @@ def run_verb(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
     if args.verb == Verb.clean:
         return
 
-    build = False
-
     for config in images:
         check_inputs(config)
 
-        if not needs_build(args, config):
-            continue
-
-        def target() -> None:
-            become_root()
-            init_mount_namespace()
-
-            # For extra safety when running as root, remount a bunch of stuff read-only.
-            for d in ("/usr", "/etc", "/opt", "/srv", "/boot", "/efi", "/media", "/mnt"):
-                if Path(d).exists():
-                    run(["mount", "--rbind", d, d, "--options", "ro"])
-
-            with (
-                complete_step(f"Building {config.name()} image"),
-                mount_tools(config.tools_tree),
-                hide_host_directories(),
-                prepend_to_environ_path(config),
-            ):
-                # After tools have been mounted, check if we have what we need
-                check_tools(args, config)
-
-                # Create these as the invoking user to make sure they're owned by the user running mkosi.
-                for p in (
-                    config.output_dir,
-                    config.cache_dir,
-                    config.build_dir,
-                    config.workspace_dir,
-                ):
-                    if p:
-                        run(["mkdir", "--parents", p], user=INVOKING_USER.uid, group=INVOKING_USER.gid)
-
-                with acl_toggle_build(config, INVOKING_USER.uid):
-                    build_image(args, config)
+    build = [config for config in images if needs_build(args, config)]
 
-        fork_and_wait(target)
+    if args.jobs > 1 and len(build) > 1:
+        graph = {
+            image_key(config): [
+                image_key(dep)
+                for dep in build
+                if dep.image in config.dependencies or config.tools_tree == dep.output_dir_or_cwd() / dep.output
+            ]
+            for config in build
+        }
 
-        build = True
+        fork_and_wait_graph(
+            {image_key(config): functools.partial(run_build, args, config) for config in build},
+            graph,
+            args.jobs,
+        )
+    else:
+        for config in build:
+            fork_and_wait(functools.partial(run_build, args, config))
 
     if build and args.auto_bump:
         bump_image_version()
@@ -3035,9 +3495,13 @@ def run_verb(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
                     run_shell(args, last)
 
             if args.verb == Verb.qemu:
+                from mkosi.qemu import run_qemu
+
                 run_qemu(args, last, qemu_device_fds)
 
             if args.verb == Verb.ssh:
+                from mkosi.qemu import run_ssh
+
                 run_ssh(args, last)
 
             if args.verb == Verb.serve:
@@ -3050,4 +3514,6 @@ def run_verb(args: MkosiArgs, images: Sequence[MkosiConfig]) -> None:
                 run_coredumpctl(args, last)
 
             if args.verb == Verb.burn:
+                from mkosi.burn import run_burn
+
                 run_burn(args, last)
@@ -9,7 +9,7 @@ from types import FrameType
 from typing import Optional
 
 from mkosi import run_verb
-from mkosi.config import parse_config
+from mkosi.config import parse_config_cached
 from mkosi.log import log_setup
 from mkosi.run import run, uncaught_exception_handler
 from mkosi.util import INVOKING_USER
@@ -26,7 +26,7 @@ def main() -> None:
     log_setup()
     # Ensure that the name and home of the user we are running as are resolved as early as possible.
     INVOKING_USER.init()
-    args, images = parse_config(sys.argv[1:])
+    args, images = parse_config_cached(sys.argv[1:])
 
     if args.debug:
         faulthandler.enable()
@@ -1,13 +1,20 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import contextlib
+import hashlib
 import os
 import shutil
-from collections.abc import Iterable
+import stat
+import subprocess
+import threading
+from collections.abc import Iterable, Iterator
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Optional
 
-from mkosi.log import log_step
-from mkosi.run import bwrap, finalize_passwd_mounts
+from mkosi.config import Compression
+from mkosi.log import die, log_step
+from mkosi.run import bwrap, finalize_passwd_mounts, log_process_failure, spawn
+from mkosi.types import _FILE, PathString
 
 
 def tar_binary() -> str:
@@ -21,8 +28,87 @@ def tar_binary() -> str:
     return "gtar" if shutil.which("gtar") else "tar"
 
 
-def cpio_binary() -> str:
-    return "gcpio" if shutil.which("gcpio") else "cpio"
+def gzip_binary() -> str:
+    return "pigz" if shutil.which("pigz") else "gzip"
+
+
+def compressor_command(compression: Compression) -> list[PathString]:
+    """Returns a command suitable for compressing archives."""
+
+    if compression == Compression.gz:
+        return [gzip_binary(), "--fast", "--stdout", "-"]
+    elif compression == Compression.xz:
+        return ["xz", "--check=crc32", "--fast", "-T0", "--stdout", "-"]
+    elif compression == Compression.zstd:
+        return ["zstd", "-q", "-T0", "--stdout", "-"]
+    else:
+        die(f"Unknown compression {compression}")
+
+
+@contextlib.contextmanager
+def hashing_writer(o: BinaryIO, dst: Path, digests: dict[Path, str]) -> Iterator[BinaryIO]:
+    """
+    Returns a file object that forwards everything written to it to o while calculating its SHA256 digest on the
+    fly, which is stored in digests under dst once the file object is closed. Writes go through a pipe so that
+    the returned file object can also be handed to subprocesses.
+    """
+    h = hashlib.sha256()
+    r, w = os.pipe()
+    errors: list[BaseException] = []
+
+    def copy() -> None:
+        try:
+            with open(r, "rb") as i:
+                while (buf := i.read(1024**2)):
+                    h.update(buf)
+                    o.write(buf)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=copy)
+    thread.start()
+
+    try:
+        with open(w, "wb") as f:
+            yield f
+    finally:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    digests[dst] = h.hexdigest()
+
+
+@contextlib.contextmanager
+def compressed_writer(
+    dst: Path,
+    compression: Compression = Compression.none,
+    digests: Optional[dict[Path, str]] = None,
+) -> Iterator[BinaryIO]:
+    """
+    Open dst for writing. If compression is requested, everything written to the returned file object is piped
+    through the compressor before it ends up in dst so that no uncompressed copy is ever written to disk. If
+    digests is not None, the SHA256 digest of dst is recorded in it while it is written.
+    """
+    with dst.open("wb") as f, contextlib.ExitStack() as stack:
+        o: BinaryIO = stack.enter_context(hashing_writer(f, dst, digests)) if digests is not None else f
+
+        if not compression:
+            yield o
+            return
+
+        cmdline = [os.fspath(x) for x in compressor_command(compression)]
+        r, w = os.pipe()
+
+        with spawn(cmdline, stdin=r, stdout=o) as proc:
+            os.close(r)
+            with open(w, "wb") as i:
+                yield i
+
+        if proc.returncode != 0:
+            log_process_failure(cmdline, proc.returncode)
+            raise subprocess.CalledProcessError(proc.returncode, cmdline)
 
 
 def tar_exclude_apivfs_tmp() -> list[str]:
@@ -36,32 +122,46 @@ def tar_exclude_apivfs_tmp() -> list[str]:
     ]
 
 
-def make_tar(src: Path, dst: Path) -> None:
+def make_tar(
+    src: Path,
+    dst: Path,
+    compression: Compression = Compression.none,
+    mtime: Optional[int] = None,
+    digests: Optional[dict[Path, str]] = None,
+) -> None:
     log_step(f"Creating tar archive {dst}…")
-    bwrap(
-        [
-            tar_binary(),
-            "--create",
-            "--file", dst,
-            "--directory", src,
-            "--acls",
-            "--selinux",
-            # --xattrs implies --format=pax
-            "--xattrs",
-            # PAX format emits additional headers for atime, ctime and mtime
-            # that would make the archive non-reproducible.
-            "--pax-option=delete=atime,delete=ctime,delete=mtime",
-            "--sparse",
-            "--force-local",
-            *tar_exclude_apivfs_tmp(),
-            ".",
-        ],
-        # Make sure tar uses user/group information from the root directory instead of the host.
-        options=finalize_passwd_mounts(src) if (src / "etc/passwd").exists() else [],
-    )
+    with compressed_writer(dst, compression, digests) as f:
+        bwrap(
+            [
+                tar_binary(),
+                "--create",
+                "--file", "-",
+                "--directory", src,
+                "--acls",
+                "--selinux",
+                # --xattrs implies --format=pax
+                "--xattrs",
+                # PAX format emits additional headers for atime, ctime and mtime
+                # that would make the archive non-reproducible.
+                "--pax-option=delete=atime,delete=ctime,delete=mtime",
+                # Clamp modification times while writing the archive so the tree doesn't have to be normalized
+                # beforehand.
+                *(["--mtime", f"@{mtime}", "--clamp-mtime"] if mtime is not None else []),
+                "--sparse",
+                "--force-local",
+                *tar_exclude_apivfs_tmp(),
+                ".",
+            ],
+            # Make sure tar uses user/group information from the root directory instead of the host.
+            options=finalize_passwd_mounts(src) if (src / "etc/passwd").exists() else [],
+            stdout=f,
+        )
 
 
-def extract_tar(src: Path, dst: Path, log: bool = True) -> None:
+def extract_tar(src: Path, dst: Path, log: bool = True, stdin: _FILE = None) -> None:
+    """
+    Extract the tar archive src into dst. To extract an archive read from stdin, pass "-" as src.
+    """
     if log:
         log_step(f"Extracting tar archive {src}…")
     bwrap(
@@ -83,26 +183,153 @@ def extract_tar(src: Path, dst: Path, log: bool = True) -> None:
         ],
         # Make sure tar uses user/group information from the root directory instead of the host.
         options=finalize_passwd_mounts(dst) if (dst / "etc/passwd").exists() else [],
+        stdin=stdin,
     )
 
 
-def make_cpio(src: Path, dst: Path, files: Optional[Iterable[Path]] = None) -> None:
+def cpio_header(
+    *,
+    path: PathString,
+    ino: int,
+    mode: int,
+    uid: int,
+    gid: int,
+    nlink: int,
+    mtime: int,
+    size: int,
+    rdev: int,
+    namesize: int,
+) -> bytes:
+    fields = {
+        "inode": ino,
+        "mode": mode,
+        "uid": uid,
+        "gid": gid,
+        "nlink": nlink,
+        "mtime": mtime,
+        "size": size,
+        # We always record 0:0 as the device the file lives on so that the archive is reproducible.
+        "devmajor": 0,
+        "devminor": 0,
+        "rdevmajor": os.major(rdev),
+        "rdevminor": os.minor(rdev),
+        "namesize": namesize,
+        # The checksum is only used by the "crc" format.
+        "check": 0,
+    }
+
+    # Every field of the newc format is exactly eight hexadecimal digits, so any value that doesn't fit would
+    # silently corrupt the archive.
+    for field, v in fields.items():
+        if not 0 <= v < 2**32:
+            die(f"Cannot add {path} to cpio archive: its {field} {v} does not fit in the newc format")
+
+    return b"070701" + b"".join(f"{v:08x}".encode() for v in fields.values())
+
+
+def write_cpio(f: BinaryIO, src: Path, files: Iterable[Path], mtime: Optional[int] = None) -> None:
+    """
+    Write a newc cpio archive of the given files to f. Inode numbers are assigned sequentially, the contents of
+    hardlinked files are stored with the last link like GNU cpio does and mtimes are clamped to mtime if given.
+    """
+    entries = [(os.fsencode(p.relative_to(src)), p, os.lstat(p)) for p in files]
+
+    # Like GNU cpio, we store the data of hardlinked files with the last link in the archive and write all
+    # other links with a size of zero.
+    last = {(st.st_dev, st.st_ino): i for i, (_, _, st) in enumerate(entries) if st.st_nlink > 1}
+    inodes: dict[tuple[int, int], int] = {}
+    offset = 0
+
+    def write(b: bytes) -> None:
+        nonlocal offset
+        f.write(b)
+        offset += len(b)
+
+    def pad() -> None:
+        write(b"\0" * (-offset % 4))
+
+    for i, (name, path, st) in enumerate(entries):
+        key = (st.st_dev, st.st_ino)
+        ino = inodes.setdefault(key, len(inodes) + 1)
+        data = b""
+        size = 0
+
+        if stat.S_ISLNK(st.st_mode):
+            data = os.fsencode(os.readlink(path))
+            size = len(data)
+        elif stat.S_ISREG(st.st_mode) and last.get(key, i) == i:
+            size = st.st_size
+
+        write(
+            cpio_header(
+                path=path,
+                ino=ino,
+                mode=st.st_mode,
+                uid=st.st_uid,
+                gid=st.st_gid,
+                nlink=st.st_nlink,
+                mtime=min(int(st.st_mtime), mtime) if mtime is not None else int(st.st_mtime),
+                size=size,
+                rdev=st.st_rdev if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) else 0,
+                namesize=len(name) + 1,
+            )
+        )
+        write(name + b"\0")
+        pad()
+
+        if data:
+            write(data)
+        elif size:
+            with path.open("rb") as sf:
+                remaining = size
+                while remaining and (buf := sf.read(min(remaining, 1024**2))):
+                    write(buf)
+                    remaining -= len(buf)
+
+            if remaining:
+                die(f"{path} changed size while it was being added to the cpio archive")
+
+        pad()
+
+    trailer = b"TRAILER!!!"
+    write(
+        cpio_header(
+            path="TRAILER!!!",
+            ino=0,
+            mode=0,
+            uid=0,
+            gid=0,
+            nlink=1,
+            mtime=0,
+            size=0,
+            rdev=0,
+            namesize=len(trailer) + 1,
+        )
+    )
+    write(trailer + b"\0")
+    pad()
+    # GNU cpio pads archives to a multiple of its 512 byte block size.
+    write(b"\0" * (-offset % 512))
+
+
+def cpio_files(src: Path) -> Iterator[Path]:
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            yield Path(dirpath) / name
+
+
+def make_cpio(
+    src: Path,
+    dst: Path,
+    files: Optional[Iterable[Path]] = None,
+    compression: Compression = Compression.none,
+    mtime: Optional[int] = None,
+    digests: Optional[dict[Path, str]] = None,
+) -> None:
     if not files:
-        files = src.rglob("*")
+        files = cpio_files(src)
 
     log_step(f"Creating cpio archive {dst}…")
-    bwrap(
-        [
-            cpio_binary(),
-            "--create",
-            "--reproducible",
-            "--null",
-            "--format=newc",
-            "--quiet",
-            "--directory", src,
-            "-O", dst,
-        ],
-        input="\0".join(os.fspath(f.relative_to(src)) for f in files),
-        # Make sure tar uses user/group information from the root directory instead of the host.
-        options=finalize_passwd_mounts(dst),
-    )
+    with compressed_writer(dst, compression, digests) as f:
+        write_cpio(f, src, files, mtime)
@@ -3,23 +3,27 @@
 import argparse
 import base64
 import contextlib
+import contextvars
 import copy
 import dataclasses
 import enum
 import fnmatch
 import functools
 import graphlib
+import hashlib
 import inspect
 import json
 import logging
 import math
 import operator
 import os.path
+import pickle
 import platform
 import re
 import shlex
 import shutil
 import subprocess
+import sys
 import tempfile
 import textwrap
 import uuid
@@ -59,6 +63,7 @@ class Verb(StrEnum):
     journalctl    = enum.auto()
     coredumpctl   = enum.auto()
     burn          = enum.auto()
+    cache         = enum.auto()
 
     def supports_cmdline(self) -> bool:
         return self in (
@@ -70,6 +75,7 @@ class Verb(StrEnum):
             Verb.journalctl,
             Verb.coredumpctl,
             Verb.burn,
+            Verb.cache,
         )
 
     def needs_build(self) -> bool:
@@ -170,6 +176,12 @@ class ManifestFormat(StrEnum):
     changelog = enum.auto()  # human-readable text file with package changelogs
 
 
+class CacheLayer(StrEnum):
+    install = enum.auto()  # the distribution installation
+    prepare = enum.auto()  # the image after running the prepare scripts
+    build   = enum.auto()  # the build overlay with build packages and the build prepare scripts
+
+
 class Compression(StrEnum):
     none = enum.auto()
     zstd = enum.auto()
@@ -228,6 +240,34 @@ def parse_boolean(s: str) -> bool:
     die(f"Invalid boolean literal: {s!r}")
 
 
+@dataclasses.dataclass
+class ConfigInputs:
+    """The files and directories that the result of parsing the configuration depends on."""
+    paths: set[Path] = dataclasses.field(default_factory=set)
+    # The environment variables that were looked up.
+    environ: set[str] = dataclasses.field(default_factory=set)
+    # Set if the configuration depends on something other than files, e.g. the output of a program.
+    cacheable: bool = True
+
+
+CONFIG_INPUTS: contextvars.ContextVar[Optional[ConfigInputs]] = contextvars.ContextVar("config-inputs", default=None)
+
+
+def record_config_input(path: Path) -> None:
+    if (inputs := CONFIG_INPUTS.get()) is not None:
+        inputs.paths.add(path.absolute())
+
+
+def record_config_environ(key: str) -> None:
+    if (inputs := CONFIG_INPUTS.get()) is not None:
+        inputs.environ.add(key)
+
+
+def uncacheable_config() -> None:
+    if (inputs := CONFIG_INPUTS.get()) is not None:
+        inputs.cacheable = False
+
+
 def parse_path(value: str,
                *,
                required: bool = True,
@@ -237,6 +277,8 @@ def parse_path(value: str,
                expandvars: bool = True,
                secret: bool = False) -> Path:
     if expandvars:
+        for m in re.finditer(r"\$(\w+|\{[^}]*\})", value):
+            record_config_environ(m.group(1).strip("{}"))
         value = os.path.expandvars(value)
 
     path = Path(value)
@@ -246,6 +288,8 @@ def parse_path(value: str,
             path = INVOKING_USER.home() / path.relative_to("~")
         path = path.expanduser()
 
+    record_config_input(path)
+
     if required and not path.exists():
         die(f"{value} does not exist")
 
@@ -275,6 +319,42 @@ def parse_tree(value: str) -> ConfigTree:
     )
 
 
+def tree_digest(path: Path) -> str:
+    """Hash the names, modes, symlink targets and contents of all files in the given tree."""
+    h = hashlib.sha256()
+
+    if not path.exists():
+        return h.hexdigest()
+
+    if not path.is_dir():
+        with path.open("rb") as f:
+            while (buf := f.read(1024 * 1024)):
+                h.update(buf)
+        return h.hexdigest()
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            p = Path(dirpath) / name
+            st = p.lstat()
+            h.update(os.fspath(p.relative_to(path)).encode() + b"\0")
+            h.update(f"{st.st_mode:o}".encode() + b"\0")
+
+            if p.is_symlink():
+                h.update(os.fsencode(os.readlink(p)) + b"\0")
+            elif p.is_file():
+                with p.open("rb") as f:
+                    while (buf := f.read(1024 * 1024)):
+                        h.update(buf)
+
+    return h.hexdigest()
+
+
+def cache_manifest_key(manifest: dict[str, Any]) -> str:
+    """Return the key that identifies the cache entry with the given manifest."""
+    return hashlib.sha256(json.dumps(manifest, cls=MkosiJsonEncoder, sort_keys=True).encode()).hexdigest()[:16]
+
+
 def config_match_build_sources(match: str, value: list[ConfigTree]) -> bool:
     return Path(match.lstrip("/")) in [tree.target for tree in value if tree.target]
 
@@ -393,6 +473,7 @@ def config_default_source_date_epoch(namespace: argparse.Namespace) -> Optional[
     for env in namespace.environment:
         if env.startswith("SOURCE_DATE_EPOCH="):
             return config_parse_source_date_epoch(env.removeprefix("SOURCE_DATE_EPOCH="), None)
+    record_config_environ("SOURCE_DATE_EPOCH")
     return config_parse_source_date_epoch(os.environ.get("SOURCE_DATE_EPOCH"), None)
 
 
@@ -539,6 +620,7 @@ def match_path_exists(value: str) -> bool:
     if not value:
         return False
 
+    record_config_input(Path(value))
     return Path(value).exists()
 
 
@@ -557,6 +639,7 @@ def match_systemd_version(value: str) -> bool:
     if not value:
         return False
 
+    uncacheable_config()
     version = run(["systemctl", "--version"], stdout=subprocess.PIPE).stdout.strip().split()[1]
     return config_match_version(value, version)
 
@@ -585,6 +668,31 @@ def parse_bytes(value: str) -> int:
     return result
 
 
+def parse_seconds(value: str) -> int:
+    factors = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+    factor = factors.get(value[-1:], 1)
+    if value[-1:] in factors:
+        value = value[:-1]
+
+    try:
+        result = int(value) * factor
+    except ValueError:
+        die(f"{value!r} is not a valid time span")
+
+    if result < 0:
+        die(f"Time span {value!r} is negative")
+
+    return result
+
+
+def config_parse_seconds(value: Optional[str], old: Optional[int] = None) -> Optional[int]:
+    if not value:
+        return None
+
+    return parse_seconds(value)
+
+
 def config_parse_bytes(value: Optional[str], old: Optional[int] = None) -> Optional[int]:
     if not value:
         return None
@@ -793,6 +901,8 @@ class MkosiArgs:
     auto_bump: bool
     doc_format: DocFormat
     json: bool
+    jobs: int
+    trace: bool
 
     @classmethod
     def default(cls) -> "MkosiArgs":
@@ -876,6 +986,7 @@ class MkosiConfig:
     repository_key_check: bool
     repositories: list[str]
     cache_only: bool
+    repository_metadata_max_age: Optional[int]
     package_manager_trees: list[ConfigTree]
 
     output_format: OutputFormat
@@ -885,6 +996,7 @@ class MkosiConfig:
     output_dir: Optional[Path]
     workspace_dir: Optional[Path]
     cache_dir: Optional[Path]
+    package_pool_dir: Optional[Path]
     build_dir: Optional[Path]
     image_id: Optional[str]
     image_version: Optional[str]
@@ -959,6 +1071,9 @@ class MkosiConfig:
     key: Optional[str]
 
     incremental: bool
+    incremental_cache_size: Optional[int]
+    incremental_overlay: bool
+    package_pool_size: Optional[int]
     nspawn_settings: Optional[Path]
     extra_search_paths: list[Path]
     ephemeral: bool
@@ -995,6 +1110,12 @@ class MkosiConfig:
     def output_dir_or_cwd(self) -> Path:
         return self.output_dir or Path.cwd()
 
+    def package_pool_dir_or_default(self) -> Optional[Path]:
+        if self.package_pool_dir:
+            return self.package_pool_dir
+
+        return self.cache_dir / "pool" if self.cache_dir else None
+
     def workspace_dir_or_default(self) -> Path:
         if self.workspace_dir:
             return self.workspace_dir
@@ -1086,20 +1207,39 @@ class MkosiConfig:
     def output_changelog(self) -> str:
         return f"{self.output_with_version}.changelog"
 
-    def cache_manifest(self) -> dict[str, Any]:
-        return {
+    def cache_manifest(self, layer: CacheLayer = CacheLayer.build) -> dict[str, Any]:
+        # Each layer's manifest includes the inputs of all the layers below it so that changing the inputs of a
+        # layer invalidates all the layers on top of it as well.
+        manifest: dict[str, Any] = {
+            "layer": layer,
             "distribution": self.distribution,
             "release": self.release,
             "architecture": self.architecture,
             "packages": self.packages,
-            "build_packages": self.build_packages,
             "repositories": self.repositories,
             "overlay": self.overlay,
-            "prepare_scripts": [
+            "package_manager_trees": [
+                {
+                    "target": tree.target,
+                    "digest": tree_digest(tree.source),
+                }
+                for tree in self.package_manager_trees
+            ],
+        }
+
+        if layer in (CacheLayer.prepare, CacheLayer.build):
+            manifest["prepare_scripts"] = [
                 base64.b64encode(script.read_bytes()).decode()
                 for script in self.prepare_scripts
             ]
-        }
+
+        if layer == CacheLayer.build:
+            manifest["build_packages"] = self.build_packages
+
+        return manifest
+
+    def cache_key(self, layer: CacheLayer = CacheLayer.build) -> str:
+        return cache_manifest_key(self.cache_manifest(layer))
 
     def to_dict(self) -> dict[str, Any]:
         def key_transformer(k: str) -> str:
@@ -1304,6 +1444,13 @@ SETTINGS = (
         parse=config_parse_boolean,
         help="Only use the package cache when installing packages",
     ),
+    MkosiConfigSetting(
+        dest="repository_metadata_max_age",
+        metavar="SECONDS",
+        section="Distribution",
+        parse=config_parse_seconds,
+        help="Maximum age of cached repository metadata",
+    ),
     MkosiConfigSetting(
         dest="package_manager_trees",
         long="--package-manager-tree",
@@ -1383,6 +1530,14 @@ SETTINGS = (
         paths=("mkosi.cache",),
         help="Package cache path",
     ),
+    MkosiConfigSetting(
+        dest="package_pool_dir",
+        metavar="PATH",
+        name="PackagePoolDirectory",
+        section="Output",
+        parse=config_make_path_parser(required=False),
+        help="Shared package pool path",
+    ),
     MkosiConfigSetting(
         dest="build_dir",
         metavar="PATH",
@@ -1910,6 +2065,28 @@ SETTINGS = (
         parse=config_parse_boolean,
         help="Make use of and generate intermediary cache images",
     ),
+    MkosiConfigSetting(
+        dest="incremental_cache_size",
+        metavar="BYTES",
+        section="Host",
+        parse=config_parse_bytes,
+        help="Maximum size of all incremental cache entries in the cache directory",
+    ),
+    MkosiConfigSetting(
+        dest="incremental_overlay",
+        metavar="BOOL",
+        nargs="?",
+        section="Host",
+        parse=config_parse_boolean,
+        help="Mount cached images as an overlay instead of copying them",
+    ),
+    MkosiConfigSetting(
+        dest="package_pool_size",
+        metavar="BYTES",
+        section="Host",
+        parse=config_parse_bytes,
+        help="Maximum size of the package pool",
+    ),
     MkosiConfigSetting(
         dest="nspawn_settings",
         name="NSpawnSettings",
@@ -2149,6 +2326,7 @@ def create_argument_parser(action: type[argparse.Action]) -> argparse.ArgumentPa
                 mkosi [options...] {b}journalctl{e}  [command line...]
                 mkosi [options...] {b}coredumpctl{e} [command line...]
                 mkosi [options...] {b}clean{e}
+                mkosi [options...] {b}cache{e}       gc|stats
                 mkosi [options...] {b}serve{e}
                 mkosi [options...] {b}bump{e}
                 mkosi [options...] {b}genkey{e}
@@ -2238,6 +2416,19 @@ def create_argument_parser(action: type[argparse.Action]) -> argparse.ArgumentPa
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        metavar="JOBS",
+        help="Number of images to build in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--trace",
+        help="Record the duration and resource usage of each build step",
+        action="store_true",
+        default=False,
+    )
     # These can be removed once mkosi v15 is available in LTS distros and compatibility with <= v14
     # is no longer needed in build infrastructure (e.g.: OBS).
     parser.add_argument(
@@ -2499,10 +2690,15 @@ def parse_config(argv: Sequence[str] = ()) -> tuple[MkosiArgs, tuple[MkosiConfig
         if path.is_dir():
             path = path / "mkosi.conf"
 
+        record_config_input(path)
+
         if not match_config(path, namespace, defaults):
             return False
 
         if extras:
+            record_config_input(path.parent / "mkosi.local.conf")
+            record_config_input(path.parent / "mkosi.conf.d")
+
             if (path.parent / "mkosi.local.conf").exists():
                 parse_config(path.parent / "mkosi.local.conf", namespace, defaults)
 
@@ -2556,6 +2752,7 @@ def parse_config(argv: Sequence[str] = ()) -> tuple[MkosiArgs, tuple[MkosiConfig
             if profile:
                 for p in (profile, f"{profile}.conf"):
                     p = Path("mkosi.profiles") / p
+                    record_config_input(p)
                     if p.exists():
                         break
                 else:
@@ -2623,6 +2820,7 @@ def parse_config(argv: Sequence[str] = ()) -> tuple[MkosiArgs, tuple[MkosiConfig
 
         d: Optional[Path]
         for d in (Path("mkosi.images"), Path("mkosi.presets")):
+            record_config_input(d)
             if Path(d).exists():
                 break
         else:
@@ -2683,6 +2881,161 @@ def parse_config(argv: Sequence[str] = ()) -> tuple[MkosiArgs, tuple[MkosiConfig
     return args, tuple(images)
 
 
+def config_cache_dir() -> Path:
+    return Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "mkosi/config"
+
+
+def config_input_fingerprint(path: Path) -> Optional[tuple[int, int, int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+
+# Environment variables that are consulted implicitly while parsing the configuration, e.g. by shutil.which(),
+# Path.expanduser() or run().
+CONFIG_CACHE_ENVIRON = (
+    "HOME",
+    "PATH",
+    "PKEXEC_UID",
+    "SUDO_GID",
+    "SUDO_UID",
+    "SYSTEMD_LOG_LEVEL",
+    "TERM",
+    "TMPDIR",
+    "XDG_CACHE_HOME",
+)
+
+
+def config_cache_key(argv: Sequence[str]) -> str:
+    # Anything that can influence the result of parsing the configuration that isn't a file or environment variable
+    # we record while parsing goes into the key.
+    key = [
+        list(argv),
+        os.fspath(Path.cwd()),
+        [os.getenv(k) for k in CONFIG_CACHE_ENVIRON],
+        os.getuid(),
+        os.geteuid(),
+        list(shutil.get_terminal_size()),
+        __version__,
+        sys.version,
+        platform.release(),
+        platform.machine(),
+        config_input_fingerprint(Path(__file__)),
+    ]
+
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+class LogRecorder(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__(logging.INFO)
+        self.records: list[tuple[int, str]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def parse_config_cached(
+    argv: Sequence[str] = (),
+    *,
+    max_entries: int = 64,
+) -> tuple[MkosiArgs, tuple[MkosiConfig, ...]]:
+    """
+    Like parse_config() but reuses the result of an earlier invocation with the same arguments and environment
+    if none of the configuration files that were looked at during that invocation changed since then.
+    """
+    cachedir = config_cache_dir()
+    cache = cachedir / f"{config_cache_key(argv)}.pickle"
+
+    # We use pickle instead of JSON as the JSON roundtrip does not preserve the exact types of all settings which
+    # would make the cached configuration compare unequal to a freshly parsed one.
+    try:
+        with cache.open("rb") as f:
+            # Unpickling a file runs arbitrary code, so only load files that nobody else could have written.
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+                logging.debug(f"Ignoring configuration cache {cache} which is not owned by us")
+                j = None
+            else:
+                j = pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ImportError):
+        j = None
+
+    if (
+        isinstance(j, dict) and
+        j.get("Version") == __version__ and
+        all(config_input_fingerprint(p) == fp for p, fp in j["Inputs"].items()) and
+        all(os.getenv(k) == v for k, v in j["Environ"].items())
+    ):
+        args = j["Args"]
+        images = j["Images"]
+
+        # Bump the modification time so that the least recently used entries are removed first.
+        with contextlib.suppress(OSError):
+            os.utime(cache)
+
+        # Replay the side effects of parsing the configuration.
+        if args.directory is not None:
+            os.chdir(args.directory)
+        if args.debug:
+            ARG_DEBUG.set(args.debug)
+            logging.getLogger().setLevel(logging.DEBUG)
+        if args.debug_shell:
+            ARG_DEBUG_SHELL.set(args.debug_shell)
+        for level, message in j["Log"]:
+            logging.log(level, message)
+
+        return args, images
+
+    inputs = ConfigInputs(paths={Path("/etc/os-release"), Path("/usr/lib/os-release")})
+    recorder = LogRecorder()
+    token = CONFIG_INPUTS.set(inputs)
+    logging.getLogger().addHandler(recorder)
+
+    try:
+        args, images = parse_config(argv)
+    finally:
+        logging.getLogger().removeHandler(recorder)
+        CONFIG_INPUTS.reset(token)
+
+    if not inputs.cacheable:
+        return args, images
+
+    j = {
+        "Version": __version__,
+        "Inputs": {p: config_input_fingerprint(p) for p in inputs.paths},
+        "Environ": {k: os.getenv(k) for k in sorted(inputs.environ)},
+        "Log": recorder.records,
+        "Args": args,
+        "Images": images,
+    }
+
+    try:
+        cachedir.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        # The configuration might contain secrets such as the root password so make sure only we can read it.
+        with tempfile.NamedTemporaryFile("wb", dir=cachedir, prefix=".", delete=False) as f:
+            try:
+                os.fchmod(f.fileno(), 0o600)
+                pickle.dump(j, f)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+
+        os.replace(f.name, cache)
+
+        entries = sorted(cachedir.glob("*.pickle"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for p in entries[max_entries:]:
+            p.unlink(missing_ok=True)
+    except (OSError, pickle.PickleError) as e:
+        logging.debug(f"Failed to write configuration cache {cache}: {e}")
+
+    return args, images
+
+
 def load_credentials(args: argparse.Namespace) -> dict[str, str]:
     creds = {
         "agetty.autologin": "root",
@@ -2690,11 +3043,15 @@ def load_credentials(args: argparse.Namespace) -> dict[str, str]:
     }
 
     d = Path("mkosi.credentials")
+    if args.directory is not None:
+        record_config_input(d)
     if args.directory is not None and d.is_dir():
         for e in d.iterdir():
             if os.access(e, os.X_OK):
+                uncacheable_config()
                 creds[e.name] = run([e], stdout=subprocess.PIPE, env=os.environ).stdout
             else:
+                record_config_input(e)
                 creds[e.name] = e.read_text()
 
     for s in args.credentials:
@@ -2702,6 +3059,8 @@ def load_credentials(args: argparse.Namespace) -> dict[str, str]:
         creds[key] = value
 
     if "firstboot.timezone" not in creds and shutil.which("timedatectl"):
+        # The timezone is configured by pointing /etc/localtime at the corresponding zoneinfo file.
+        record_config_input(Path("/etc/localtime"))
         tz = run(
             ["timedatectl", "show", "-p", "Timezone", "--value"],
             stdout=subprocess.PIPE,
@@ -2713,19 +3072,19 @@ def load_credentials(args: argparse.Namespace) -> dict[str, str]:
     if "firstboot.locale" not in creds:
         creds["firstboot.locale"] = "C.UTF-8"
 
-    if (
-        args.ssh and
-        "ssh.authorized_keys.root" not in creds and
-        "SSH_AUTH_SOCK" in os.environ and shutil.which("ssh-add")
-    ):
-        key = run(
-            ["ssh-add", "-L"],
-            stdout=subprocess.PIPE,
-            env=os.environ,
-            check=False,
-        ).stdout.strip()
-        if key:
-            creds["ssh.authorized_keys.root"] = key
+    if args.ssh and "ssh.authorized_keys.root" not in creds:
+        record_config_environ("SSH_AUTH_SOCK")
+
+        if "SSH_AUTH_SOCK" in os.environ and shutil.which("ssh-add"):
+            uncacheable_config()
+            key = run(
+                ["ssh-add", "-L"],
+                stdout=subprocess.PIPE,
+                env=os.environ,
+                check=False,
+            ).stdout.strip()
+            if key:
+                creds["ssh.authorized_keys.root"] = key
 
     return creds
 
@@ -2785,6 +3144,9 @@ def load_environment(args: argparse.Namespace) -> dict[str, str]:
         env["IMAGE_VERSION"] = args.image_version
     if args.source_date_epoch is not None:
         env["SOURCE_DATE_EPOCH"] = str(args.source_date_epoch)
+    for key in ("http_proxy", "https_proxy", "MKOSI_DNF"):
+        record_config_environ(key)
+
     if proxy := os.getenv("http_proxy"):
         env["http_proxy"] = proxy
     if proxy := os.getenv("https_proxy"):
@@ -2794,6 +3156,8 @@ def load_environment(args: argparse.Namespace) -> dict[str, str]:
 
     for s in args.environment:
         key, sep, value = s.partition("=")
+        if not sep:
+            record_config_environ(key)
         value = value if sep else os.getenv(key, "")
         env[key] = value
 
@@ -2946,6 +3310,7 @@ def summary(config: MkosiConfig) -> str:
            Repo Signature/Key check: {yes_no(config.repository_key_check)}
                        Repositories: {line_join_list(config.repositories)}
              Use Only Package Cache: {yes_no(config.cache_only)}
+        Repository Metadata Max Age: {none_to_default(config.repository_metadata_max_age)}
               Package Manager Trees: {line_join_tree_list(config.package_manager_trees)}
 
     {bold("OUTPUT")}:
@@ -2956,6 +3321,7 @@ def summary(config: MkosiConfig) -> str:
                    Output Directory: {config.output_dir_or_cwd()}
                 Workspace Directory: {config.workspace_dir_or_default()}
                     Cache Directory: {none_to_none(config.cache_dir)}
+             Package Pool Directory: {none_to_none(config.package_pool_dir_or_default())}
                     Build Directory: {none_to_none(config.build_dir)}
                            Image ID: {config.image_id}
                       Image Version: {config.image_version}
@@ -3043,6 +3409,9 @@ def summary(config: MkosiConfig) -> str:
 
     {bold("HOST CONFIGURATION")}:
                    Incremental: {yes_no(config.incremental)}
+        Incremental Cache Size: {format_bytes_or_none(config.incremental_cache_size)}
+           Incremental Overlay: {yes_no(config.incremental_overlay)}
+             Package Pool Size: {format_bytes_or_none(config.package_pool_size)}
                NSpawn Settings: {none_to_none(config.nspawn_settings)}
             Extra Search Paths: {line_join_list(config.extra_search_paths)}
                      Ephemeral: {config.ephemeral}
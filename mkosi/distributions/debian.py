@@ -1,17 +1,21 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import os
 import shutil
+import subprocess
 import tempfile
 from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from mkosi.architecture import Architecture
 from mkosi.archive import extract_tar
 from mkosi.distributions import Distribution, DistributionInstaller, PackageType
-from mkosi.installer.apt import invoke_apt, setup_apt
+from mkosi.installer.apt import invoke_apt, setup_apt, update_apt_metadata
 from mkosi.log import die
-from mkosi.run import run
+from mkosi.run import log_process_failure, spawn
 from mkosi.state import MkosiState
+from mkosi.types import PathString
 from mkosi.util import umask
 
 
@@ -163,13 +167,13 @@ class Installer(DistributionInstaller):
 
             essential = f.read().strip().splitlines()
 
-        # Now, extract the debs to the chroot by first extracting the sources tar file out of the deb and
-        # then extracting the tar file into the chroot.
+        # Now, extract the debs to the chroot by streaming the data tar file out of each deb straight into
+        # tar. The debs are extracted in parallel. If multiple essential debs ship the same file, it doesn't
+        # matter which one ends up in the chroot as the packages are properly installed with apt afterwards.
 
-        for deb in essential:
-            with tempfile.NamedTemporaryFile() as f:
-                run(["dpkg-deb", "--fsys-tarfile", deb], stdout=f)
-                extract_tar(Path(f.name), state.root, log=False)
+        with ThreadPoolExecutor() as pool:
+            for f in [pool.submit(extract_deb, Path(deb), state.root) for deb in essential]:
+                f.result()
 
         # Finally, run apt to properly install packages in the chroot without having to worry that maintainer
         # scripts won't find basic tools that they depend on.
@@ -187,7 +191,7 @@ class Installer(DistributionInstaller):
         with umask(~0o644):
             policyrcd.write_text("#!/bin/sh\nexit 101\n")
 
-        invoke_apt(state, "apt-get", "update", apivfs=False)
+        update_apt_metadata(state)
         invoke_apt(state, "apt-get", "install", packages, apivfs=apivfs)
         install_apt_sources(state, cls.repositories(state, local=False))
 
@@ -230,6 +234,22 @@ class Installer(DistributionInstaller):
         return a
 
 
+def extract_deb(deb: Path, root: Path) -> None:
+    cmdline: list[PathString] = ["dpkg-deb", "--fsys-tarfile", deb]
+    r, w = os.pipe()
+
+    with spawn(cmdline, stdout=w) as dpkg:
+        os.close(w)
+        try:
+            extract_tar(Path("-"), root, log=False, stdin=r)
+        finally:
+            os.close(r)
+
+    if dpkg.returncode != 0:
+        log_process_failure([os.fspath(s) for s in cmdline], dpkg.returncode)
+        raise subprocess.CalledProcessError(dpkg.returncode, cmdline)
+
+
 def install_apt_sources(state: MkosiState, repos: Sequence[str]) -> None:
     if not (state.root / "usr/bin/apt").exists():
         return
@@ -20,46 +20,47 @@ from mkosi.run import apivfs_cmd, bwrap, chroot_cmd, run
 from mkosi.state import MkosiState
 from mkosi.tree import copy_tree, rmtree
 from mkosi.types import PathString
-from mkosi.util import sort_packages
+from mkosi.util import flock, sort_packages
 
 
 def invoke_emerge(state: MkosiState, packages: Sequence[str] = (), apivfs: bool = True) -> None:
-    bwrap(
-        cmd=apivfs_cmd(state.root) + [
-            # We can't mount the stage 3 /usr using `options`, because bwrap isn't available in the stage 3
-            # tarball which is required by apivfs_cmd(), so we have to mount /usr from the tarball later
-            # using another bwrap exec.
-            "bwrap",
-            "--dev-bind", "/", "/",
-            "--bind", state.cache_dir / "stage3/usr", "/usr",
-            "emerge",
-            "--buildpkg=y",
-            "--usepkg=y",
-            "--getbinpkg=y",
-            "--binpkg-respect-use=y",
-            "--jobs",
-            "--load-average",
-            "--root-deps=rdeps",
-            "--with-bdeps=n",
-            "--verbose-conflicts",
-            "--noreplace",
-            *(["--verbose", "--quiet=n", "--quiet-fail=n"] if ARG_DEBUG.get() else ["--quiet-build", "--quiet"]),
-            f"--root={state.root}",
-            *sort_packages(packages),
-        ],
-        network=True,
-        options=[
-            # TODO: Get rid of as many of these as possible.
-            "--bind", state.cache_dir / "stage3/etc", "/etc",
-            "--bind", state.cache_dir / "stage3/var", "/var",
-            "--ro-bind", "/etc/resolv.conf", "/etc/resolv.conf",
-            "--bind", state.cache_dir / "repos", "/var/db/repos",
-        ],
-        env=dict(
-            PKGDIR=str(state.cache_dir / "binpkgs"),
-            DISTDIR=str(state.cache_dir / "distfiles"),
-        ) | ({"USE": "build"} if not apivfs else {}) | state.config.environment,
-    )
+    with flock(state.cache_dir):
+        bwrap(
+            cmd=apivfs_cmd(state.root) + [
+                # We can't mount the stage 3 /usr using `options`, because bwrap isn't available in the stage 3
+                # tarball which is required by apivfs_cmd(), so we have to mount /usr from the tarball later
+                # using another bwrap exec.
+                "bwrap",
+                "--dev-bind", "/", "/",
+                "--bind", state.cache_dir / "stage3/usr", "/usr",
+                "emerge",
+                "--buildpkg=y",
+                "--usepkg=y",
+                "--getbinpkg=y",
+                "--binpkg-respect-use=y",
+                "--jobs",
+                "--load-average",
+                "--root-deps=rdeps",
+                "--with-bdeps=n",
+                "--verbose-conflicts",
+                "--noreplace",
+                *(["--verbose", "--quiet=n", "--quiet-fail=n"] if ARG_DEBUG.get() else ["--quiet-build", "--quiet"]),
+                f"--root={state.root}",
+                *sort_packages(packages),
+            ],
+            network=True,
+            options=[
+                # TODO: Get rid of as many of these as possible.
+                "--bind", state.cache_dir / "stage3/etc", "/etc",
+                "--bind", state.cache_dir / "stage3/var", "/var",
+                "--ro-bind", "/etc/resolv.conf", "/etc/resolv.conf",
+                "--bind", state.cache_dir / "repos", "/var/db/repos",
+            ],
+            env=dict(
+                PKGDIR=str(state.cache_dir / "binpkgs"),
+                DISTDIR=str(state.cache_dir / "distfiles"),
+            ) | ({"USE": "build"} if not apivfs else {}) | state.config.environment,
+        )
 
 
 class Installer(DistributionInstaller):
@@ -39,13 +39,17 @@ def clean_package_manager_metadata(state: MkosiState) -> None:
 
 
 def package_manager_scripts(state: MkosiState) -> dict[str, list[PathString]]:
+    # Scripts use the same package cache directory as mkosi itself, so take the same lock that mkosi takes when it
+    # invokes the package manager.
+    lock: list[PathString] = ["flock", "--exclusive", "--no-fork", state.cache_dir]
+
     return {
-        "pacman": apivfs_cmd(state.root) + pacman_cmd(state),
-        "zypper": apivfs_cmd(state.root) + zypper_cmd(state),
-        "dnf"   : apivfs_cmd(state.root) + dnf_cmd(state),
+        "pacman": lock + apivfs_cmd(state.root) + pacman_cmd(state),
+        "zypper": lock + apivfs_cmd(state.root) + zypper_cmd(state),
+        "dnf"   : lock + apivfs_cmd(state.root) + dnf_cmd(state),
         "rpm"   : apivfs_cmd(state.root) + rpm_cmd(state),
     } | {
-        command: apivfs_cmd(state.root) + apt_cmd(state, command) for command in (
+        command: lock + apivfs_cmd(state.root) + apt_cmd(state, command) for command in (
             "apt",
             "apt-cache",
             "apt-cdrom",
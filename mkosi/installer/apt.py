@@ -1,12 +1,21 @@
 # SPDX-License-Identifier: LGPL-2.1+
+import hashlib
 import shutil
 import textwrap
+import time
 from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
 
 from mkosi.run import apivfs_cmd, bwrap
 from mkosi.state import MkosiState
 from mkosi.types import PathString
-from mkosi.util import sort_packages, umask
+from mkosi.util import flock, sort_packages, umask
+
+# Repository metadata that was downloaded after this point in time is never downloaded again by this invocation of
+# mkosi, so that the image, the default initrd and the tools tree all share the same metadata. This module is
+# loaded before any image is built.
+SESSION_START = time.time()
 
 
 def setup_apt(state: MkosiState, repos: Sequence[str]) -> None:
@@ -56,6 +65,53 @@ def setup_apt(state: MkosiState, repos: Sequence[str]) -> None:
                 f.write(f"{repo}\n")
 
 
+def apt_lists_dir(state: MkosiState) -> Path:
+    """
+    Return the directory in the cache directory that apt stores the repository metadata in. The directory is keyed
+    on the configured repositories and the architecture so that all images using the same repositories share the
+    same metadata.
+    """
+    h = hashlib.sha256(state.config.distribution.architecture(state.config.architecture).encode())
+
+    sources = state.pkgmngr / "etc/apt/sources.list"
+    sourcesd = state.pkgmngr / "etc/apt/sources.list.d"
+    for p in sorted([sources, *(sourcesd.iterdir() if sourcesd.exists() else [])]):
+        if p.is_file():
+            h.update(p.name.encode() + b"\0" + p.read_bytes() + b"\0")
+
+    return state.cache_dir / "apt/lists" / h.hexdigest()[:16]
+
+
+def metadata_is_fresh(stamp: Path, max_age: Optional[int]) -> bool:
+    try:
+        mtime = stamp.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+    return mtime >= SESSION_START or (max_age is not None and time.time() - mtime < max_age)
+
+
+def update_apt_metadata(state: MkosiState) -> None:
+    """
+    Download the repository metadata with apt-get update unless it was already downloaded by this invocation of
+    mkosi or is younger than RepositoryMetadataMaxAge=.
+    """
+    lists = apt_lists_dir(state)
+    stamp = lists.with_name(f"{lists.name}.stamp")
+
+    with umask(~0o755):
+        (lists / "partial").mkdir(parents=True, exist_ok=True)
+
+    # apt is invoked with locking disabled so make sure that multiple images built in parallel don't update the
+    # same metadata at the same time.
+    with flock(lists):
+        if metadata_is_fresh(stamp, state.config.repository_metadata_max_age):
+            return
+
+        invoke_apt(state, "apt-get", "update", apivfs=False)
+        stamp.touch()
+
+
 def apt_cmd(state: MkosiState, command: str) -> list[PathString]:
     debarch = state.config.distribution.architecture(state.config.architecture)
 
@@ -83,6 +139,7 @@ def apt_cmd(state: MkosiState, command: str) -> list[PathString]:
         "-o", "APT::Sandbox::User=root",
         "-o", f"Dir::Cache={state.cache_dir / 'apt'}",
         "-o", f"Dir::State={state.pkgmngr / 'var/lib/apt'}",
+        "-o", f"Dir::State::lists={apt_lists_dir(state)}",
         "-o", f"Dir::State::status={state.root / 'var/lib/dpkg/status'}",
         "-o", f"Dir::Etc::trusted={trustedkeys}",
         "-o", f"Dir::Etc::trustedparts={trustedkeys_dir}",
@@ -119,5 +176,9 @@ def invoke_apt(
     apivfs: bool = True,
 ) -> None:
     cmd = apivfs_cmd(state.root) if apivfs else []
-    bwrap(cmd + apt_cmd(state, command) + [operation, *sort_packages(packages)],
-          network=True, env=state.config.environment)
+
+    # Images that are built in parallel might share the same package cache directory, which package managers don't
+    # expect, so only let one of them use it at a time.
+    with flock(state.cache_dir):
+        bwrap(cmd + apt_cmd(state, command) + [operation, *sort_packages(packages)],
+              network=True, env=state.config.environment)
@@ -11,7 +11,7 @@ from mkosi.run import apivfs_cmd, bwrap, run
 from mkosi.state import MkosiState
 from mkosi.tree import copy_tree, rmtree
 from mkosi.types import PathString
-from mkosi.util import sort_packages
+from mkosi.util import flock, sort_packages
 
 
 class Repo(NamedTuple):
@@ -130,6 +130,9 @@ def dnf_cmd(state: MkosiState) -> list[PathString]:
     if not state.config.repository_key_check:
         cmdline += ["--nogpgcheck"]
 
+    if state.config.repository_metadata_max_age is not None:
+        cmdline += [f"--setopt=metadata_expire={state.config.repository_metadata_max_age}"]
+
     if state.config.repositories:
         opt = "--enable-repo" if dnf.endswith("dnf5") else "--enablerepo"
         cmdline += [f"{opt}={repo}" for repo in state.config.repositories]
@@ -149,8 +152,10 @@ def dnf_cmd(state: MkosiState) -> list[PathString]:
 
 def invoke_dnf(state: MkosiState, command: str, packages: Iterable[str], apivfs: bool = True) -> None:
     cmd = apivfs_cmd(state.root) if apivfs else []
-    bwrap(cmd + dnf_cmd(state) + [command, *sort_packages(packages)],
-          network=True, env=state.config.environment)
+
+    with flock(state.cache_dir):
+        bwrap(cmd + dnf_cmd(state) + [command, *sort_packages(packages)],
+              network=True, env=state.config.environment)
 
     fixup_rpmdb_location(state.root)
 
@@ -7,7 +7,7 @@ from mkosi.architecture import Architecture
 from mkosi.run import apivfs_cmd, bwrap
 from mkosi.state import MkosiState
 from mkosi.types import PathString
-from mkosi.util import sort_packages, umask
+from mkosi.util import flock, sort_packages, umask
 
 
 def setup_pacman(state: MkosiState) -> None:
@@ -111,5 +111,7 @@ def invoke_pacman(
     apivfs: bool = True,
 ) -> None:
     cmd = apivfs_cmd(state.root) if apivfs else []
-    bwrap(cmd + pacman_cmd(state) + [operation, *options, *sort_packages(packages)],
-          network=True, env=state.config.environment)
+
+    with flock(state.cache_dir):
+        bwrap(cmd + pacman_cmd(state) + [operation, *options, *sort_packages(packages)],
+              network=True, env=state.config.environment)
@@ -7,7 +7,7 @@ from mkosi.installer.dnf import Repo, fixup_rpmdb_location
 from mkosi.run import apivfs_cmd, bwrap
 from mkosi.state import MkosiState
 from mkosi.types import PathString
-from mkosi.util import sort_packages
+from mkosi.util import flock, sort_packages
 
 
 def setup_zypper(state: MkosiState, repos: Sequence[Repo]) -> None:
@@ -70,7 +70,9 @@ def invoke_zypper(
     apivfs: bool = True,
 ) -> None:
     cmd = apivfs_cmd(state.root) if apivfs else []
-    bwrap(cmd + zypper_cmd(state) + [verb, *options, *sort_packages(packages)],
-          network=True, env=state.config.environment)
+
+    with flock(state.cache_dir):
+        bwrap(cmd + zypper_cmd(state) + [verb, *options, *sort_packages(packages)],
+              network=True, env=state.config.environment)
 
     fixup_rpmdb_location(state.root)
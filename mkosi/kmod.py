@@ -1,29 +1,106 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import bisect
+import concurrent.futures
+import contextlib
+import dataclasses
+import fnmatch
+import glob
+import gzip
+import hashlib
+import json
 import logging
+import lzma
 import os
 import re
+import struct
 import subprocess
-from collections.abc import Iterator, Sequence
+import tempfile
+from collections.abc import Iterable, Iterator, Mapping, Sequence
 from pathlib import Path
+from typing import Optional
 
 from mkosi.log import complete_step, log_step
-from mkosi.run import bwrap, chroot_cmd
+from mkosi.run import log_process_failure, spawn
+from mkosi.types import PathString
 
 
 def loaded_modules() -> list[str]:
     return [l.split()[0] for l in Path("/proc/modules").read_text().splitlines()]
 
 
+@dataclasses.dataclass(frozen=True)
+class TreeIndex:
+    directories: list[Path]
+    files: list[Path]
+    # Maps the paths found below symlinks to directories to the paths that they actually refer to.
+    aliases: dict[Path, Path] = dataclasses.field(default_factory=dict)
+
+    def modules(self) -> list[Path]:
+        return [p for p in self.files if ".ko" in p.name and p not in self.aliases]
+
+
+def index_tree(path: Path) -> TreeIndex:
+    """
+    Walks the given directory tree once using os.scandir() and returns all directories and all other files in it.
+    Symlinks to directories are listed as directories and are descended into if they point to a directory inside
+    the tree. Every directory is only descended into once via a symlink so that symlink loops are not followed
+    forever.
+    """
+    root = Path(os.path.realpath(path))
+    directories = []
+    files = []
+    aliases = {}
+    visited = set()
+    todo = [(path, path, False)]
+
+    with contextlib.suppress(FileNotFoundError):
+        st = root.stat()
+        visited.add((st.st_dev, st.st_ino))
+
+    while todo:
+        parent, real, aliased = todo.pop()
+
+        try:
+            it = os.scandir(parent)
+        except FileNotFoundError:
+            continue
+
+        with it:
+            for entry in it:
+                p = Path(entry.path)
+                if aliased:
+                    aliases[p] = real / entry.name
+
+                if not entry.is_dir():
+                    files += [p]
+                    continue
+
+                directories += [p]
+
+                if not entry.is_symlink():
+                    todo += [(p, real / entry.name, aliased)]
+                    continue
+
+                target = Path(os.path.realpath(p))
+                st = entry.stat()
+                if target.is_relative_to(root) and (st.st_dev, st.st_ino) not in visited:
+                    visited.add((st.st_dev, st.st_ino))
+                    todo += [(p, path / target.relative_to(root), True)]
+
+    return TreeIndex(sorted(directories), sorted(files), aliases)
+
+
 def filter_kernel_modules(
     root: Path,
     kver: str,
     include: Sequence[str],
     exclude: Sequence[str],
     host: bool,
+    index: Optional[TreeIndex] = None,
 ) -> list[Path]:
     modulesd = root / "usr/lib/modules" / kver
-    modules = {m for m in modulesd.rglob("*.ko*")}
+    modules = set((index or index_tree(modulesd)).modules())
 
     if host:
         include = [*include, *loaded_modules()]
@@ -55,65 +132,247 @@ def module_path_to_name(path: Path) -> str:
     return path.name.partition(".")[0]
 
 
-def resolve_module_dependencies(root: Path, kver: str, modules: Sequence[str]) -> tuple[set[Path], set[Path]]:
+def normalize_module_name(name: str) -> str:
+    # The kernel treats dashes and underscores in module names as equivalent.
+    return name.replace("-", "_")
+
+
+def elf_section(data: bytes, name: str) -> Optional[bytes]:
+    """Returns the contents of the ELF section with the given name or None if there is no such section."""
+    if data[:4] != b"\x7fELF":
+        return None
+
+    endian = "<" if data[5] == 1 else ">"
+
+    if data[4] == 2:
+        shoff, = struct.unpack_from(f"{endian}Q", data, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(f"{endian}HHH", data, 0x3A)
+        shdr = f"{endian}I20xQQ"
+    else:
+        shoff, = struct.unpack_from(f"{endian}I", data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(f"{endian}HHH", data, 0x2E)
+        shdr = f"{endian}I12xII"
+
+    sections = [struct.unpack_from(shdr, data, shoff + i * shentsize) for i in range(shnum)]
+    if shstrndx >= len(sections):
+        return None
+
+    _, stroff, _ = sections[shstrndx]
+
+    for nameoff, offset, size in sections:
+        end = data.index(b"\0", stroff + nameoff)
+        if data[stroff + nameoff:end] == name.encode():
+            return data[offset:offset + size]
+
+    return None
+
+
+def modinfo(path: Path) -> list[tuple[str, str]]:
+    """Returns the key/value pairs stored in the .modinfo section of the given (possibly compressed) kernel module."""
+    if path.suffix == ".xz":
+        data = lzma.decompress(path.read_bytes())
+    elif path.suffix == ".gz":
+        data = gzip.decompress(path.read_bytes())
+    elif path.suffix == ".zst":
+        data = decompress_zstd(path)
+    else:
+        data = path.read_bytes()
+
+    section = elf_section(data, ".modinfo")
+    if section is None:
+        logging.debug(f"No .modinfo section found in {path}")
+        return []
+
+    info = []
+    for entry in section.split(b"\0"):
+        key, sep, value = entry.decode(errors="replace").partition("=")
+        if sep:
+            info += [(key, value)]
+
+    return info
+
+
+def decompress_zstd(path: Path) -> bytes:
+    """
+    Python's standard library cannot decompress zstd, so stream the given file through zstd and return the
+    decompressed contents.
+    """
+    cmdline: list[PathString] = ["zstd", "--decompress", "--stdout", "--quiet", path]
+    r, w = os.pipe()
+
+    with spawn(cmdline, stdout=w) as zstd:
+        os.close(w)
+        with open(r, "rb") as f:
+            data = f.read()
+
+    if zstd.returncode != 0:
+        log_process_failure([os.fspath(s) for s in cmdline], zstd.returncode)
+        raise subprocess.CalledProcessError(zstd.returncode, cmdline)
+
+    return data
+
+
+def module_index(nametofile: Mapping[str, Path]) -> dict[str, tuple[list[str], list[str]]]:
+    """
+    Returns a mapping from the name of each of the given modules to its module dependencies and the firmware
+    files (or firmware file prefixes) it references.
+    """
+    log_step("Reading kernel module information to fetch kernel module dependencies")
+
+    # Decompressing the modules is done by zlib, liblzma or zstd, which release the GIL or run in a separate
+    # process, so reading the modules concurrently speeds things up considerably.
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        infos = dict(zip(nametofile.keys(), pool.map(modinfo, nametofile.values())))
+
+    index = {}
+
+    for name, info in infos.items():
+        depends = []
+        firmware = []
+
+        for key, value in info:
+            if key == "depends":
+                depends += [normalize_module_name(d) for d in value.strip().split(",") if d]
+            elif key == "softdep":
+                # softdep entries look like "pre: mod1 mod2 post: mod3".
+                depends += [normalize_module_name(d) for d in value.split() if d not in ("pre:", "post:")]
+            elif key == "firmware":
+                firmware += [value.strip()]
+
+        index[name] = (depends, firmware)
+
+    return index
+
+
+def module_index_key(root: Path, kver: str, modules: Iterable[Path]) -> str:
+    h = hashlib.sha256(kver.encode())
+
+    for m in sorted(modules):
+        st = m.stat()
+        h.update(f"{m.relative_to(root)}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+
+    return h.hexdigest()
+
+
+def load_module_index(
+    root: Path,
+    kver: str,
+    nametofile: Mapping[str, Path],
+    cache: Optional[Path],
+) -> dict[str, tuple[list[str], list[str]]]:
+    """
+    Like module_index(), but if a cache directory is given, the index is stored in <cache>/kmod/<kver>.json and
+    reused as long as the path, size and modification time of every module of the kernel are unchanged.
+    """
+    if cache is None:
+        return module_index(nametofile)
+
+    path = cache / "kmod" / f"{kver}.json"
+    key = module_index_key(root, kver, nametofile.values())
+
+    try:
+        cached = json.loads(path.read_text())
+        if cached["key"] == key:
+            log_step(f"Using cached kernel module information from {path}")
+            return {name: (m["depends"], m["firmware"]) for name, m in cached["modules"].items()}
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        pass
+
+    index = module_index(nametofile)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary file and rename it into place so that concurrent builds never read a partially written
+    # index.
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, prefix=f".{kver}", delete=False) as f:
+        json.dump(
+            {
+                "key": key,
+                "modules": {
+                    name: {"depends": depends, "firmware": firmware}
+                    for name, (depends, firmware) in sorted(index.items())
+                },
+            },
+            f,
+            indent=4,
+        )
+
+    os.rename(f.name, path)
+
+    return index
+
+
+def lookup_firmware(names: Sequence[str], prefix: str) -> list[str]:
+    """
+    Returns the entries of the sorted list of firmware paths that match the glob "<prefix>*", using a binary search
+    instead of scanning the firmware directory.
+    """
+    if glob.has_magic(prefix):
+        return [n for n in names if n.count("/") == prefix.count("/") and fnmatch.fnmatchcase(n, f"{prefix}*")]
+
+    matches = []
+
+    for i in range(bisect.bisect_left(names, prefix), len(names)):
+        if not names[i].startswith(prefix):
+            break
+
+        # Like with glob, the wildcard doesn't match across directories.
+        if "/" not in names[i][len(prefix):]:
+            matches += [names[i]]
+
+    return matches
+
+
+def resolve_module_dependencies(
+    root: Path,
+    kver: str,
+    modules: Sequence[str],
+    cache: Optional[Path] = None,
+    index: Optional[TreeIndex] = None,
+    firmware_index: Optional[TreeIndex] = None,
+) -> tuple[set[Path], set[Path]]:
     """
     Returns a tuple of lists containing the paths to the module and firmware dependencies of the given list
     of module names (including the given module paths themselves). The paths are returned relative to the
     root directory.
     """
     modulesd = Path("usr/lib/modules") / kver
-    builtin = set(module_path_to_name(Path(m)) for m in (root / modulesd / "modules.builtin").read_text().splitlines())
-    allmodules = set((root / modulesd / "kernel").glob("**/*.ko*"))
-    nametofile = {module_path_to_name(m): m for m in allmodules}
-
-    log_step("Running modinfo to fetch kernel module dependencies")
-
-    # We could run modinfo once for each module but that's slow. Luckily we can pass multiple modules to
-    # modinfo and it'll process them all in a single go. We get the modinfo for all modules to build two maps
-    # that map the path of the module to its module dependencies and its firmware dependencies respectively.
-    # Because there's more kernel modules than the max number of accepted CLI arguments for bwrap, we split the modules
-    # list up into chunks.
-    info = ""
-    for i in range(0, len(nametofile.keys()), 8500):
-        chunk = list(nametofile.keys())[i:i+8500]
-        info += bwrap(chroot_cmd(root) + ["modinfo", "--set-version", kver, "--null", *chunk],
-                      stdout=subprocess.PIPE).stdout.strip()
+    builtin = set(
+        normalize_module_name(module_path_to_name(Path(m)))
+        for m in (root / modulesd / "modules.builtin").read_text().splitlines()
+    )
+    allmodules = set(
+        m for m in (index or index_tree(root / modulesd)).modules() if m.is_relative_to(root / modulesd / "kernel")
+    )
+    nametofile = {normalize_module_name(module_path_to_name(m)): m for m in allmodules}
+
+    index = load_module_index(root, kver, nametofile, cache)
 
     log_step("Calculating required kernel modules and firmware")
 
-    moddep = {}
-    firmwaredep = {}
+    firmwared = root / "usr/lib/firmware"
+    firmware_index = firmware_index or index_tree(firmwared)
+    firmware_names = sorted(
+        os.fspath(p.relative_to(firmwared)) for p in firmware_index.directories + firmware_index.files
+    )
 
-    depends = []
-    firmware = []
-    for line in info.split("\0"):
-        key, sep, value = line.partition(":")
-        if not sep:
-            key, sep, value = line.partition("=")
+    moddep: dict[str, list[str]] = {}
+    firmwaredep: dict[str, list[Path]] = {}
 
-        if key in ("depends", "softdep"):
-            depends += [d for d in value.strip().split(",") if d]
+    for name, (depends, references) in index.items():
+        firmware = []
 
-        elif key == "firmware":
-            fw = [f for f in (root / "usr/lib/firmware").glob(f"{value.strip()}*")]
+        for value in references:
+            fw = [firmwared / f for f in lookup_firmware(firmware_names, value)]
             if not fw:
                 logging.debug(f"Not including missing firmware /usr/lib/firmware/{value} in the initrd")
 
             firmware += fw
 
-        elif key == "name":
-            # The file names use dashes, but the module names use underscores. We track the names
-            # in terms of the file names, since the depends use dashes and therefore filenames as
-            # well.
-            name = value.strip().replace("_", "-")
-
-            moddep[name] = depends
-            firmwaredep[name] = firmware
-
-            depends = []
-            firmware = []
+        moddep[name] = depends
+        firmwaredep[name] = firmware
 
-    todo = [*builtin, *modules]
+    todo = [*builtin, *(normalize_module_name(m) for m in modules)]
     mods = set()
     firmware = set()
 
@@ -140,37 +399,40 @@ def gen_required_kernel_modules(
     include: Sequence[str],
     exclude: Sequence[str],
     host: bool,
+    cache: Optional[Path] = None,
+    modules_index: Optional[TreeIndex] = None,
+    firmware_index: Optional[TreeIndex] = None,
 ) -> Iterator[Path]:
     modulesd = root / "usr/lib/modules" / kver
-    modules = filter_kernel_modules(root, kver, include, exclude, host)
+    modules_index = modules_index or index_tree(modulesd)
+    firmware_index = firmware_index or index_tree(root / "usr/lib/firmware")
+    modules = filter_kernel_modules(root, kver, include, exclude, host, modules_index)
 
     names = [module_path_to_name(m) for m in modules]
-    mods, firmware = resolve_module_dependencies(root, kver, names)
+    mods, firmware = resolve_module_dependencies(root, kver, names, cache, modules_index, firmware_index)
 
     def files() -> Iterator[Path]:
         yield modulesd.parent
         yield modulesd
         yield modulesd / "kernel"
 
-        for d in (modulesd, root / "usr/lib/firmware"):
-            for p in (root / d).rglob("*"):
-                if p.is_dir():
-                    yield p
+        # Paths below symlinks to directories are included via the directories they point to instead.
+        yield from (p for p in modules_index.directories if p not in modules_index.aliases)
+        yield from (p for p in firmware_index.directories if p not in firmware_index.aliases)
 
-        for p in sorted(mods) + sorted(firmware):
+        for p in sorted(mods) + sorted(set(firmware_index.aliases.get(p, p) for p in firmware)):
             yield p
 
-        for p in (root / modulesd).iterdir():
-            if not p.name.startswith("modules"):
-                continue
-
-            yield p
+        for p in modules_index.files + modules_index.directories:
+            if p.parent == modulesd and p.name.startswith("modules"):
+                yield p
 
-        if (root / modulesd / "vdso").exists():
+        if (modulesd / "vdso").exists():
             yield modulesd / "vdso"
 
-            for p in (root / modulesd / "vdso").iterdir():
-                yield p
+            for p in modules_index.files + modules_index.directories:
+                if p.parent == modulesd / "vdso":
+                    yield p
 
     return files()
 
@@ -181,23 +443,28 @@ def process_kernel_modules(
     include: Sequence[str],
     exclude: Sequence[str],
     host: bool,
+    cache: Optional[Path] = None,
 ) -> None:
     if not include and not exclude:
         return
 
     with complete_step("Applying kernel module filters"):
-        required = set(gen_required_kernel_modules(root, kver, include, exclude, host))
+        modules_index = index_tree(root / "usr/lib/modules" / kver)
+        firmware_index = index_tree(root / "usr/lib/firmware")
+        required = set(
+            gen_required_kernel_modules(root, kver, include, exclude, host, cache, modules_index, firmware_index)
+        )
 
-        for m in (root / "usr/lib/modules" / kver).rglob("*.ko*"):
+        for m in modules_index.modules():
             if m in required:
                 continue
 
             logging.debug(f"Removing module {m}")
-            (root / m).unlink()
+            m.unlink()
 
-        for fw in (m for m in (root / "usr/lib/firmware").rglob("*") if not m.is_dir()):
-            if fw in required:
+        for fw in firmware_index.files:
+            if fw in required or fw in firmware_index.aliases:
                 continue
 
             logging.debug(f"Removing firmware {fw}")
-            (root / fw).unlink()
+            fw.unlink()
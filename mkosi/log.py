@@ -2,9 +2,12 @@
 
 import contextlib
 import contextvars
+import dataclasses
 import logging
 import os
+import resource
 import sys
+import time
 from collections.abc import Iterator
 from typing import Any, NoReturn, Optional
 
@@ -14,6 +17,28 @@ ARG_DEBUG_SHELL = contextvars.ContextVar("debug-shell", default=False)
 LEVEL = 0
 
 
+@dataclasses.dataclass(frozen=True)
+class StepProfile:
+    text: str
+    level: int
+    # Seconds since the monotonic clock's reference point.
+    start: float
+    duration: float
+    # CPU time (user + system) in seconds used by mkosi itself and by its child processes during the step.
+    cpu: float
+    child_cpu: float
+    # Peak resident set size in bytes of mkosi or any of its child processes at the end of the step.
+    maxrss: int
+    # Bytes written to block devices during the step.
+    written: int
+
+
+STEP_PROFILE: contextvars.ContextVar[Optional[list[StepProfile]]] = contextvars.ContextVar(
+    "step-profile",
+    default=None,
+)
+
+
 class Style:
     bold = "\033[0;1;39m" if sys.stderr.isatty() else ""
     gray = "\033[0;38;5;245m" if sys.stderr.isatty() else ""
@@ -48,12 +73,40 @@ def log_notice(text: str) -> None:
     logging.info(f"{Style.bold}{text}{Style.reset}")
 
 
+def resource_usage() -> tuple[float, float, int, int]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return (
+        own.ru_utime + own.ru_stime,
+        children.ru_utime + children.ru_stime,
+        max(own.ru_maxrss, children.ru_maxrss) * 1024,
+        (own.ru_oublock + children.ru_oublock) * 512,
+    )
+
+
+@contextlib.contextmanager
+def record_steps() -> Iterator[list[StepProfile]]:
+    """Record the duration and resource usage of every step completed within the context."""
+    steps: list[StepProfile] = []
+    token = STEP_PROFILE.set(steps)
+    try:
+        yield steps
+    finally:
+        STEP_PROFILE.reset(token)
+
+
 @contextlib.contextmanager
 def complete_step(text: str, text2: Optional[str] = None) -> Iterator[list[Any]]:
     global LEVEL
 
     log_step(text)
 
+    if (steps := STEP_PROFILE.get()) is not None:
+        level = LEVEL
+        start = time.monotonic()
+        cpu, child_cpu, _, written = resource_usage()
+
     LEVEL += 1
     try:
         args: list[Any] = []
@@ -62,6 +115,22 @@ def complete_step(text: str, text2: Optional[str] = None) -> Iterator[list[Any]]
         LEVEL -= 1
         assert LEVEL >= 0
 
+        if steps is not None:
+            end = time.monotonic()
+            endcpu, endchild_cpu, maxrss, endwritten = resource_usage()
+            steps.append(
+                StepProfile(
+                    text=text,
+                    level=level,
+                    start=start,
+                    duration=end - start,
+                    cpu=endcpu - cpu,
+                    child_cpu=endchild_cpu - child_cpu,
+                    maxrss=maxrss,
+                    written=endwritten - written,
+                )
+            )
+
     if text2 is not None:
         log_step(text2.format(*args))
 
@@ -1,13 +1,22 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import contextlib
 import dataclasses
 import datetime
+import enum
+import gzip
 import json
 import logging
+import os
+import sqlite3
+import struct
 import subprocess
+import tempfile
 import textwrap
+from collections.abc import Callable, Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import IO, Any, Optional
+from typing import IO, Any, Optional, Union
 
 from mkosi.config import ManifestFormat, MkosiConfig
 from mkosi.distributions import Distribution, PackageType
@@ -61,6 +70,36 @@ class SourcePackageManifest:
         return t
 
 
+# Marks the start of the changelog of each package when querying the changelogs of multiple rpm packages at once.
+RPM_CHANGELOG_DELIMITER = "@@MKOSI-CHANGELOG@@"
+# Marks the end of the changelog of each package, so that any other output of rpm, e.g. about packages that are
+# not installed, is not mistaken for part of a changelog.
+RPM_CHANGELOG_END = "@@MKOSI-CHANGELOG-END@@"
+# The name, version, release and architecture of a package, which rpm accepts as a package to query as well. Unlike
+# %{NEVRA}, this doesn't depend on how the epoch is formatted.
+RPM_CHANGELOG_KEY = "%{NAME}-%{VERSION}-%{RELEASE}%|ARCH?{.%{ARCH}}|"
+# The query format used by rpm's --changelog alias.
+RPM_CHANGELOG_FORMAT = r"[* %{CHANGELOGTIME:day} %{CHANGELOGNAME}\n%{CHANGELOGTEXT}\n\n]"
+
+
+def read_deb_changelog(root: Path, package: str) -> Optional[str]:
+    doc = root / "usr/share/doc" / package
+
+    # The documentation directory is often a symlink to the one of another package built from the same source,
+    # which might point outside of the image when resolved from the host, so leave those to apt.
+    if doc.is_symlink():
+        return None
+
+    for name in ("changelog.Debian.gz", "changelog.gz"):
+        try:
+            with gzip.open(doc / name, "rt", encoding="utf-8", errors="replace") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+
+    return None
+
+
 def parse_pkg_desc(f: Path) -> tuple[str, str, str, str]:
     name = version = base = arch = ""
     with f.open() as desc:
@@ -78,6 +117,164 @@ def parse_pkg_desc(f: Path) -> tuple[str, str, str, str]:
     return name, version, base, arch
 
 
+# The fields of a package as queried from the package database, see record_rpm_packages() and
+# record_deb_packages().
+PackageRecord = tuple[str, str, str, str, str, str]
+
+
+def split_package_records(output: str) -> list[PackageRecord]:
+    records = []
+
+    for line in output.splitlines():
+        a, b, c, d, e, f = line.split("\t")
+        records += [(a, b, c, d, e, f)]
+
+    return records
+
+
+def parse_dpkg_status(admindir: Path) -> Optional[list[PackageRecord]]:
+    """
+    Parse the dpkg status database and return the same fields that record_deb_packages() queries with
+    dpkg-query for every package that dpkg-query would list. Returns None if the database cannot be parsed
+    reliably.
+    """
+    status = admindir / "status"
+    if not status.exists():
+        return None
+
+    # Changes that dpkg hasn't merged into the status file yet are kept in the updates directory. dpkg merges
+    # them when it exits so this only happens if it was interrupted, in which case leave it to dpkg-query.
+    if (admindir / "updates").exists() and any(p.name.isdigit() for p in (admindir / "updates").iterdir()):
+        return None
+
+    # db-fsys:Last-Modified is the modification time of the package's file list.
+    lists = {}
+    if (admindir / "info").is_dir():
+        with os.scandir(admindir / "info") as it:
+            for entry in it:
+                if entry.name.endswith(".list"):
+                    lists[entry.name] = str(int(entry.stat().st_mtime))
+
+    packages: list[PackageRecord] = []
+
+    for stanza in status.read_text(encoding="utf-8", errors="replace").split("\n\n"):
+        fields = {}
+        for line in stanza.splitlines():
+            # Skip continuation lines of multiline fields, we don't need any of those.
+            if not line or line[0] in " \t":
+                continue
+
+            key, _, value = line.partition(":")
+            fields[key] = value.strip()
+
+        # dpkg-query lists everything except packages that were purged.
+        if "Package" not in fields or fields.get("Status", "").endswith(" not-installed"):
+            continue
+
+        name = fields["Package"]
+        arch = fields.get("Architecture", "")
+        # The Source field might include the source version in parentheses if it differs from the binary version.
+        source = fields.get("Source", "").partition(" ")[0] or name
+
+        # The file list of Multi-Arch: same packages includes the architecture in its name.
+        installtime = lists.get(f"{name}:{arch}.list" if fields.get("Multi-Arch") == "same" else f"{name}.list", "")
+
+        packages += [(name, source, fields.get("Version", ""), arch, fields.get("Installed-Size", ""), installtime)]
+
+    return packages
+
+
+class RpmTag(enum.IntEnum):
+    NAME        = 1000
+    VERSION     = 1001
+    RELEASE     = 1002
+    EPOCH       = 1003
+    INSTALLTIME = 1008
+    SIZE        = 1009
+    ARCH        = 1022
+    SOURCERPM   = 1044
+    LONGSIZE    = 5009
+
+
+def parse_rpm_header(blob: bytes) -> dict[RpmTag, Union[str, int]]:
+    """
+    Parse the tags we're interested in from an rpm header as stored in the rpm database, which is the header
+    without its magic: the number of index entries and the size of the data store followed by the index entries
+    and the data store itself.
+    """
+    count, _ = struct.unpack_from(">II", blob)
+    store = 8 + count * 16
+    tags: dict[RpmTag, Union[str, int]] = {}
+
+    for i in range(count):
+        tagno, type, offset, _ = struct.unpack_from(">IIiI", blob, 8 + i * 16)
+        try:
+            tag = RpmTag(tagno)
+        except ValueError:
+            continue
+
+        offset += store
+
+        if type == 4:  # RPM_INT32_TYPE
+            tags[tag] = struct.unpack_from(">I", blob, offset)[0]
+        elif type == 5:  # RPM_INT64_TYPE
+            tags[tag] = struct.unpack_from(">Q", blob, offset)[0]
+        elif type in (6, 8, 9):  # RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE
+            tags[tag] = blob[offset:blob.index(b"\0", offset)].decode(errors="replace")
+
+    return tags
+
+
+def read_rpmdb(dbpath: Path) -> Optional[list[PackageRecord]]:
+    """
+    Read the sqlite rpm database and return the same fields that record_rpm_packages() queries with rpm for
+    every installed package. Returns None if the database doesn't use the sqlite backend or cannot be read
+    reliably.
+    """
+    db = dbpath / "rpmdb.sqlite"
+    if not db.exists():
+        return None
+
+    # We open the database as immutable so that sqlite doesn't create any files next to it in the image, but
+    # that means it ignores the write-ahead log, so leave it to rpm if there's anything in there.
+    wal = dbpath / "rpmdb.sqlite-wal"
+    if wal.exists() and wal.stat().st_size > 0:
+        return None
+
+    try:
+        with contextlib.closing(sqlite3.connect(f"{db.absolute().as_uri()}?immutable=1", uri=True)) as conn:
+            blobs = [blob for blob, in conn.execute("SELECT blob FROM Packages")]
+    except sqlite3.Error as e:
+        logging.debug(f"Failed to read rpm database {db}, falling back to rpm: {e}")
+        return None
+
+    packages: list[PackageRecord] = []
+
+    for blob in blobs:
+        tags = parse_rpm_header(blob)
+        name = str(tags.get(RpmTag.NAME, ""))
+        arch = str(tags.get(RpmTag.ARCH, "(none)"))
+
+        nevra = f"{name}-"
+        if RpmTag.EPOCH in tags:
+            nevra += f"{tags[RpmTag.EPOCH]}:"
+        nevra += f"{tags.get(RpmTag.VERSION, '')}-{tags.get(RpmTag.RELEASE, '')}"
+        # Packages without an architecture such as gpg-pubkey don't have it in their NEVRA.
+        if arch != "(none)":
+            nevra += f".{arch}"
+
+        packages += [(
+            nevra,
+            str(tags.get(RpmTag.SOURCERPM, "(none)")),
+            name,
+            arch,
+            str(tags.get(RpmTag.LONGSIZE, tags.get(RpmTag.SIZE, 0))),
+            str(tags.get(RpmTag.INSTALLTIME, 0)),
+        )]
+
+    return packages
+
+
 @dataclasses.dataclass
 class Manifest:
     config: MkosiConfig
@@ -103,20 +300,22 @@ class Manifest:
         # has to be told to use the location the rpmdb was moved to.
         # Otherwise the rpmdb will appear empty. See: https://bugs.debian.org/1004863
         dbpath = "/usr/lib/sysimage/rpm"
-        if not (root / dbpath).exists():
+        if not (root / dbpath.lstrip("/")).exists():
             dbpath = "/var/lib/rpm"
 
-        c = run(["rpm",
-                 f"--root={root}",
-                 f"--dbpath={dbpath}",
-                 "-qa",
-                 "--qf", r"%{NEVRA}\t%{SOURCERPM}\t%{NAME}\t%{ARCH}\t%{LONGSIZE}\t%{INSTALLTIME}\n"],
-                stdout=subprocess.PIPE)
+        packages = read_rpmdb(root / dbpath.lstrip("/"))
+        if packages is None:
+            c = run(["rpm",
+                     f"--root={root}",
+                     f"--dbpath={dbpath}",
+                     "-qa",
+                     "--qf", r"%{NEVRA}\t%{SOURCERPM}\t%{NAME}\t%{ARCH}\t%{LONGSIZE}\t%{INSTALLTIME}\n"],
+                    stdout=subprocess.PIPE)
+            packages = split_package_records(c.stdout)
 
-        packages = sorted(c.stdout.splitlines())
+        changelogs: dict[str, tuple[str, str]] = {}
 
-        for package in packages:
-            nevra, srpm, name, arch, size, installtime = package.split("\t")
+        for nevra, srpm, name, arch, size, installtime in sorted(packages):
 
             assert nevra.startswith(f"{name}-")
             evra = nevra.removeprefix(f"{name}-")
@@ -146,32 +345,64 @@ class Manifest:
 
             source = self.source_packages.get(srpm)
             if source is None:
-                c = run(["rpm",
-                         f"--root={root}",
-                         f"--dbpath={dbpath}",
-                         "-q",
-                         "--changelog",
-                         nevra],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.DEVNULL)
-                changelog = c.stdout.strip()
-                source = SourcePackageManifest(srpm, changelog)
+                source = SourcePackageManifest(srpm, None)
                 self.source_packages[srpm] = source
+                # The version and release can't contain colons, so anything before a colon is the epoch.
+                vra = f"{evr.rpartition(':')[2]}.{arch}" if arch else evr.rpartition(':')[2]
+                # The source rpm file name includes the version, so we can use it as the cache key.
+                changelogs[srpm] = (f"{name}-{vra}", srpm)
 
             source.add(manifest)
 
+        if changelogs:
+            self.load_changelogs(changelogs, lambda nevras: self.query_rpm_changelogs(root, dbpath, nevras))
+
+    def query_rpm_changelogs(self, root: Path, dbpath: str, keys: Mapping[str, str]) -> dict[str, str]:
+        """
+        Query the changelogs of many packages with a single rpm invocation. keys maps each source package to the
+        name-version-release.arch of one of its packages. Returns the changelogs keyed by source package, leaving
+        out any packages that rpm could not find.
+        """
+        sources = {key: source for source, key in keys.items()}
+        changelogs = {}
+        batch = 500
+
+        for i in range(0, len(sources), batch):
+            # rpm fails if any of the packages isn't installed, but still prints the changelogs of all the
+            # others, so don't let a single package fail the entire batch.
+            c = run(["rpm",
+                     f"--root={root}",
+                     f"--dbpath={dbpath}",
+                     "-q",
+                     "--qf",
+                     f"{RPM_CHANGELOG_DELIMITER}{RPM_CHANGELOG_KEY}\\n{RPM_CHANGELOG_FORMAT}{RPM_CHANGELOG_END}",
+                     *list(sources)[i:i + batch]],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    check=False)
+
+            for record in c.stdout.split(RPM_CHANGELOG_DELIMITER)[1:]:
+                key, _, rest = record.partition("\n")
+                changelog, found, _ = rest.partition(RPM_CHANGELOG_END)
+                if found and (source := sources.get(key)) is not None:
+                    changelogs[source] = changelog.strip()
+
+        return changelogs
+
     def record_deb_packages(self, root: Path) -> None:
-        c = run(["dpkg-query",
-                 f"--admindir={root}/var/lib/dpkg",
-                 "--show",
-                 "--showformat",
-                     r'${Package}\t${source:Package}\t${Version}\t${Architecture}\t${Installed-Size}\t${db-fsys:Last-Modified}\n'],
-                 stdout=subprocess.PIPE)
+        packages = parse_dpkg_status(root / "var/lib/dpkg")
+        if packages is None:
+            c = run(["dpkg-query",
+                     f"--admindir={root}/var/lib/dpkg",
+                     "--show",
+                     "--showformat",
+                         r'${Package}\t${source:Package}\t${Version}\t${Architecture}\t${Installed-Size}\t${db-fsys:Last-Modified}\n'],
+                     stdout=subprocess.PIPE)
+            packages = split_package_records(c.stdout)
 
-        packages = sorted(c.stdout.splitlines())
+        changelogs: dict[str, tuple[str, str]] = {}
 
-        for package in packages:
-            name, source, version, arch, size, installtime = package.split("\t")
+        for name, source, version, arch, size, installtime in sorted(packages):
 
             # dpkg records the size in KBs, the field is optional
             # db-fsys:Last-Modified is not available in very old dpkg, so just skip creating
@@ -194,43 +425,101 @@ class Manifest:
 
             source_package = self.source_packages.get(source)
             if source_package is None:
-                # Yes, --quiet is specified twice, to avoid output about download stats.
-                # Note that the argument of the 'changelog' verb is the binary package name,
-                # not the source package name.
-                cmd = [
-                    "apt-get",
-                    "--quiet",
-                    "--quiet",
-                    "-o", f"Dir={root}",
-                    "-o", f"DPkg::Chroot-Directory={root}",
-                    "changelog",
-                    name,
-                ]
-
-                # If we are building with docs then it's easy, as the changelogs are saved
-                # in the image, just fetch them. Otherwise they will be downloaded from the network.
-                if self.config.with_docs:
-                    # By default apt drops privileges and runs as the 'apt' user, but that means it
-                    # loses access to the build directory, which is 700.
-                    cmd += ["--option", "Acquire::Changelogs::AlwaysOnline=false",
-                            "--option", "Debug::NoDropPrivs=true"]
-                else:
-                    # Override the URL to avoid HTTPS, so that we don't need to install
-                    # ca-certificates to make it work.
-                    if self.config.distribution == Distribution.ubuntu:
-                        cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Ubuntu=http://changelogs.ubuntu.com/changelogs/pool/@CHANGEPATH@/changelog"]
-                    else:
-                        cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Debian=http://metadata.ftp-master.debian.org/changelogs/@CHANGEPATH@_changelog"]
-
-                # We have to run from the root, because if we use the RootDir option to make
-                # apt from the host look at the repositories in the image, it will also pick
-                # the 'methods' executables from there, but the ABI might not be compatible.
-                result = run(cmd, stdout=subprocess.PIPE)
-                source_package = SourcePackageManifest(source, result.stdout.strip())
+                source_package = SourcePackageManifest(source, None)
                 self.source_packages[source] = source_package
+                # Note that apt looks up changelogs by binary package name, not by source package name.
+                changelogs[source] = (name, f"{name}_{version}")
 
             source_package.add(manifest)
 
+        if changelogs:
+            self.load_changelogs(changelogs, lambda names: self.query_deb_changelogs(root, names))
+
+    def query_deb_changelogs(self, root: Path, names: Mapping[str, str]) -> dict[str, str]:
+        """
+        Read the changelogs of the given packages from the image if they are installed there, and fetch the others
+        with apt-get. Returns the changelogs keyed by source package.
+        """
+        def changelog(name: str) -> str:
+            if (changelog := read_deb_changelog(root, name)) is not None:
+                return changelog
+
+            # Yes, --quiet is specified twice, to avoid output about download stats.
+            cmd = [
+                "apt-get",
+                "--quiet",
+                "--quiet",
+                "-o", f"Dir={root}",
+                "-o", f"DPkg::Chroot-Directory={root}",
+                "changelog",
+                name,
+            ]
+
+            # If we are building with docs then it's easy, as the changelogs are saved
+            # in the image, just fetch them. Otherwise they will be downloaded from the network.
+            if self.config.with_docs:
+                # By default apt drops privileges and runs as the 'apt' user, but that means it
+                # loses access to the build directory, which is 700.
+                cmd += ["--option", "Acquire::Changelogs::AlwaysOnline=false",
+                        "--option", "Debug::NoDropPrivs=true"]
+            else:
+                # Override the URL to avoid HTTPS, so that we don't need to install
+                # ca-certificates to make it work.
+                if self.config.distribution == Distribution.ubuntu:
+                    cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Ubuntu=http://changelogs.ubuntu.com/changelogs/pool/@CHANGEPATH@/changelog"]
+                else:
+                    cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Debian=http://metadata.ftp-master.debian.org/changelogs/@CHANGEPATH@_changelog"]
+
+            # We have to run from the root, because if we use the RootDir option to make
+            # apt from the host look at the repositories in the image, it will also pick
+            # the 'methods' executables from there, but the ABI might not be compatible.
+            return run(cmd, stdout=subprocess.PIPE).stdout.strip()
+
+        # Changelogs that aren't in the image are downloaded one at a time by apt, so fetch a few of them in
+        # parallel but don't hammer the changelog servers.
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return dict(zip(names, pool.map(changelog, names.values())))
+
+    def load_changelogs(
+        self,
+        queries: Mapping[str, tuple[str, str]],
+        query: Callable[[Mapping[str, str]], dict[str, str]],
+    ) -> None:
+        """
+        Fill in the changelogs of the given source packages. queries maps each source package to the argument
+        passed to query for it and to a cache key that identifies the version of the package. Changelogs never
+        change for a given version, so if a cache directory is configured, they are stored in
+        <cache>/changelogs/<distribution>/<key> and only queried if they are not in the cache yet.
+        """
+        cache = self.config.cache_dir / "changelogs" / str(self.config.distribution) if self.config.cache_dir else None
+        missing = {}
+
+        for source, (arg, key) in queries.items():
+            if cache and (cache / key).exists():
+                self.source_packages[source].changelog = (cache / key).read_text()
+            else:
+                missing[source] = arg
+
+        if not missing:
+            return
+
+        if cache:
+            cache.mkdir(parents=True, exist_ok=True)
+
+        for source, changelog in query(missing).items():
+            self.source_packages[source].changelog = changelog
+
+            if not cache:
+                continue
+
+            key = queries[source][1]
+            # Write to a temporary file and rename it into place so that concurrent builds never read a partially
+            # written changelog.
+            with tempfile.NamedTemporaryFile("w", dir=cache, prefix=f".{key}", delete=False) as f:
+                f.write(changelog)
+
+            os.rename(f.name, cache / key)
+
     def record_pkg_packages(self, root: Path) -> None:
         packages = sorted((root / "var/lib/pacman/local").glob("*/desc"))
 
@@ -10,6 +10,7 @@ from pathlib import Path
 from typing import Optional
 
 from mkosi.run import run
+from mkosi.tree import walk_tree
 from mkosi.types import PathString
 from mkosi.util import INVOKING_USER, umask
 from mkosi.versioncomp import GenericVersion
@@ -25,10 +26,22 @@ def delete_whiteout_files(path: Path) -> None:
     Overlayfs uses such files to mark "whiteouts" (files present in
     the lower layers, but removed in the upper one).
     """
-    for entry in path.rglob("*"):
-        # TODO: Use Path.stat() once we depend on Python 3.10+.
-        if stat_is_whiteout(os.stat(entry, follow_symlinks=False)):
-            entry.unlink()
+    def visit(dirfd: int, entry: os.DirEntry[str], context: bool) -> Optional[bool]:
+        if entry.is_dir(follow_symlinks=False):
+            return True
+
+        # The file type of an entry is usually known from readdir() already, so we only have to stat the
+        # entries that could be character devices.
+        if (
+            not entry.is_file(follow_symlinks=False) and
+            not entry.is_symlink() and
+            stat_is_whiteout(entry.stat(follow_symlinks=False))
+        ):
+            os.unlink(entry.name, dir_fd=dirfd)
+
+        return None
+
+    walk_tree(path, visit, True)
 
 
 @contextlib.contextmanager
@@ -73,9 +86,16 @@ def mount_overlay(
     lowerdirs: Sequence[Path],
     upperdir: Optional[Path] = None,
     where: Optional[Path] = None,
+    delete_whiteouts: bool = True,
 ) -> Iterator[Path]:
+    """
+    Mount an overlay filesystem of lowerdirs with upperdir as the upper directory. Any whiteout files are
+    deleted from upperdir after unmounting, unless delete_whiteouts is false or no upperdir was given, in
+    which case a temporary upper directory is used that is discarded after unmounting.
+    """
     with contextlib.ExitStack() as stack:
         if upperdir is None:
+            delete_whiteouts = False
             upperdir = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="volatile-overlay")))
             st = lowerdirs[-1].stat()
             os.chmod(upperdir, st.st_mode)
@@ -115,7 +135,8 @@ def mount_overlay(
             with mount("overlay", where, options=options, type="overlay"):
                 yield where
         finally:
-            delete_whiteout_files(upperdir)
+            if delete_whiteouts:
+                delete_whiteout_files(upperdir)
 
 
 @contextlib.contextmanager
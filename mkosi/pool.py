@@ -0,0 +1,242 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import dataclasses
+import errno
+import hashlib
+import os
+import re
+import shutil
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Optional
+
+from mkosi.distributions import PackageType
+from mkosi.tree import walk_tree
+from mkosi.util import flock
+
+# The subdirectories of a cache directory that package managers download packages to.
+PACKAGE_CACHE_DIRS = ("apt", "dnf", "libdnf5", "pacman", "zypp")
+
+POOL_ENTRY = re.compile(r"([0-9a-f]{64})-(.+)")
+
+
+@dataclasses.dataclass(frozen=True)
+class PoolEntry:
+    path: Path
+    digest: str
+    name: str
+    size: int
+    # The last time the package was read or added to the pool, whichever is more recent.
+    used: float
+    nlink: int
+
+
+def is_package(name: str, packagetype: Optional[PackageType] = None) -> bool:
+    if packagetype in (None, PackageType.deb) and name.endswith((".deb", ".ddeb", ".udeb")):
+        return True
+    if packagetype in (None, PackageType.rpm) and name.endswith(".rpm"):
+        return True
+    if packagetype in (None, PackageType.pkg) and ".pkg.tar" in name and not name.endswith(".sig"):
+        return True
+
+    return False
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+
+    with path.open("rb") as f:
+        while (buf := f.read(1024**2)):
+            h.update(buf)
+
+    return h.hexdigest()
+
+
+def pool_entries(pool: Path) -> list[PoolEntry]:
+    """Return all packages in the pool, ordered from least to most recently used."""
+    if not pool.exists():
+        return []
+
+    entries = []
+
+    with os.scandir(pool) as it:
+        for entry in it:
+            if not (m := POOL_ENTRY.fullmatch(entry.name)) or not entry.is_file(follow_symlinks=False):
+                continue
+
+            st = entry.stat(follow_symlinks=False)
+            entries += [
+                PoolEntry(
+                    path=Path(entry.path),
+                    digest=m.group(1),
+                    name=m.group(2),
+                    size=st.st_size,
+                    used=max(st.st_atime, st.st_mtime),
+                    nlink=st.st_nlink,
+                )
+            ]
+
+    return sorted(entries, key=lambda e: (e.used, e.name))
+
+
+def package_cache_files(cache: Path) -> list[Path]:
+    """Return all downloaded packages in the package manager subdirectories of the given cache directory."""
+    files = []
+
+    def visit(dirfd: int, entry: os.DirEntry[str], context: Path) -> Optional[Path]:
+        # apt stores incomplete downloads in partial/ so skip those.
+        if entry.is_dir(follow_symlinks=False) and entry.name != "partial":
+            return context / entry.name
+        if entry.is_file(follow_symlinks=False) and is_package(entry.name):
+            files.append(context / entry.name)
+
+        return None
+
+    for d in PACKAGE_CACHE_DIRS:
+        if (cache / d).is_dir():
+            walk_tree(cache / d, visit, cache / d)
+
+    return files
+
+
+def package_cache_dirs(cache: Path, packagetype: PackageType) -> list[Path]:
+    """Return the directories in the given cache directory that packages are looked up in before downloading."""
+    if packagetype == PackageType.deb:
+        return [cache / "apt/archives"]
+    if packagetype == PackageType.pkg:
+        return [cache / "pacman/pkg"]
+    if packagetype == PackageType.rpm:
+        # dnf keeps a separate packages directory per repository which only exists once the metadata of the
+        # repository has been downloaded.
+        return sorted([*cache.glob("dnf/*/packages"), *cache.glob("libdnf5/*/packages")])
+
+    return []
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        tmp = dst.with_name(f".{dst.name}.tmp")
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+
+
+def populate_package_cache(pool: Path, cache: Path, packagetype: PackageType) -> None:
+    """
+    Hardlink the packages from the pool into the given package cache directory so that the package manager
+    doesn't download them again. Packages of which the pool holds multiple different versions with the same
+    file name are skipped. The package managers verify the checksums of cached packages, so a package from
+    the pool that doesn't match the repository metadata is downloaded again.
+    """
+    if not pool.exists():
+        return
+
+    with flock(pool):
+        _populate_package_cache(pool, cache, packagetype)
+
+
+def _populate_package_cache(pool: Path, cache: Path, packagetype: PackageType) -> None:
+    byname: dict[str, list[PoolEntry]] = {}
+    for entry in pool_entries(pool):
+        if is_package(entry.name, packagetype):
+            byname.setdefault(entry.name, []).append(entry)
+
+    candidates = [entries[0] for entries in byname.values() if len(entries) == 1]
+    if not candidates:
+        return
+
+    for d in package_cache_dirs(cache, packagetype):
+        d.mkdir(parents=True, exist_ok=True)
+        present = set(os.listdir(d))
+
+        for entry in candidates:
+            if entry.name in present:
+                continue
+
+            try:
+                os.link(entry.path, d / entry.name)
+            except OSError as e:
+                # Copying the entire pool into the package cache would defeat its purpose, so don't bother if
+                # the pool lives on a different filesystem.
+                if e.errno == errno.EXDEV:
+                    return
+                raise
+
+
+def sync_package_pool(pool: Path, cache: Path) -> None:
+    """
+    Add all packages downloaded to the given package cache directory to the pool. Packages that are already in
+    the pool are replaced with a hardlink to the pooled package so that they are only stored once.
+    """
+    pool.mkdir(parents=True, exist_ok=True)
+
+    with flock(pool):
+        for path in package_cache_files(cache):
+            _sync_package(pool, path)
+
+
+def _sync_package(pool: Path, path: Path) -> None:
+    # Packages with multiple links are already in the pool.
+    if path.stat().st_nlink > 1:
+        return
+
+    entry = pool / f"{file_digest(path)}-{path.name}"
+
+    if entry.exists():
+        tmp = path.with_name(f".{path.name}.tmp")
+        try:
+            os.link(entry, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    else:
+        link_or_copy(path, entry)
+
+    # Downloaded packages might carry the modification time of the server, so mark them as used explicitly.
+    os.utime(entry)
+
+
+def gc_package_pool(pool: Path, size: int, caches: Iterable[Path] = ()) -> list[PoolEntry]:
+    """
+    Remove the least recently used packages from the pool until it uses at most size bytes. Hardlinks to the
+    removed packages in the given cache directories are removed as well so that the disk space is actually
+    freed. Returns the removed entries.
+    """
+    if not pool.exists():
+        return []
+
+    with flock(pool):
+        return _gc_package_pool(pool, size, caches)
+
+
+def _gc_package_pool(pool: Path, size: int, caches: Iterable[Path]) -> list[PoolEntry]:
+    entries = pool_entries(pool)
+    total = sum(e.size for e in entries)
+    removed: list[PoolEntry] = []
+    inodes: set[tuple[int, int]] = set()
+
+    for entry in entries:
+        if total <= size:
+            break
+
+        if entry.nlink > 1:
+            st = entry.path.stat()
+            inodes.add((st.st_dev, st.st_ino))
+
+        entry.path.unlink()
+        removed += [entry]
+        total -= entry.size
+
+    if inodes:
+        for cache in caches:
+            for path in package_cache_files(cache):
+                st = path.stat()
+                if (st.st_dev, st.st_ino) in inodes:
+                    path.unlink()
+
+    return removed
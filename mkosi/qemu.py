@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
 import asyncio
+import asyncio.tasks
 import base64
 import contextlib
 import enum
@@ -9,6 +10,7 @@ import fcntl
 import hashlib
 import logging
 import os
+import queue
 import random
 import shutil
 import socket
@@ -16,10 +18,12 @@ import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import uuid
-from collections.abc import Iterator, Mapping
+from collections.abc import Awaitable, Iterator, Mapping
 from pathlib import Path
-from typing import Optional
+from types import TracebackType
+from typing import Any, Optional
 
 from mkosi.architecture import Architecture
 from mkosi.config import (
@@ -34,7 +38,6 @@ from mkosi.config import (
 from mkosi.log import die
 from mkosi.partition import finalize_root, find_partitions
 from mkosi.run import (
-    MkosiAsyncioThread,
     become_root,
     find_binary,
     fork_and_wait,
@@ -359,6 +362,59 @@ def start_virtiofsd(directory: Path, *, uidmap: bool) -> Iterator[Path]:
                 proc.wait()
 
 
+class MkosiAsyncioThread(threading.Thread):
+    """
+    The default threading.Thread() is not interruptable, so we make our own version by using the concurrency
+    feature in python that is interruptable, namely asyncio.
+
+    Additionally, we store any exception that the coroutine raises and re-raise it in join() if no other
+    exception was raised before.
+    """
+
+    def __init__(self, target: Awaitable[Any], *args: Any, **kwargs: Any) -> None:
+        self.target = target
+        self.loop: queue.SimpleQueue[asyncio.AbstractEventLoop] = queue.SimpleQueue()
+        self.exc: queue.SimpleQueue[BaseException] = queue.SimpleQueue()
+        super().__init__(*args, **kwargs)
+
+    def run(self) -> None:
+        async def wrapper() -> None:
+            self.loop.put(asyncio.get_running_loop())
+            await self.target
+
+        try:
+            asyncio.run(wrapper())
+        except asyncio.CancelledError:
+            pass
+        except BaseException as e:
+            self.exc.put(e)
+
+    def cancel(self) -> None:
+        loop = self.loop.get()
+
+        for task in asyncio.tasks.all_tasks(loop):
+            loop.call_soon_threadsafe(task.cancel)
+
+    def __enter__(self) -> "MkosiAsyncioThread":
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        type: Optional[type[BaseException]],
+        value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.cancel()
+        self.join()
+
+        if type is None:
+            try:
+                raise self.exc.get_nowait()
+            except queue.Empty:
+                pass
+
+
 @contextlib.contextmanager
 def vsock_notify_handler() -> Iterator[tuple[str, dict[str, str]]]:
     """
@@ -1,31 +1,31 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
-import asyncio
-import asyncio.tasks
 import contextlib
 import ctypes
 import ctypes.util
 import enum
 import errno
 import fcntl
+import functools
+import graphlib
 import logging
 import os
 import pwd
-import queue
 import shlex
 import shutil
 import signal
 import subprocess
 import sys
 import threading
-from collections.abc import Awaitable, Collection, Iterator, Mapping, Sequence
+from collections.abc import Collection, Iterator, Mapping, Sequence
 from pathlib import Path
 from types import TracebackType
-from typing import Any, Callable, NoReturn, Optional
+from typing import Callable, NoReturn, Optional
 
 from mkosi.log import ARG_DEBUG, ARG_DEBUG_SHELL, die
 from mkosi.types import _FILE, CompletedProcess, PathString, Popen
 from mkosi.util import INVOKING_USER, flock, one_zero
+from mkosi.versioncomp import GenericVersion
 
 CLONE_NEWNS = 0x00020000
 CLONE_NEWUSER = 0x10000000
@@ -129,6 +129,9 @@ def become_root() -> None:
     INVOKING_USER.uid = SUBRANGE - 100
     INVOKING_USER.gid = SUBRANGE - 100
 
+    # Our capabilities are different in the new user namespace.
+    effective_caps.cache_clear()
+
 
 def init_mount_namespace() -> None:
     unshare(CLONE_NEWNS)
@@ -153,6 +156,14 @@ def make_foreground_process(*, new_process_group: bool = True) -> None:
         signal.signal(signal.SIGTTOU, old)
 
 
+def on_main_thread() -> bool:
+    """
+    Signal handlers and the foreground process group are process wide and signal handlers can only be installed
+    from the main thread, so commands started from worker threads have to stay in our process group.
+    """
+    return threading.current_thread() is threading.main_thread()
+
+
 def ensure_exc_info() -> tuple[type[BaseException], BaseException, TracebackType]:
     exctype, exc, tb = sys.exc_info()
     assert exctype
@@ -217,6 +228,89 @@ def fork_and_wait(target: Callable[[], None]) -> None:
         raise subprocess.CalledProcessError(rc, ["self"])
 
 
+def forward_prefixed_output(fd: int, prefix: str) -> None:
+    with os.fdopen(fd, "rb") as f:
+        for line in f:
+            sys.stderr.buffer.write(prefix.encode() + line)
+            sys.stderr.buffer.flush()
+
+
+def fork_and_wait_graph(
+    targets: Mapping[str, Callable[[], None]],
+    graph: Mapping[str, Collection[str]],
+    jobs: int,
+) -> None:
+    """
+    Run each target in its own child process, running at most @jobs children at once. A target is started as
+    soon as all the targets it depends on according to @graph have finished successfully. The output of each child
+    is prefixed with the name of its target. If a target fails, all other running targets are terminated and no
+    new targets are started.
+    """
+    sorter = graphlib.TopologicalSorter({name: [d for d in graph.get(name, ()) if d in targets] for name in targets})
+    sorter.prepare()
+
+    pending: list[str] = []
+    running: dict[int, tuple[str, threading.Thread]] = {}
+    failed = 0
+
+    def start(name: str) -> None:
+        rfd, wfd = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            with uncaught_exception_handler(exit=os._exit):
+                os.close(rfd)
+                # Targets running in parallel can't share the terminal, so there's no interactive input and we
+                # don't try to become the foreground process.
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, sys.stdin.fileno())
+                os.dup2(wfd, sys.stdout.fileno())
+                os.dup2(wfd, sys.stderr.fileno())
+                os.close(devnull)
+                os.close(wfd)
+                targets[name]()
+
+        os.close(wfd)
+        thread = threading.Thread(target=forward_prefixed_output, args=(rfd, f"{name}: "), daemon=True)
+        thread.start()
+        running[pid] = (name, thread)
+
+    try:
+        while True:
+            if not failed:
+                pending += sorter.get_ready()
+                while pending and len(running) < jobs:
+                    start(pending.pop(0))
+
+            if not running:
+                break
+
+            pid, status = os.wait()
+            if pid not in running:
+                continue
+
+            name, thread = running.pop(pid)
+            thread.join()
+
+            if (rc := os.waitstatus_to_exitcode(status)) == 0:
+                sorter.done(name)
+            elif not failed:
+                logging.error(f"Building {name} failed, terminating all other builds")
+                failed = rc
+
+                for other in running:
+                    os.kill(other, signal.SIGTERM)
+    except BaseException:
+        for pid in running:
+            os.kill(pid, signal.SIGTERM)
+        for pid in running:
+            os.waitpid(pid, 0)
+        raise
+
+    if failed:
+        raise subprocess.CalledProcessError(failed, ["self"])
+
+
 @contextlib.contextmanager
 def sigkill_to_sigterm() -> Iterator[None]:
     old = signal.SIGKILL
@@ -277,12 +371,14 @@ def run(
     elif stdin is None:
         stdin = subprocess.DEVNULL
 
+    foreground = on_main_thread()
+
     try:
         # subprocess.run() will use SIGKILL to kill processes when an exception is raised.
         # We'd prefer it to use SIGTERM instead but since this we can't configure which signal
         # should be used, we override the constant in the signal module instead before we call
         # subprocess.run().
-        with sigkill_to_sigterm():
+        with sigkill_to_sigterm() if foreground else contextlib.nullcontext():
             return subprocess.run(
                 cmdline,
                 check=check,
@@ -295,7 +391,7 @@ def run(
                 group=group,
                 env=env,
                 cwd=cwd,
-                preexec_fn=make_foreground_process,
+                preexec_fn=make_foreground_process if foreground else None,
             )
     except FileNotFoundError as e:
         die(f"{e.filename} not found.")
@@ -304,7 +400,8 @@ def run(
             log_process_failure(cmdline, e.returncode)
         raise e
     finally:
-        make_foreground_process(new_process_group=False)
+        if foreground:
+            make_foreground_process(new_process_group=False)
 
 
 @contextlib.contextmanager
@@ -339,6 +436,8 @@ def spawn(
         **env,
     }
 
+    foreground = foreground and on_main_thread()
+
     def preexec() -> None:
         if foreground:
             make_foreground_process()
@@ -356,7 +455,8 @@ def spawn(
             group=group,
             pass_fds=pass_fds,
             env=env,
-            preexec_fn=preexec,
+            # preexec_fn is not safe to use when there are threads, so only pass it when we actually need it.
+            preexec_fn=preexec if foreground or preexec_fn else None,
         ) as proc:
             yield proc
     except FileNotFoundError as e:
@@ -375,16 +475,21 @@ class Capability(enum.Enum):
     CAP_NET_ADMIN = 12
 
 
-def have_effective_cap(capability: Capability) -> bool:
+@functools.lru_cache(maxsize=1)
+def effective_caps() -> Optional[int]:
     for line in Path("/proc/self/status").read_text().splitlines():
         if line.startswith("CapEff:"):
-            hexcap = line.removeprefix("CapEff:").strip()
-            break
-    else:
+            return int(line.removeprefix("CapEff:").strip(), 16)
+
+    return None
+
+
+def have_effective_cap(capability: Capability) -> bool:
+    if (caps := effective_caps()) is None:
         logging.warning(f"\"CapEff:\" not found in /proc/self/status, assuming we don't have {capability}")
         return False
 
-    return (int(hexcap, 16) & (1 << capability.value)) != 0
+    return (caps & (1 << capability.value)) != 0
 
 
 def find_binary(*names: PathString, root: Optional[Path] = None) -> Optional[Path]:
@@ -396,6 +501,20 @@ def find_binary(*names: PathString, root: Optional[Path] = None) -> Optional[Pat
     return None
 
 
+@functools.lru_cache
+def _bwrap_version(dev: int, ino: int) -> GenericVersion:
+    return GenericVersion(run(["bwrap", "--version"], stdout=subprocess.PIPE).stdout.split()[1])
+
+
+def bwrap_version() -> GenericVersion:
+    # /usr might get overmounted with the tools tree so make sure we don't reuse the version of another binary.
+    if not (bwrap := find_binary("bwrap")):
+        die("bwrap not found.")
+
+    st = os.stat(bwrap)
+    return _bwrap_version(st.st_dev, st.st_ino)
+
+
 def bwrap(
     cmd: Sequence[PathString],
     *,
@@ -439,13 +558,21 @@ def bwrap(
         "--setenv", "SYSTEMD_OFFLINE", one_zero(network),
     ]
 
+    # Since bubblewrap 0.6.0, --perms applies to --tmpfs as well which allows us to avoid spawning a shell just
+    # to fix up the permissions of /dev/shm for every sandboxed command.
+    if bwrap_version() >= "0.6.0":
+        cmdline += ["--perms", "1777", "--tmpfs", "/dev/shm"]
+        shm: list[PathString] = []
+    else:
+        shm = ["sh", "-c", "chmod 1777 /dev/shm && exec $0 \"$@\""]
+
     cmdline += [
         "--setenv", "PATH", f"{scripts or ''}:{os.environ['PATH']}",
         *options,
-        "sh", "-c", "chmod 1777 /dev/shm && exec $0 \"$@\"",
+        *shm,
     ]
 
-    if setpgid := find_binary("setpgid"):
+    if on_main_thread() and (setpgid := find_binary("setpgid")):
         cmdline += [setpgid, "--foreground", "--"]
 
     try:
@@ -501,7 +628,7 @@ def apivfs_cmd(root: Path) -> list[PathString]:
 
     cmdline += finalize_passwd_mounts(root)
 
-    if setpgid := find_binary("setpgid"):
+    if on_main_thread() and (setpgid := find_binary("setpgid")):
         cmdline += [setpgid, "--foreground", "--"]
 
     chmod = f"chmod 1777 {root / 'tmp'} {root / 'var/tmp'} {root / 'dev/shm'}"
@@ -540,60 +667,8 @@ def chroot_cmd(root: Path, *, resolve: bool = False, options: Sequence[PathStrin
 
     cmdline += [*options]
 
-    if setpgid := find_binary("setpgid", root=root):
+    if on_main_thread() and (setpgid := find_binary("setpgid", root=root)):
         cmdline += [setpgid, "--foreground", "--"]
 
     return apivfs_cmd(root) + cmdline
 
-
-class MkosiAsyncioThread(threading.Thread):
-    """
-    The default threading.Thread() is not interruptable, so we make our own version by using the concurrency
-    feature in python that is interruptable, namely asyncio.
-
-    Additionally, we store any exception that the coroutine raises and re-raise it in join() if no other
-    exception was raised before.
-    """
-
-    def __init__(self, target: Awaitable[Any], *args: Any, **kwargs: Any) -> None:
-        self.target = target
-        self.loop: queue.SimpleQueue[asyncio.AbstractEventLoop] = queue.SimpleQueue()
-        self.exc: queue.SimpleQueue[BaseException] = queue.SimpleQueue()
-        super().__init__(*args, **kwargs)
-
-    def run(self) -> None:
-        async def wrapper() -> None:
-            self.loop.put(asyncio.get_running_loop())
-            await self.target
-
-        try:
-            asyncio.run(wrapper())
-        except asyncio.CancelledError:
-            pass
-        except BaseException as e:
-            self.exc.put(e)
-
-    def cancel(self) -> None:
-        loop = self.loop.get()
-
-        for task in asyncio.tasks.all_tasks(loop):
-            loop.call_soon_threadsafe(task.cancel)
-
-    def __enter__(self) -> "MkosiAsyncioThread":
-        self.start()
-        return self
-
-    def __exit__(
-        self,
-        type: Optional[type[BaseException]],
-        value: Optional[BaseException],
-        traceback: Optional[TracebackType],
-    ) -> None:
-        self.cancel()
-        self.join()
-
-        if type is None:
-            try:
-                raise self.exc.get_nowait()
-            except queue.Empty:
-                pass
@@ -14,6 +14,8 @@ class MkosiState:
         self.args = args
         self.config = config
         self.workspace = workspace
+        # SHA256 digests of outputs that were calculated while the outputs were written.
+        self.digests: dict[Path, str] = {}
 
         with umask(~0o755):
             # Using a btrfs subvolume as the upperdir in an overlayfs results in EXDEV so make sure we create
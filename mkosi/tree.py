@@ -1,10 +1,14 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
 import errno
+import fnmatch
+import os
 import shutil
 import subprocess
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional, TypeVar
 
 from mkosi.archive import extract_tar
 from mkosi.config import ConfigFeature
@@ -14,6 +18,8 @@ from mkosi.types import PathString
 from mkosi.util import umask
 from mkosi.versioncomp import GenericVersion
 
+T = TypeVar("T")
+
 
 def statfs(path: Path) -> str:
     return run(["stat", "--file-system", "--format", "%T", path], stdout=subprocess.PIPE).stdout.strip()
@@ -107,6 +113,115 @@ def rmtree(*paths: Path) -> None:
     run(["rm", "-rf", "--", *paths])
 
 
+def _walk_tree(dirfd: int, visit: Callable[[int, os.DirEntry[str], T], Optional[T]], context: T) -> None:
+    with os.scandir(dirfd) as it:
+        for entry in it:
+            if (child := visit(dirfd, entry, context)) is None:
+                continue
+
+            fd = os.open(entry.name, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC, dir_fd=dirfd)
+            try:
+                _walk_tree(fd, visit, child)
+            finally:
+                os.close(fd)
+
+
+def walk_tree(
+    path: Path,
+    visit: Callable[[int, os.DirEntry[str], T], Optional[T]],
+    context: T,
+    *,
+    parallel: bool = False,
+) -> None:
+    """
+    Call visit() for every entry underneath path (but not path itself) with a file descriptor of the directory
+    containing the entry, so that the entry can be operated on with the dir_fd= variants of the os functions
+    without resolving its full path again. visit() returns the context to pass on to the entries of a directory
+    or None to not descend into it. Note that symlinks to directories are descended into if visit() asks for it.
+    If parallel is true, the top-level subtrees of path are walked concurrently.
+    """
+    fd = os.open(path, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+    try:
+        if not parallel:
+            _walk_tree(fd, visit, context)
+            return
+
+        subtrees = []
+        try:
+            with os.scandir(fd) as it:
+                for entry in it:
+                    if (child := visit(fd, entry, context)) is not None:
+                        subtrees += [(os.open(entry.name, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC, dir_fd=fd), child)]
+
+            with ThreadPoolExecutor() as pool:
+                for f in [pool.submit(_walk_tree, subfd, visit, child) for subfd, child in subtrees]:
+                    f.result()
+        finally:
+            for subfd, _ in subtrees:
+                os.close(subfd)
+    finally:
+        os.close(fd)
+
+
+def glob_tree(root: Path, patterns: Sequence[str]) -> list[Path]:
+    """
+    Return all paths underneath root matching any of the given glob patterns in a single walk of root. Patterns
+    have the same semantics as with Path.glob() except that the descendants of a matching directory are not
+    matched again.
+    """
+    parts = [Path(p).parts for p in patterns]
+    if any(not p for p in parts):
+        die(f"Invalid glob pattern in {' '.join(patterns)}")
+
+    def expand(states: set[tuple[int, int]]) -> frozenset[tuple[int, int]]:
+        # "**" also matches zero directories so skip over it as well.
+        todo = list(states)
+        while todo:
+            i, j = todo.pop()
+            if j < len(parts[i]) and parts[i][j] == "**" and (i, j + 1) not in states:
+                states.add((i, j + 1))
+                todo.append((i, j + 1))
+
+        return frozenset(states)
+
+    matches = []
+
+    def visit(
+        dirfd: int,
+        entry: os.DirEntry[str],
+        context: tuple[Path, frozenset[tuple[int, int]]],
+    ) -> Optional[tuple[Path, frozenset[tuple[int, int]]]]:
+        parent, states = context
+        directory = entry.is_dir(follow_symlinks=False)
+        new = set()
+
+        for i, j in states:
+            if j == len(parts[i]):
+                continue
+
+            if parts[i][j] == "**":
+                # Like Path.glob(), don't follow symlinks when recursing.
+                if directory:
+                    new.add((i, j))
+            elif fnmatch.fnmatchcase(entry.name, parts[i][j]):
+                new.add((i, j + 1))
+
+        closed = expand(new)
+        if any(j == len(parts[i]) and (parts[i][-1] != "**" or directory) for i, j in closed):
+            matches.append(root / parent / entry.name)
+            return None
+
+        closed = frozenset((i, j) for i, j in closed if j < len(parts[i]))
+        if not closed or not entry.is_dir():
+            return None
+
+        return parent / entry.name, closed
+
+    walk_tree(root, visit, (Path(), expand({(i, 0) for i in range(len(parts))})))
+
+    return matches
+
+
 def move_tree(src: Path, dst: Path, use_subvolumes: ConfigFeature = ConfigFeature.disabled) -> None:
     if src == dst:
         return
@@ -1,7 +1,81 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
-import string
-from itertools import takewhile
+import functools
+import re
+from typing import Union
+
+# Token ranks, in the order in which the tokens compare against each other. Any characters outside of
+# a-z, A-Z, 0-9, -, ., ~ and ^ are skipped and never produce a token.
+_TILDE = 0
+_END = 1
+_DASH = 2
+_CARET = 3
+_DOT = 4
+# Digit runs are only ever compared against other digit runs or separators, so they can share their rank
+# with the low gap.
+_DIGITS = 5
+_GAP_LOW = 5
+_LETTERS = 6
+_GAP_HIGH = 7
+
+_SEPARATORS = {"~": _TILDE, "-": _DASH, "^": _CARET, ".": _DOT}
+_TOKEN = re.compile(r"[~\-^.]|[0-9]+|[a-zA-Z]+")
+_GAP = object()
+
+VersionKey = tuple[tuple[Union[int, str], ...], ...]
+
+
+@functools.lru_cache(maxsize=4096)
+def version_key(version: str) -> VersionKey:
+    """
+    Parse a version into a tuple that sorts according to the UAPI Group Version Format Specification.
+
+    Comparing two versions consumes digit runs from both versions at the same time, where a version that
+    has letters instead of digits at that point counts as zero and does not advance. To turn that into a
+    plain tuple comparison, every letter run is preceded by a digit run (inserting a zero if there is
+    none), so that digits are only ever compared against digits and letters against letters. A digit run
+    that directly follows another digit run (separated by skipped characters) is preceded by a gap token
+    instead, which compares higher than letters if a non-zero digit run follows before the next letter run
+    or separator and lower otherwise.
+    """
+    tokens: list[Union[int, str, object, tuple[int]]] = []
+
+    for m in _TOKEN.finditer(version):
+        s = m.group()
+
+        if s in _SEPARATORS:
+            tokens += [(_SEPARATORS[s],)]
+        elif s.isdigit():
+            if tokens and isinstance(tokens[-1], int):
+                tokens += [_GAP]
+            tokens += [int(s)]
+        else:
+            # Zero digit runs following a gap are skipped when compared against letters, so they don't
+            # matter when followed by letters.
+            while len(tokens) >= 2 and tokens[-1] == 0 and tokens[-2] is _GAP:
+                del tokens[-2:]
+            if not tokens or not isinstance(tokens[-1], int):
+                tokens += [0]
+            tokens += [s]
+
+    tokens += [(_END,)]
+
+    key: list[tuple[Union[int, str], ...]] = []
+
+    for i, token in enumerate(tokens):
+        if isinstance(token, tuple):
+            key += [token]
+        elif isinstance(token, int):
+            key += [(_DIGITS, token)]
+        elif isinstance(token, str):
+            key += [(_LETTERS, token)]
+        else:
+            j = i + 1
+            while tokens[j] == 0 and tokens[j + 1] is _GAP:
+                j += 2
+            key += [(_GAP_HIGH,) if tokens[j] != 0 else (_GAP_LOW,)]
+
+    return tuple(key)
 
 
 class GenericVersion:
@@ -12,173 +86,69 @@ class GenericVersion:
     _RIGHT_SMALLER = 1
     _LEFT_SMALLER = -1
 
+    __slots__ = ("_version", "_key")
+
     def __init__(self, version: str):
         self._version = version
+        self._key = version_key(version)
 
     @classmethod
     def compare_versions(cls, v1: str, v2: str) -> int:
         """Implements comparison according to UAPI Group Version Format Specification"""
-        def rstrip_invalid_version_chars(s: str) -> str:
-            valid_version_chars = {*string.ascii_letters, *string.digits, "~", "-", "^", "."}
-            for i, c in enumerate(s):
-                if c in valid_version_chars:
-                    return s[i:]
-            return ""
-
-        def digit_prefix(s: str) -> str:
-            return "".join(takewhile(lambda c: c in string.digits, s))
-
-        def letter_prefix(s: str) -> str:
-            return "".join(takewhile(lambda c: c in string.ascii_letters, s))
-
-        while True:
-            # Any characters which are outside of the set of listed above (a-z, A-Z, 0-9, -, ., ~,
-            # ^) are skipped in both strings. In particular, this means that non-ASCII characters
-            # that are Unicode digits or letters are skipped too.
-            v1 = rstrip_invalid_version_chars(v1)
-            v2 = rstrip_invalid_version_chars(v2)
-
-            # If the remaining part of one of strings starts with "~": if other remaining part does
-            # not start with ~, the string with ~ compares lower. Otherwise, both tilde characters
-            # are skipped.
-
-            if v1.startswith("~") and v2.startswith("~"):
-                v1 = v1.removeprefix("~")
-                v2 = v2.removeprefix("~")
-            elif v1.startswith("~"):
-                return cls._LEFT_SMALLER
-            elif v2.startswith("~"):
-                return cls._RIGHT_SMALLER
-
-            # If one of the strings has ended: if the other string hasn’t, the string that has
-            # remaining characters compares higher. Otherwise, the strings compare equal.
-
-            if not v1 and not v2:
-                return cls._EQUAL
-            elif not v1 and v2:
-                return cls._LEFT_SMALLER
-            elif v1 and not v2:
-                return cls._RIGHT_SMALLER
-
-            # If the remaining part of one of strings starts with "-": if the other remaining part
-            # does not start with -, the string with - compares lower. Otherwise, both minus
-            # characters are skipped.
-
-            if v1.startswith("-") and v2.startswith("-"):
-                v1 = v1.removeprefix("-")
-                v2 = v2.removeprefix("-")
-            elif v1.startswith("-"):
-                return cls._LEFT_SMALLER
-            elif v2.startswith("-"):
-                return cls._RIGHT_SMALLER
-
-            # If the remaining part of one of strings starts with "^": if the other remaining part
-            # does not start with ^, the string with ^ compares higher. Otherwise, both caret
-            # characters are skipped.
-
-            if v1.startswith("^") and v2.startswith("^"):
-                v1 = v1.removeprefix("^")
-                v2 = v2.removeprefix("^")
-            elif v1.startswith("^"):
-                # TODO: bug?
-                return cls._LEFT_SMALLER  #cls._RIGHT_SMALLER
-            elif v2.startswith("^"):
-                return cls._RIGHT_SMALLER #cls._LEFT_SMALLER
-
-            # If the remaining part of one of strings starts with ".": if the other remaining part
-            # does not start with ., the string with . compares lower. Otherwise, both dot
-            # characters are skipped.
-
-            if v1.startswith(".") and v2.startswith("."):
-                v1 = v1.removeprefix(".")
-                v2 = v2.removeprefix(".")
-            elif v1.startswith("."):
-                return cls._LEFT_SMALLER
-            elif v2.startswith("."):
-                return cls._RIGHT_SMALLER
-
-            # If either of the remaining parts starts with a digit: numerical prefixes are compared
-            # numerically. Any leading zeroes are skipped. The numerical prefixes (until the first
-            # non-digit character) are evaluated as numbers. If one of the prefixes is empty, it
-            # evaluates as 0. If the numbers are different, the string with the bigger number
-            # compares higher. Otherwise, the comparison continues at the following characters at
-            # point 1.
-
-            v1_digit_prefix = digit_prefix(v1)
-            v2_digit_prefix = digit_prefix(v2)
-
-            if v1_digit_prefix or v2_digit_prefix:
-                v1_digits = int(v1_digit_prefix) if v1_digit_prefix else 0
-                v2_digits = int(v2_digit_prefix) if v2_digit_prefix else 0
-
-                if v1_digits < v2_digits:
-                    return cls._LEFT_SMALLER
-                elif v1_digits > v2_digits:
-                    return cls._RIGHT_SMALLER
-
-                v1 = v1.removeprefix(v1_digit_prefix)
-                v2 = v2.removeprefix(v2_digit_prefix)
-                continue
-
-            # Leading alphabetical prefixes are compared alphabetically. The substrings are
-            # compared letter-by-letter. If both letters are the same, the comparison continues
-            # with the next letter. Capital letters compare lower than lower-case letters (A <
-            # a). When the end of one substring has been reached (a non-letter character or the end
-            # of the whole string), if the other substring has remaining letters, it compares
-            # higher. Otherwise, the comparison continues at the following characters at point 1.
-
-            v1_letter_prefix = letter_prefix(v1)
-            v2_letter_prefix = letter_prefix(v2)
-
-            if v1_letter_prefix < v2_letter_prefix:
-                return cls._LEFT_SMALLER
-            elif v1_letter_prefix > v2_letter_prefix:
-                return cls._RIGHT_SMALLER
-
-            v1 = v1.removeprefix(v1_letter_prefix)
-            v2 = v2.removeprefix(v2_letter_prefix)
+        k1 = version_key(v1)
+        k2 = version_key(v2)
 
-    def __eq__(self, other: object) -> bool:
+        if k1 < k2:
+            return cls._LEFT_SMALLER
+        elif k1 > k2:
+            return cls._RIGHT_SMALLER
+
+        return cls._EQUAL
+
+    @property
+    def key(self) -> VersionKey:
+        return self._key
+
+    @staticmethod
+    def _coerce(other: object) -> "Union[GenericVersion, None]":
+        if isinstance(other, GenericVersion):
+            return other
         if isinstance(other, (str, int)):
-            other = GenericVersion(str(other))
-        elif not isinstance(other, GenericVersion):
+            return GenericVersion(str(other))
+        return None
+
+    def __eq__(self, other: object) -> bool:
+        if (o := self._coerce(other)) is None:
             return False
-        return self.compare_versions(self._version, other._version) == self._EQUAL
+        return self._key == o._key
 
     def __ne__(self, other: object) -> bool:
-        if isinstance(other, (str, int)):
-            other = GenericVersion(str(other))
-        elif not isinstance(other, GenericVersion):
+        if (o := self._coerce(other)) is None:
             return False
-        return self.compare_versions(self._version, other._version) != self._EQUAL
+        return self._key != o._key
 
     def __lt__(self, other: object) -> bool:
-        if isinstance(other, (str, int)):
-            other = GenericVersion(str(other))
-        elif not isinstance(other, GenericVersion):
+        if (o := self._coerce(other)) is None:
             return False
-        return self.compare_versions(self._version, other._version) == self._LEFT_SMALLER
+        return self._key < o._key
 
     def __le__(self, other: object) -> bool:
-        if isinstance(other, (str, int)):
-            other = GenericVersion(str(other))
-        elif not isinstance(other, GenericVersion):
+        if (o := self._coerce(other)) is None:
             return False
-        return self.compare_versions(self._version, other._version) in (self._EQUAL, self._LEFT_SMALLER)
+        return self._key <= o._key
 
     def __gt__(self, other: object) -> bool:
-        if isinstance(other, (str, int)):
-            other = GenericVersion(str(other))
-        elif not isinstance(other, GenericVersion):
+        if (o := self._coerce(other)) is None:
             return False
-        return self.compare_versions(self._version, other._version) == self._RIGHT_SMALLER
+        return self._key > o._key
 
     def __ge__(self, other: object) -> bool:
-        if isinstance(other, (str, int)):
-            other = GenericVersion(str(other))
-        elif not isinstance(other, GenericVersion):
+        if (o := self._coerce(other)) is None:
             return False
-        return self.compare_versions(self._version, other._version) in (self._EQUAL, self._RIGHT_SMALLER)
+        return self._key >= o._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
 
     def __str__(self) -> str:
         return self._version
@@ -1,6 +1,8 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import contextlib
 import os
+import pty
 import sys
 import tempfile
 from collections.abc import Iterator, Sequence
@@ -102,6 +104,21 @@ class Image:
         return self.mkosi("genkey", ["--force"], user=INVOKING_USER.uid, group=INVOKING_USER.gid)
 
 
+@contextlib.contextmanager
+def stderr_on_pty() -> Iterator[None]:
+    """Connect stderr to a pseudo terminal, like it is when mkosi is run interactively."""
+    master, slave = pty.openpty()
+    saved = os.dup(2)
+
+    try:
+        os.dup2(slave, 2)
+        yield
+    finally:
+        os.dup2(saved, 2)
+        for fd in (saved, slave, master):
+            os.close(fd)
+
+
 @pytest.fixture(scope="session", autouse=True)
 def suspend_capture_stdin(pytestconfig: Any) -> Iterator[None]:
     """
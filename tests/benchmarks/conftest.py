@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import dataclasses
+import gc
+import json
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, Optional, TypeVar
+
+import pytest
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+T = TypeVar("T")
+
+
+@dataclasses.dataclass(frozen=True)
+class BenchmarkResult:
+    # Fastest of all rounds in seconds.
+    time: float
+    # The time relative to the calibration workload, which is what is compared against the baseline so that
+    # the baseline can be used on other machines.
+    relative: float
+    # Peak memory allocated by Python in bytes while running the benchmark once.
+    memory: int
+
+
+RESULTS: dict[str, BenchmarkResult] = {}
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--benchmark-save",
+        action="store_true",
+        default=False,
+        help="Store the benchmark results as the new baseline",
+    )
+    parser.addoption(
+        "--benchmark-max-regression",
+        type=float,
+        default=None,
+        help="Fail benchmarks that are slower than the baseline by more than this factor (e.g. 0.5 for 50%%)",
+    )
+
+
+def calibrate() -> float:
+    """
+    Measure how long a fixed pure Python workload takes on this machine right now. This is measured alongside
+    every benchmark so that changes in the load of the machine affect both measurements alike.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    d: dict[str, list[int]] = {}
+    for i in range(100000):
+        d[str(i)] = sorted((i % 7, i % 5, i % 3))
+
+    return time.perf_counter() - start
+
+
+def load_baseline() -> dict[str, BenchmarkResult]:
+    if not BASELINE.exists():
+        return {}
+
+    return {name: BenchmarkResult(**result) for name, result in json.loads(BASELINE.read_text()).items()}
+
+
+class Benchmark:
+    def __init__(self, name: str, max_regression: Optional[float]) -> None:
+        self.name = name
+        self.max_regression = max_regression
+
+    def __call__(self, func: Callable[..., T], *args: Any, rounds: int = 5, **kwargs: Any) -> T:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = func(*args, **kwargs)
+            _, memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        times = []
+        calibration = []
+        for _ in range(rounds):
+            calibration.append(calibrate())
+            gc.collect()
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+
+        RESULTS[self.name] = new = BenchmarkResult(
+            time=min(times),
+            relative=min(times) / min(calibration),
+            memory=memory,
+        )
+
+        old = load_baseline().get(self.name)
+        if old and self.max_regression is not None and new.relative > old.relative * (1 + self.max_regression):
+            pytest.fail(
+                f"{self.name} took {new.relative:.3f}x the calibration workload, baseline is {old.relative:.3f}x"
+            )
+
+        return result
+
+
+@pytest.fixture
+def benchmark(request: pytest.FixtureRequest) -> Benchmark:
+    return Benchmark(request.node.name, request.config.getoption("--benchmark-max-regression", default=None))
+
+
+def pytest_terminal_summary(terminalreporter: Any, config: pytest.Config) -> None:
+    if not RESULTS:
+        return
+
+    baseline = load_baseline()
+
+    terminalreporter.section("benchmarks")
+    terminalreporter.write_line(
+        f"{'NAME':<40} {'TIME':>10} {'RELATIVE':>10} {'BASELINE':>10} {'MEMORY':>10} {'BASELINE':>10}"
+    )
+
+    for name, result in sorted(RESULTS.items()):
+        old = baseline.get(name)
+        terminalreporter.write_line(
+            f"{name:<40} {result.time:>9.3f}s {result.relative:>9.3f}x {f'{old.relative:.3f}x' if old else '-':>10} "
+            f"{result.memory // 1024:>8}K {f'{old.memory // 1024}K' if old else '-':>10}"
+        )
+
+    if config.getoption("--benchmark-save", default=False):
+        BASELINE.write_text(
+            json.dumps({**{k: dataclasses.asdict(v) for k, v in baseline.items()},
+                        **{k: dataclasses.asdict(v) for k, v in RESULTS.items()}},
+                       indent=4, sort_keys=True) + "\n"
+        )
+        terminalreporter.write_line(f"Baseline written to {BASELINE}")
@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import dataclasses
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from mkosi.config import MkosiConfig, parse_config
+from mkosi.distributions import Distribution
+from mkosi.kmod import resolve_module_dependencies
+from mkosi.manifest import Manifest, RpmTag
+from mkosi.util import chdir
+from mkosi.versioncomp import GenericVersion, version_key
+from tests.benchmarks.conftest import Benchmark
+from tests.test_kmod import make_module
+from tests.test_manifest import make_dpkg_status, make_rpmdb
+
+pytestmark = pytest.mark.benchmark
+
+KVER = "6.6.0"
+
+
+@pytest.fixture(scope="module")
+def config_tree(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    d = tmp_path_factory.mktemp("config")
+
+    (d / "mkosi.conf").write_text(
+        """\
+        [Distribution]
+        Distribution=fedora
+        Release=39
+
+        [Content]
+        Packages=systemd
+        """.replace("        ", "")
+    )
+
+    (d / "include").mkdir()
+    for i in range(50):
+        (d / "include" / f"{i:02}.conf").write_text(f"[Content]\nPackages=include-{i}\nEnvironment=INCLUDE{i}=1\n")
+
+    (d / "mkosi.conf.d").mkdir()
+    for i in range(300):
+        (d / "mkosi.conf.d" / f"{i:03}.conf").write_text(
+            "[Match]\n"
+            f"Distribution={'fedora' if i % 2 else 'debian'}\n"
+            "\n"
+            "[Config]\n"
+            f"Include={d / 'include' / f'{i % 50:02}.conf'}\n"
+            "\n"
+            "[Content]\n"
+            f"Packages=package-{i}\n"
+            f"          other-package-{i}\n"
+            f"RemoveFiles=/usr/share/doc/{i}\n"
+            f"Environment=VAR{i}={i}\n"
+        )
+
+    return d
+
+
+@pytest.fixture(scope="module")
+def modules_tree(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    root = tmp_path_factory.mktemp("modules")
+    modulesd = root / "usr/lib/modules" / KVER
+    rng = random.Random(0)
+
+    for i in range(6000):
+        depends = ",".join(f"mod{j}" for j in rng.sample(range(i), min(i, rng.randint(0, 3))))
+        make_module(
+            modulesd / f"kernel/drivers/sub{i % 60}/mod{i}.ko",
+            [f"name=mod{i}", f"depends={depends}", f"firmware=fw/mod{i}.bin"],
+        )
+
+    (modulesd / "modules.builtin").write_text("")
+    (root / "usr/lib/firmware/fw").mkdir(parents=True)
+    for i in range(0, 6000, 3):
+        (root / "usr/lib/firmware/fw" / f"mod{i}.bin").write_text("")
+
+    return root
+
+
+def versions() -> list[str]:
+    rng = random.Random(0)
+    versions = []
+
+    for _ in range(3000):
+        version = ".".join(str(rng.randint(0, 20)) for _ in range(rng.randint(1, 4)))
+        version += rng.choice(["", "~rc1", "-1", "^git", "a", "-2.fc39", "+b1"])
+        versions.append(version)
+
+    return versions
+
+
+def test_parse_config(benchmark: Benchmark, config_tree: Path) -> None:
+    def parse() -> tuple[MkosiConfig, ...]:
+        with chdir(config_tree):
+            _, configs = parse_config([])
+
+        return configs
+
+    [config] = benchmark(parse)
+    # Only the fedora drop-ins match and each include is only parsed once.
+    assert len(config.packages) == 1 + 150 * 2 + 25
+
+
+def test_import_time(benchmark: Benchmark) -> None:
+    def start() -> list[str]:
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import mkosi.__main__"],
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        ).stderr.splitlines()
+
+    modules = {line.rpartition("|")[2].strip() for line in benchmark(start)}
+    assert "mkosi.config" in modules
+    # These are only needed by specific verbs and should only be imported when those verbs are executed.
+    for module in ("asyncio", "mkosi.burn", "mkosi.installer", "mkosi.kmod", "mkosi.manifest", "mkosi.qemu"):
+        assert module not in modules
+
+
+def test_compare_versions(benchmark: Benchmark) -> None:
+    vs = versions()
+
+    def sort() -> list[str]:
+        # Make sure we measure parsing the versions as well and not just the comparisons.
+        version_key.cache_clear()
+        return sorted(vs, key=GenericVersion)
+
+    result = benchmark(sort)
+    assert len(result) == len(vs)
+
+
+def test_resolve_module_dependencies(benchmark: Benchmark, modules_tree: Path) -> None:
+    mods, firmware = benchmark(resolve_module_dependencies, modules_tree, KVER, ["mod5999", "mod4000", "mod10"])
+    assert mods
+    assert firmware
+
+
+def test_resolve_module_dependencies_cached(
+    benchmark: Benchmark,
+    modules_tree: Path,
+    tmp_path: Path,
+) -> None:
+    resolve_module_dependencies(modules_tree, KVER, ["mod5999"], tmp_path)
+    mods, _ = benchmark(resolve_module_dependencies, modules_tree, KVER, ["mod5999"], tmp_path)
+    assert mods
+
+
+def record_packages(benchmark: Benchmark, distribution: Distribution, root: Path) -> Manifest:
+    config = dataclasses.replace(MkosiConfig.default(), distribution=distribution)
+
+    def record() -> Manifest:
+        manifest = Manifest(config)
+        manifest.record_packages(root)
+        return manifest
+
+    return benchmark(record)
+
+
+def test_record_rpm_packages(benchmark: Benchmark, tmp_path: Path) -> None:
+    make_rpmdb(tmp_path / "usr/lib/sysimage/rpm", [
+        {
+            RpmTag.NAME: f"package{i}",
+            RpmTag.VERSION: f"1.{i}",
+            RpmTag.RELEASE: "1.fc39",
+            RpmTag.ARCH: "x86_64",
+            RpmTag.SOURCERPM: f"source{i // 3}-1.{i}-1.fc39.src.rpm",
+            RpmTag.INSTALLTIME: i,
+            RpmTag.SIZE: i * 1024,
+        }
+        for i in range(3000)
+    ])
+    manifest = record_packages(benchmark, Distribution.fedora, tmp_path)
+    assert len(manifest.packages) == 3000
+
+
+def test_record_deb_packages(benchmark: Benchmark, tmp_path: Path) -> None:
+    make_dpkg_status(tmp_path / "var/lib/dpkg", [
+        f"Package: package{i}\nStatus: install ok installed\nArchitecture: amd64\nSource: source{i // 3}\n"
+        f"Version: 1.{i}-1\nInstalled-Size: {i}\nDescription: package {i}\n Long description.\n"
+        for i in range(3000)
+    ])
+    manifest = record_packages(benchmark, Distribution.debian, tmp_path)
+    assert len(manifest.packages) == 3000
@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import fcntl
+import os
+import shutil
+import subprocess
+from collections.abc import Sequence
+from pathlib import Path
+
+import pytest
+
+from mkosi.config import parse_config
+from mkosi.installer import apt
+from mkosi.run import run
+from mkosi.state import MkosiState
+from mkosi.types import PathString
+
+pytestmark = pytest.mark.skipif(not shutil.which("apt-get"), reason="apt-get is not installed")
+
+
+def make_repo(path: Path, package: str) -> None:
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "Packages").write_text(
+        f"Package: {package}\nVersion: 1.0\nArchitecture: all\nFilename: ./{package}_1.0_all.deb\nSize: 1\n"
+        "Description: test\n\n"
+    )
+    (path / "Release").write_text("Origin: mkosi\nLabel: mkosi\nSuite: test\nArchitectures: amd64 all\n")
+
+
+def make_state(tmp_path: Path, name: str, repo: Path, *args: str) -> MkosiState:
+    (tmp_path / name).mkdir()
+    parsed, [config] = parse_config(["--distribution", "debian", "--cache-dir", os.fspath(tmp_path / "cache"), *args])
+    state = MkosiState(parsed, config, tmp_path / name)
+    apt.setup_apt(state, [f"deb [trusted=yes] file://{repo} ./"])
+    return state
+
+
+def test_update_apt_metadata(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    updates = []
+
+    # bubblewrap is not needed to test against a local repository, so run apt directly.
+    def invoke_apt(
+        state: MkosiState,
+        command: str,
+        operation: str,
+        packages: Sequence[str] = (),
+        apivfs: bool = True,
+    ) -> None:
+        updates.append(state.workspace.name)
+        run([*apt.apt_cmd(state, command), operation, *packages], stdout=subprocess.DEVNULL)
+
+    monkeypatch.setattr(apt, "invoke_apt", invoke_apt)
+
+    make_repo(tmp_path / "repo", "foo")
+    make_repo(tmp_path / "other", "bar")
+
+    image = make_state(tmp_path, "image", tmp_path / "repo")
+    initrd = make_state(tmp_path, "initrd", tmp_path / "repo")
+    other = make_state(tmp_path, "other-image", tmp_path / "other")
+
+    apt.update_apt_metadata(image)
+    apt.update_apt_metadata(image)
+    # The metadata is shared between images with the same repositories.
+    apt.update_apt_metadata(initrd)
+    apt.update_apt_metadata(other)
+
+    assert updates == ["image", "other-image"]
+    assert apt.apt_lists_dir(image) == apt.apt_lists_dir(initrd) != apt.apt_lists_dir(other)
+    assert "Package: foo" in run([*apt.apt_cmd(initrd, "apt-cache"), "show", "foo"], stdout=subprocess.PIPE).stdout
+
+    # Metadata downloaded by a previous invocation is only reused if it is younger than the configured max age.
+    monkeypatch.setattr(apt, "SESSION_START", apt.SESSION_START + 60)
+    apt.update_apt_metadata(make_state(tmp_path, "cached", tmp_path / "repo", "--repository-metadata-max-age", "1h"))
+    assert updates == ["image", "other-image"]
+
+    apt.update_apt_metadata(initrd)
+    assert updates == ["image", "other-image", "initrd"]
+
+
+def test_invoke_apt_locks_cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    locked = []
+
+    def bwrap(cmd: Sequence[PathString], **kwargs: object) -> None:
+        fd = os.open(tmp_path / "cache", os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            locked.append(True)
+        finally:
+            os.close(fd)
+
+    monkeypatch.setattr(apt, "bwrap", bwrap)
+
+    make_repo(tmp_path / "repo", "foo")
+    state = make_state(tmp_path, "image", tmp_path / "repo")
+
+    # Images built in parallel share the package cache, so only one package manager may use it at a time.
+    apt.invoke_apt(state, "apt-get", "install", ["foo"])
+    assert locked == [True]
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import gzip
+import hashlib
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from mkosi.archive import compressed_writer, make_cpio, write_cpio
+from mkosi.config import Compression
+
+
+def parse_cpio(data: bytes) -> list[tuple[str, dict[str, int], bytes]]:
+    fields = ("ino", "mode", "uid", "gid", "nlink", "mtime", "size", "devmajor", "devminor", "rdevmajor",
+              "rdevminor", "namesize", "check")
+    entries = []
+    offset = 0
+
+    while True:
+        assert data[offset:offset + 6] == b"070701"
+        header = {
+            f: int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16)
+            for i, f in enumerate(fields)
+        }
+        offset += 110
+        name = data[offset:offset + header["namesize"] - 1].decode()
+        offset += header["namesize"]
+        offset += -offset % 4
+        content = data[offset:offset + header["size"]]
+        offset += header["size"]
+        offset += -offset % 4
+
+        if name == "TRAILER!!!":
+            break
+
+        entries.append((name, header, content))
+
+    assert len(data) % 512 == 0
+    assert not data[offset:].strip(b"\0")
+
+    return entries
+
+
+@pytest.mark.parametrize("compression", [Compression.none, Compression.gz])
+def test_make_cpio(tmp_path: Path, compression: Compression) -> None:
+    root = tmp_path / "root"
+    (root / "usr/lib").mkdir(parents=True)
+    (root / "usr/lib/abc").write_text("abc")
+    os.link(root / "usr/lib/abc", root / "usr/lib/def")
+    (root / "usr/lib/link").symlink_to("abc")
+    (root / "usr/lib/empty").touch()
+    os.mkfifo(root / "fifo")
+    os.utime(root / "usr/lib/empty", (100, 100))
+
+    make_cpio(root, tmp_path / "archive.cpio", compression=compression, mtime=200)
+
+    data = (tmp_path / "archive.cpio").read_bytes()
+    if compression == Compression.gz:
+        data = gzip.decompress(data)
+
+    entries = {name: (header, content) for name, header, content in parse_cpio(data)}
+
+    assert list(entries) == ["fifo", "usr", "usr/lib", "usr/lib/abc", "usr/lib/def", "usr/lib/empty", "usr/lib/link"]
+    assert all(header["mtime"] <= 200 for header, _ in entries.values())
+    assert entries["usr/lib/empty"][0]["mtime"] == 100
+    assert entries["usr/lib/link"][1] == b"abc"
+
+    # The data of hardlinked files is only stored with the last link.
+    abc, abcdata = entries["usr/lib/abc"]
+    defh, defdata = entries["usr/lib/def"]
+    assert abc["ino"] == defh["ino"]
+    assert abc["nlink"] == defh["nlink"] == 2
+    assert (abc["size"], abcdata) == (0, b"")
+    assert (defh["size"], defdata) == (3, b"abc")
+
+    assert len({header["ino"] for header, _ in entries.values()}) == len(entries) - 1
+    assert all(header["devmajor"] == header["devminor"] == 0 for header, _ in entries.values())
+
+
+def test_make_cpio_files(tmp_path: Path) -> None:
+    (tmp_path / "a").write_text("a")
+    (tmp_path / "b").write_text("b")
+
+    make_cpio(tmp_path, tmp_path / "archive.cpio", [tmp_path / "b"])
+
+    assert [name for name, _, _ in parse_cpio((tmp_path / "archive.cpio").read_bytes())] == ["b"]
+
+
+
+def test_make_cpio_out_of_range(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    # Sparse, so this doesn't actually take up any disk space.
+    with (tmp_path / "big").open("wb") as f:
+        f.truncate(4 * 1024**3)
+
+    with pytest.raises(SystemExit):
+        write_cpio(io.BytesIO(), tmp_path, [tmp_path / "big"])
+
+    assert f"{tmp_path / 'big'} to cpio archive: its size 4294967296" in caplog.text
+
+    (tmp_path / "old").touch()
+    os.utime(tmp_path / "old", (-1, -1))
+
+    with pytest.raises(SystemExit):
+        write_cpio(io.BytesIO(), tmp_path, [tmp_path / "old"])
+
+    assert f"{tmp_path / 'old'} to cpio archive: its mtime -1" in caplog.text
+
+@pytest.mark.parametrize("compression", [Compression.none, Compression.gz])
+def test_compressed_writer(tmp_path: Path, compression: Compression) -> None:
+    digests: dict[Path, str] = {}
+
+    with compressed_writer(tmp_path / "out", compression, digests) as f:
+        f.write(b"abc" * 1024)
+
+    data = (tmp_path / "out").read_bytes()
+    assert digests == {tmp_path / "out": hashlib.sha256(data).hexdigest()}
+
+    if compression == Compression.gz:
+        data = gzip.decompress(data)
+
+    assert data == b"abc" * 1024
@@ -2,9 +2,11 @@
 
 import argparse
 import itertools
+import json
 import logging
 import operator
 import os
+from collections.abc import Sequence
 from pathlib import Path
 from typing import Optional
 
@@ -12,14 +14,20 @@ import pytest
 
 from mkosi.architecture import Architecture
 from mkosi.config import (
+    CacheLayer,
     Compression,
     ConfigFeature,
     ConfigTree,
+    MkosiArgs,
     MkosiConfig,
+    MkosiJsonEncoder,
     OutputFormat,
     Verb,
+    cache_manifest_key,
     config_parse_bytes,
+    config_parse_seconds,
     parse_config,
+    parse_config_cached,
     parse_ini,
 )
 from mkosi.distributions import Distribution
@@ -708,6 +716,21 @@ def test_config_parse_bytes() -> None:
         config_parse_bytes("-4G")
 
 
+def test_config_parse_seconds() -> None:
+    assert config_parse_seconds(None) is None
+    assert config_parse_seconds("0") == 0
+    assert config_parse_seconds("90") == 90
+    assert config_parse_seconds("90s") == 90
+    assert config_parse_seconds("5m") == 300
+    assert config_parse_seconds("2h") == 7200
+    assert config_parse_seconds("1d") == 86400
+
+    with pytest.raises(SystemExit):
+        config_parse_seconds("-1h")
+    with pytest.raises(SystemExit):
+        config_parse_seconds("1w")
+
+
 def test_specifiers(tmp_path: Path) -> None:
     d = tmp_path
 
@@ -753,3 +776,143 @@ def test_specifiers(tmp_path: Path) -> None:
 
 def test_deterministic() -> None:
     assert MkosiConfig.default() == MkosiConfig.default()
+
+
+def test_cache_key(tmp_path: Path) -> None:
+    d = tmp_path
+
+    (d / "pkgmngr/etc").mkdir(parents=True)
+    (d / "pkgmngr/etc/repo.conf").write_text("a")
+
+    with chdir(d):
+        _, [config] = parse_config(["--package", "abc", "--package-manager-tree", "pkgmngr"])
+        key = config.cache_key()
+
+        assert parse_config(["--package", "abc", "--package-manager-tree", "pkgmngr"])[1][0].cache_key() == key
+        assert parse_config(["--package", "def", "--package-manager-tree", "pkgmngr"])[1][0].cache_key() != key
+
+        (d / "pkgmngr/etc/repo.conf").write_text("b")
+        assert config.cache_key() != key
+
+
+def test_cache_layer_key(tmp_path: Path) -> None:
+    d = tmp_path
+
+    (d / "mkosi.prepare").write_text("#!/bin/sh\necho a\n")
+    (d / "mkosi.prepare").chmod(0o755)
+
+    with chdir(d):
+        _, [config] = parse_config(["--package", "abc", "--build-package", "def"])
+        install = config.cache_key(CacheLayer.install)
+        prepare = config.cache_key(CacheLayer.prepare)
+        build = config.cache_key(CacheLayer.build)
+
+        assert len({install, prepare, build}) == 3
+
+        # The key of a manifest that was read back from disk matches the key of the manifest it was written from.
+        manifest = json.loads(json.dumps(config.cache_manifest(CacheLayer.build), cls=MkosiJsonEncoder))
+        assert cache_manifest_key(manifest) == build
+
+        (d / "mkosi.prepare").write_text("#!/bin/sh\necho b\n")
+        assert config.cache_key(CacheLayer.install) == install
+        assert config.cache_key(CacheLayer.prepare) != prepare
+        assert config.cache_key(CacheLayer.build) != build
+
+
+def test_parse_config_cached(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    d = tmp_path / "config"
+    d.mkdir()
+    monkeypatch.setenv("XDG_CACHE_HOME", os.fspath(tmp_path / "cache"))
+
+    (d / "mkosi.conf").write_text(
+        """\
+        [Distribution]
+        Distribution=fedora
+
+        [Content]
+        Packages=abc
+        """
+    )
+    (d / "mkosi.conf.d").mkdir()
+    (d / "mkosi.conf.d/10-abc.conf").write_text("[Content]\nPackages=def\n")
+
+    with chdir(d):
+        expected = parse_config(["--environment", "A=B"])
+        assert parse_config_cached(["--environment", "A=B"]) == expected
+
+        calls = 0
+
+        def parse(argv: list[str]) -> None:
+            nonlocal calls
+            calls += 1
+            raise AssertionError("Configuration should have been loaded from the cache")
+
+        with monkeypatch.context() as m:
+            m.setattr("mkosi.config.parse_config", parse)
+            assert parse_config_cached(["--environment", "A=B"]) == expected
+
+        # Adding a new drop-in invalidates the cache.
+        (d / "mkosi.conf.d/20-ghi.conf").write_text("[Content]\nPackages=ghi\n")
+        _, [config] = parse_config_cached(["--environment", "A=B"])
+        assert config.packages == ["abc", "def", "ghi"]
+
+        # So does modifying an existing one.
+        (d / "mkosi.conf.d/10-abc.conf").write_text("[Content]\nPackages=jkl\n")
+        _, [config] = parse_config_cached(["--environment", "A=B"])
+        assert config.packages == ["abc", "jkl", "ghi"]
+
+        # And adding a file that was looked for but didn't exist yet.
+        (d / "mkosi.local.conf").write_text("[Content]\nPackages=mno\n")
+        _, [config] = parse_config_cached(["--environment", "A=B"])
+        assert config.packages == ["mno", "abc", "jkl", "ghi"]
+
+    # The cache might contain secrets so it should only be accessible by us.
+    for p in (tmp_path / "cache/mkosi/config").iterdir():
+        assert p.stat().st_mode & 0o077 == 0
+
+
+def test_parse_config_cached_environ(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    d = tmp_path / "config"
+    d.mkdir()
+    monkeypatch.setenv("XDG_CACHE_HOME", os.fspath(tmp_path / "cache"))
+    monkeypatch.setenv("MKOSI_TEST_PACKAGE", "abc")
+    monkeypatch.setenv("MKOSI_TEST_UNUSED", "abc")
+
+    (d / "mkosi.conf").write_text("[Content]\nEnvironment=MKOSI_TEST_PACKAGE\n")
+
+    with chdir(d):
+        _, [config] = parse_config_cached()
+        assert config.environment["MKOSI_TEST_PACKAGE"] == "abc"
+
+        def parse(argv: list[str]) -> None:
+            raise AssertionError("Configuration should have been loaded from the cache")
+
+        # Environment variables that aren't looked at while parsing the configuration don't invalidate the cache.
+        monkeypatch.setenv("MKOSI_TEST_UNUSED", "def")
+        with monkeypatch.context() as m:
+            m.setattr("mkosi.config.parse_config", parse)
+            assert parse_config_cached()[1][0] == config
+
+        # But the ones that are do.
+        monkeypatch.setenv("MKOSI_TEST_PACKAGE", "def")
+        _, [config] = parse_config_cached()
+        assert config.environment["MKOSI_TEST_PACKAGE"] == "def"
+
+        # Cache files that somebody else could have written are never loaded.
+        [cache] = (tmp_path / "cache/mkosi/config").glob("*.pickle")
+        cache.chmod(0o666)
+        calls = []
+
+        def record(argv: Sequence[str]) -> tuple[MkosiArgs, tuple[MkosiConfig, ...]]:
+            calls.append(argv)
+            return parse_config(argv)
+
+        with monkeypatch.context() as m:
+            m.setattr("mkosi.config.parse_config", record)
+            assert parse_config_cached()[1][0] == config
+            assert len(calls) == 1
+
+        # Loading an entry from the cache marks it as recently used.
+        os.utime(cache, (0, 0))
+        parse_config_cached()
+        assert cache.stat().st_mtime > 0
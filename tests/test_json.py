@@ -47,8 +47,10 @@ def test_args(path: Optional[Path]) -> None:
             "Force": 9001,
             "GenkeyCommonName": "test",
             "GenkeyValidDays": "100",
+            "Jobs": 4,
             "Json": false,
             "Pager": true,
+            "Trace": true,
             "Verb": "build"
         }}
         """
@@ -65,8 +67,10 @@ def test_args(path: Optional[Path]) -> None:
         force = 9001,
         genkey_common_name = "test",
         genkey_valid_days = "100",
+        jobs = 4,
         json = False,
         pager = True,
+        trace = True,
         verb = Verb.build,
     )
 
@@ -130,6 +134,8 @@ def test_config() -> None:
             ],
             "Include": [],
             "Incremental": false,
+            "IncrementalCacheSize": 4294967296,
+            "IncrementalOverlay": true,
             "InitrdPackages": [
                 "clevis"
             ],
@@ -179,6 +185,8 @@ def test_config() -> None:
                     "target": null
                 }
             ],
+            "PackagePoolDirectory": "/is/this/the/pool",
+            "PackagePoolSize": 8589934592,
             "Packages": [],
             "Passphrase": null,
             "PostInstallationScripts": [
@@ -221,6 +229,7 @@ def test_config() -> None:
             "RepartDirectories": [],
             "Repositories": [],
             "RepositoryKeyCheck": false,
+            "RepositoryMetadataMaxAge": 3600,
             "RootPassword": [
                 "test1234",
                 false
@@ -309,6 +318,8 @@ def test_config() -> None:
         images = ("default", "initrd"),
         include = tuple(),
         incremental = False,
+        incremental_cache_size = 4294967296,
+        incremental_overlay = True,
         initrd_packages = ["clevis"],
         initrds = [Path("/efi/initrd1"), Path("/efi/initrd2")],
         kernel_command_line = [],
@@ -334,6 +345,8 @@ def test_config() -> None:
         output_format = OutputFormat.uki,
         overlay = True,
         package_manager_trees = [ConfigTree(Path("/foo/bar"), None)],
+        package_pool_dir = Path("/is/this/the/pool"),
+        package_pool_size = 8589934592,
         packages = [],
         passphrase = None,
         postinst_scripts = [Path("/bar/qux")],
@@ -357,6 +370,7 @@ def test_config() -> None:
         repart_dirs = [],
         repositories = [],
         repository_key_check = False,
+        repository_metadata_max_age = 3600,
         root_password = ("test1234", False),
         root_shell = "/bin/tcsh",
         runtime_size = 8589934592,
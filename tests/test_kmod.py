@@ -0,0 +1,253 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import gzip
+import json
+import lzma
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from mkosi.kmod import (
+    elf_section,
+    gen_required_kernel_modules,
+    index_tree,
+    lookup_firmware,
+    modinfo,
+    process_kernel_modules,
+    resolve_module_dependencies,
+)
+
+
+def make_elf(sections: dict[str, bytes], bits: int = 64, endian: str = "<") -> bytes:
+    shstrtab = b"\0"
+    names = {}
+    for name in [*sections, ".shstrtab"]:
+        names[name] = len(shstrtab)
+        shstrtab += name.encode() + b"\0"
+
+    contents = {**sections, ".shstrtab": shstrtab}
+    ehsize = 64 if bits == 64 else 52
+    shentsize = 64 if bits == 64 else 40
+
+    data = b""
+    offsets = {}
+    for name, content in contents.items():
+        offsets[name] = ehsize + len(data)
+        data += content
+
+    shoff = ehsize + len(data)
+    shnum = len(contents) + 1
+
+    ident = b"\x7fELF" + bytes([2 if bits == 64 else 1, 1 if endian == "<" else 2, 1]) + bytes(9)
+    if bits == 64:
+        header = ident + struct.pack(f"{endian}HHIQQQIHHHHHH", 1, 62, 1, 0, 0, shoff, 0, ehsize, 0, 0, shentsize,
+                                     shnum, shnum - 1)
+    else:
+        header = ident + struct.pack(f"{endian}HHIIIIIHHHHHH", 1, 3, 1, 0, 0, shoff, 0, ehsize, 0, 0, shentsize,
+                                     shnum, shnum - 1)
+
+    shdrs = bytes(shentsize)
+    for name, content in contents.items():
+        if bits == 64:
+            shdrs += struct.pack(f"{endian}IIQQQQIIQQ", names[name], 1, 0, 0, offsets[name], len(content), 0, 0, 1, 0)
+        else:
+            shdrs += struct.pack(f"{endian}IIIIIIIIII", names[name], 1, 0, 0, offsets[name], len(content), 0, 0, 1, 0)
+
+    return header + data + shdrs
+
+
+def make_module(path: Path, info: list[str]) -> None:
+    data = make_elf({".text": b"\0" * 16, ".modinfo": b"".join(i.encode() + b"\0" for i in info)})
+
+    if path.suffix == ".xz":
+        data = lzma.compress(data)
+    elif path.suffix == ".gz":
+        data = gzip.compress(data)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+@pytest.mark.parametrize("bits,endian", [(64, "<"), (64, ">"), (32, "<"), (32, ">")])
+def test_elf_section(bits: int, endian: str) -> None:
+    data = make_elf({".modinfo": b"name=foo\0", ".other": b"abc"}, bits=bits, endian=endian)
+    assert elf_section(data, ".modinfo") == b"name=foo\0"
+    assert elf_section(data, ".other") == b"abc"
+    assert elf_section(data, ".missing") is None
+    assert elf_section(b"not an elf file", ".modinfo") is None
+
+
+def test_modinfo(tmp_path: Path) -> None:
+    for suffix in (".ko", ".ko.xz", ".ko.gz"):
+        make_module(tmp_path / f"foo{suffix}", ["name=foo", "depends=bar,baz", "firmware=foo/fw.bin"])
+        assert modinfo(tmp_path / f"foo{suffix}") == [
+            ("name", "foo"),
+            ("depends", "bar,baz"),
+            ("firmware", "foo/fw.bin"),
+        ]
+
+
+def test_resolve_module_dependencies(tmp_path: Path) -> None:
+    kver = "6.6.0"
+    modulesd = tmp_path / "usr/lib/modules" / kver
+    firmwared = tmp_path / "usr/lib/firmware"
+
+    make_module(modulesd / "kernel/drivers/a.ko.xz", ["name=a", "depends=b_c", "softdep=pre: d post: e"])
+    make_module(modulesd / "kernel/drivers/b-c.ko.gz", ["name=b_c", "depends=", "firmware=b/fw.bin"])
+    make_module(modulesd / "kernel/drivers/d.ko", ["name=d", "depends=builtin"])
+    make_module(modulesd / "kernel/drivers/e.ko", ["name=e", "depends="])
+    make_module(modulesd / "kernel/drivers/unused.ko", ["name=unused", "depends=", "firmware=unused.bin"])
+
+    (modulesd / "modules.builtin").write_text("kernel/builtin.ko\n")
+    (firmwared / "b").mkdir(parents=True)
+    (firmwared / "b/fw.bin.xz").write_text("")
+    (firmwared / "unused.bin").write_text("")
+
+    mods, firmware = resolve_module_dependencies(tmp_path, kver, ["a"])
+
+    assert mods == {
+        modulesd / "kernel/drivers/a.ko.xz",
+        modulesd / "kernel/drivers/b-c.ko.gz",
+        modulesd / "kernel/drivers/d.ko",
+        modulesd / "kernel/drivers/e.ko",
+    }
+    assert firmware == {firmwared / "b/fw.bin.xz"}
+
+
+@pytest.mark.skipif(not shutil.which("zstd"), reason="zstd is not installed")
+def test_resolve_module_dependencies_zstd(tmp_path: Path) -> None:
+    kver = "6.6.0"
+    modulesd = tmp_path / "usr/lib/modules" / kver
+
+    make_module(modulesd / "kernel/a.ko", ["name=a", "depends=b"])
+    make_module(modulesd / "kernel/b.ko", ["name=b", "depends="])
+    make_module(tmp_path / "other/a.ko", ["name=c", "depends="])
+    subprocess.run(
+        ["zstd", "--quiet", "--rm", modulesd / "kernel/a.ko", modulesd / "kernel/b.ko", tmp_path / "other/a.ko"],
+        check=True,
+    )
+    (modulesd / "modules.builtin").write_text("")
+
+    # Modules with the same file name in different directories must not be mixed up.
+    assert modinfo(modulesd / "kernel/a.ko.zst") == [("name", "a"), ("depends", "b")]
+    assert modinfo(tmp_path / "other/a.ko.zst") == [("name", "c"), ("depends", "")]
+
+    mods, _ = resolve_module_dependencies(tmp_path, kver, ["a"])
+    assert mods == {modulesd / "kernel/a.ko.zst", modulesd / "kernel/b.ko.zst"}
+
+
+def test_module_index_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    kver = "6.6.0"
+    root = tmp_path / "root"
+    cache = tmp_path / "cache"
+    modulesd = root / "usr/lib/modules" / kver
+
+    make_module(modulesd / "kernel/a.ko", ["name=a", "depends=b"])
+    make_module(modulesd / "kernel/b.ko", ["name=b", "depends=", "firmware=b.bin"])
+    (modulesd / "modules.builtin").write_text("")
+
+    mods, _ = resolve_module_dependencies(root, kver, ["a"], cache)
+    assert mods == {modulesd / "kernel/a.ko", modulesd / "kernel/b.ko"}
+
+    index = json.loads((cache / "kmod" / f"{kver}.json").read_text())
+    assert index["modules"] == {
+        "a": {"depends": ["b"], "firmware": []},
+        "b": {"depends": [], "firmware": ["b.bin"]},
+    }
+
+    def fail(*args: object) -> None:
+        raise AssertionError("module index was not loaded from the cache")
+
+    with monkeypatch.context() as m:
+        m.setattr("mkosi.kmod.module_index", fail)
+        assert resolve_module_dependencies(root, kver, ["a"], cache)[0] == mods
+
+    # Modifying a module invalidates the cached index.
+    make_module(modulesd / "kernel/a.ko", ["name=a", "depends="])
+    assert resolve_module_dependencies(root, kver, ["a"], cache)[0] == {modulesd / "kernel/a.ko"}
+
+
+def test_process_kernel_modules(tmp_path: Path) -> None:
+    kver = "6.6.0"
+    modulesd = tmp_path / "usr/lib/modules" / kver
+    firmwared = tmp_path / "usr/lib/firmware"
+
+    make_module(modulesd / "kernel/drivers/a.ko", ["name=a", "depends=b", "firmware=a.bin"])
+    make_module(modulesd / "kernel/drivers/b.ko", ["name=b", "depends="])
+    make_module(modulesd / "kernel/fs/c.ko", ["name=c", "depends=", "firmware=c.bin"])
+    (modulesd / "modules.builtin").write_text("")
+    (modulesd / "modules.dep").write_text("")
+    firmwared.mkdir(parents=True)
+    (firmwared / "a.bin").write_text("")
+    (firmwared / "c.bin").write_text("")
+
+    process_kernel_modules(tmp_path, kver, include=["drivers/a"], exclude=[".*"], host=False)
+
+    assert (modulesd / "kernel/drivers/a.ko").exists()
+    assert (modulesd / "kernel/drivers/b.ko").exists()
+    assert not (modulesd / "kernel/fs/c.ko").exists()
+    assert (modulesd / "modules.dep").exists()
+    assert (firmwared / "a.bin").exists()
+    assert not (firmwared / "c.bin").exists()
+
+
+def test_symlinked_firmware_directory(tmp_path: Path) -> None:
+    kver = "6.6.0"
+    modulesd = tmp_path / "usr/lib/modules" / kver
+    firmwared = tmp_path / "usr/lib/firmware"
+
+    make_module(modulesd / "kernel/drivers/a.ko", ["name=a", "depends=", "firmware=vendor/a.bin"])
+    make_module(modulesd / "kernel/drivers/b.ko", ["name=b", "depends=", "firmware=vendor/b.bin"])
+    (modulesd / "modules.builtin").write_text("")
+    (firmwared / "real").mkdir(parents=True)
+    (firmwared / "real/a.bin").write_text("")
+    (firmwared / "real/b.bin").write_text("")
+    (firmwared / "vendor").symlink_to("real")
+    # Symlinks that point to a parent directory or out of the firmware directory are not descended into.
+    (firmwared / "real/loop").symlink_to("..")
+    (firmwared / "outside").symlink_to(modulesd)
+
+    index = index_tree(firmwared)
+    assert index.files == [
+        firmwared / "real/a.bin",
+        firmwared / "real/b.bin",
+        firmwared / "vendor/a.bin",
+        firmwared / "vendor/b.bin",
+    ]
+    assert index.aliases[firmwared / "vendor/a.bin"] == firmwared / "real/a.bin"
+
+    _, firmware = resolve_module_dependencies(tmp_path, kver, ["a"])
+    assert firmware == {firmwared / "vendor/a.bin"}
+
+    process_kernel_modules(tmp_path, kver, include=["drivers/a"], exclude=[".*"], host=False)
+
+    assert (firmwared / "real/a.bin").exists()
+    assert not (firmwared / "real/b.bin").exists()
+    assert (firmwared / "vendor").is_symlink()
+
+    # The initrd contains the symlink and the firmware file it points to.
+    required = gen_required_kernel_modules(tmp_path, kver, include=["drivers/a"], exclude=[], host=False)
+    assert {firmwared / "vendor", firmwared / "real/a.bin"} <= set(required)
+
+
+def test_lookup_firmware() -> None:
+    names = sorted([
+        "a.bin",
+        "a.bin.xz",
+        "ab.bin",
+        "intel",
+        "intel/ibt-11.sfi",
+        "intel/ibt-12.sfi",
+        "intel/sub",
+        "intel/sub/ibt-1.sfi",
+        "iwlwifi-9000.ucode",
+    ])
+
+    assert lookup_firmware(names, "a.bin") == ["a.bin", "a.bin.xz"]
+    assert lookup_firmware(names, "intel/ibt-1") == ["intel/ibt-11.sfi", "intel/ibt-12.sfi"]
+    assert lookup_firmware(names, "intel/") == ["intel/ibt-11.sfi", "intel/ibt-12.sfi", "intel/sub"]
+    assert lookup_firmware(names, "intel/ibt-1?.sfi") == ["intel/ibt-11.sfi", "intel/ibt-12.sfi"]
+    assert lookup_firmware(names, "missing.bin") == []
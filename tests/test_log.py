@@ -0,0 +1,22 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+from mkosi.log import complete_step, record_steps
+
+
+def test_record_steps() -> None:
+    with complete_step("Not recorded"):
+        pass
+
+    with record_steps() as steps:
+        with complete_step("Outer"):
+            with complete_step("Inner"):
+                pass
+
+    with complete_step("Not recorded either"):
+        pass
+
+    assert [(step.text, step.level) for step in steps] == [("Inner", 1), ("Outer", 0)]
+    inner, outer = steps
+    assert outer.start <= inner.start
+    assert outer.duration >= inner.duration >= 0
+    assert inner.maxrss > 0
@@ -0,0 +1,243 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import contextlib
+import dataclasses
+import gzip
+import os
+import sqlite3
+import struct
+import subprocess
+from pathlib import Path
+from typing import Any, Union
+
+import pytest
+
+from mkosi.config import ManifestFormat, MkosiConfig
+from mkosi.distributions import Distribution
+from mkosi.manifest import (
+    RPM_CHANGELOG_DELIMITER,
+    RPM_CHANGELOG_END,
+    Manifest,
+    PackageManifest,
+    RpmTag,
+)
+from tests import stderr_on_pty
+
+
+def make_rpm_header(tags: dict[RpmTag, Union[str, int]]) -> bytes:
+    index = data = b""
+
+    for tag, value in tags.items():
+        if isinstance(value, str):
+            type, encoded = 6, value.encode() + b"\0"
+        elif tag == RpmTag.LONGSIZE:
+            type, encoded = 5, struct.pack(">Q", value)
+            data += b"\0" * (-len(data) % 8)
+        else:
+            type, encoded = 4, struct.pack(">I", value)
+            data += b"\0" * (-len(data) % 4)
+
+        index += struct.pack(">IIiI", tag, type, len(data), 1)
+        data += encoded
+
+    return struct.pack(">II", len(tags), len(data)) + index + data
+
+
+def make_rpmdb(dbpath: Path, headers: list[dict[RpmTag, Union[str, int]]]) -> None:
+    dbpath.mkdir(parents=True, exist_ok=True)
+
+    with contextlib.closing(sqlite3.connect(dbpath / "rpmdb.sqlite")) as conn:
+        conn.execute("CREATE TABLE Packages (hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB NOT NULL)")
+        conn.executemany("INSERT INTO Packages (blob) VALUES (?)", [(make_rpm_header(h),) for h in headers])
+        conn.commit()
+
+
+def make_dpkg_status(admindir: Path, stanzas: list[str]) -> None:
+    (admindir / "info").mkdir(parents=True, exist_ok=True)
+    (admindir / "status").write_text("\n".join(stanzas))
+
+
+def make_manifest(distribution: Distribution, cache: Path) -> Manifest:
+    return Manifest(
+        dataclasses.replace(
+            MkosiConfig.default(),
+            distribution=distribution,
+            manifest_format=[ManifestFormat.changelog],
+            cache_dir=cache,
+        )
+    )
+
+
+def test_rpm_changelogs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+
+    def run(cmdline: list[str], **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        calls.append(cmdline)
+
+        if "-qa" in cmdline:
+            output = (
+                "foo-1.0-1.fc39.x86_64\tfoo-1.0-1.fc39.src.rpm\tfoo\tx86_64\t1024\t1\n"
+                "foo-libs-1.0-1.fc39.x86_64\tfoo-1.0-1.fc39.src.rpm\tfoo-libs\tx86_64\t1024\t1\n"
+                "bar-2.0-1.fc39.noarch\tbar-2.0-1.fc39.src.rpm\tbar\tnoarch\t1024\t1\n"
+                "baz-1:3.0-1.fc39.x86_64\tbaz-3.0-1.fc39.src.rpm\tbaz\tx86_64\t1024\t1\n"
+                "gone-1.0-1.fc39.x86_64\tgone-1.0-1.fc39.src.rpm\tgone\tx86_64\t1024\t1\n"
+            )
+        else:
+            output = "".join(
+                f"package {key} is not installed\n" if key.startswith("gone") else
+                f"{RPM_CHANGELOG_DELIMITER}{key}\n* {key}\n\n{RPM_CHANGELOG_END}"
+                for key in cmdline[6:]
+            )
+            # Packages that we didn't ask for are ignored.
+            output += f"{RPM_CHANGELOG_DELIMITER}other-1.0-1.fc39.x86_64\n* other\n\n{RPM_CHANGELOG_END}"
+
+        return subprocess.CompletedProcess(cmdline, 0, output, "")
+
+    monkeypatch.setattr("mkosi.manifest.run", run)
+
+    manifest = make_manifest(Distribution.fedora, tmp_path)
+    manifest.record_packages(tmp_path)
+
+    # The changelogs of all source packages are queried with a single rpm invocation, without the epoch.
+    assert len(calls) == 2
+    assert calls[1][6:] == [
+        "bar-2.0-1.fc39.noarch",
+        "baz-3.0-1.fc39.x86_64",
+        "foo-1.0-1.fc39.x86_64",
+        "gone-1.0-1.fc39.x86_64",
+    ]
+    assert manifest.source_packages["foo-1.0-1.fc39.src.rpm"].changelog == "* foo-1.0-1.fc39.x86_64"
+    assert manifest.source_packages["bar-2.0-1.fc39.src.rpm"].changelog == "* bar-2.0-1.fc39.noarch"
+    assert manifest.source_packages["baz-3.0-1.fc39.src.rpm"].changelog == "* baz-3.0-1.fc39.x86_64"
+    assert manifest.source_packages["gone-1.0-1.fc39.src.rpm"].changelog is None
+
+    # The second time around the changelogs are read from the cache and only the missing one is queried again.
+    manifest = make_manifest(Distribution.fedora, tmp_path)
+    manifest.record_packages(tmp_path)
+
+    assert len(calls) == 4
+    assert calls[3][6:] == ["gone-1.0-1.fc39.x86_64"]
+    assert manifest.source_packages["foo-1.0-1.fc39.src.rpm"].changelog == "* foo-1.0-1.fc39.x86_64"
+
+
+def test_deb_changelogs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    root = tmp_path / "root"
+    calls = []
+
+    def run(cmdline: list[str], **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        calls.append(cmdline)
+
+        if cmdline[0] == "dpkg-query":
+            output = "foo\tfoo\t1.0-1\tamd64\t1\t1\nbar\tbar-src\t2.0-1\tall\t1\t1\n"
+        else:
+            output = f"{cmdline[cmdline.index('changelog') + 1]} changelog from apt\n"
+
+        return subprocess.CompletedProcess(cmdline, 0, output, "")
+
+    monkeypatch.setattr("mkosi.manifest.run", run)
+
+    (root / "usr/share/doc/foo").mkdir(parents=True)
+    with gzip.open(root / "usr/share/doc/foo/changelog.Debian.gz", "wt") as f:
+        f.write("foo (1.0-1) unstable; urgency=medium\n")
+
+    manifest = make_manifest(Distribution.debian, tmp_path / "cache")
+    manifest.record_packages(root)
+
+    # Changelogs that are installed in the image are read directly, only the others are fetched with apt.
+    assert len(calls) == 2
+    assert "bar" in calls[1]
+    assert manifest.source_packages["foo"].changelog == "foo (1.0-1) unstable; urgency=medium"
+    assert manifest.source_packages["bar-src"].changelog == "bar changelog from apt"
+    assert (tmp_path / "cache/changelogs/debian/bar_2.0-1").read_text() == "bar changelog from apt"
+
+
+def test_deb_changelogs_on_terminal(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Changelogs that aren't in the image are fetched with apt-get from worker threads, which must also work when
+    # mkosi is running in a terminal.
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin/apt-get").write_text(
+        '#!/bin/sh\nwhile [ "$1" != changelog ]; do shift; done\necho "$2 changelog"\n'
+    )
+    (tmp_path / "bin/apt-get").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+
+    make_dpkg_status(tmp_path / "root/var/lib/dpkg", [
+        f"Package: package{i}\nStatus: install ok installed\nArchitecture: all\nVersion: 1.0\n" for i in range(16)
+    ])
+
+    manifest = make_manifest(Distribution.debian, tmp_path / "cache")
+    with stderr_on_pty():
+        manifest.record_packages(tmp_path / "root")
+
+    assert manifest.source_packages["package7"].changelog == "package7 changelog"
+
+
+def test_read_rpmdb(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def run(cmdline: list[str], **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        raise AssertionError(f"Unexpected command {cmdline}")
+
+    monkeypatch.setattr("mkosi.manifest.run", run)
+
+    make_rpmdb(tmp_path / "usr/lib/sysimage/rpm", [
+        {
+            RpmTag.NAME: "shadow-utils",
+            RpmTag.EPOCH: 2,
+            RpmTag.VERSION: "4.14.0",
+            RpmTag.RELEASE: "2.fc39",
+            RpmTag.ARCH: "x86_64",
+            RpmTag.SOURCERPM: "shadow-utils-4.14.0-2.fc39.src.rpm",
+            RpmTag.INSTALLTIME: 1700000000,
+            RpmTag.SIZE: 1,
+            RpmTag.LONGSIZE: 5 * 1024**3,
+        },
+        {
+            RpmTag.NAME: "gpg-pubkey",
+            RpmTag.VERSION: "18b8e74c",
+            RpmTag.RELEASE: "62f2920f",
+            RpmTag.INSTALLTIME: 1700000000,
+            RpmTag.SIZE: 0,
+        },
+    ])
+
+    manifest = Manifest(dataclasses.replace(MkosiConfig.default(), distribution=Distribution.fedora))
+    manifest.record_packages(tmp_path)
+
+    assert manifest.packages == [
+        PackageManifest("rpm", "gpg-pubkey", "18b8e74c-62f2920f", "", 0),
+        PackageManifest("rpm", "shadow-utils", "2:4.14.0-2.fc39", "x86_64", 5 * 1024**3),
+    ]
+
+
+def test_parse_dpkg_status(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def run(cmdline: list[str], **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        raise AssertionError(f"Unexpected command {cmdline}")
+
+    monkeypatch.setattr("mkosi.manifest.run", run)
+
+    admindir = tmp_path / "var/lib/dpkg"
+    make_dpkg_status(admindir, [
+        "Package: libfoo1\nStatus: install ok installed\nMulti-Arch: same\nArchitecture: amd64\n"
+        "Source: foo (1.0-1)\nVersion: 1.0-1+b1\nInstalled-Size: 10\nDescription: foo\n multiline\n .\n",
+        "Package: bar\nStatus: deinstall ok config-files\nArchitecture: all\nVersion: 2.0\n",
+        "Package: baz\nStatus: purge ok not-installed\nArchitecture: all\n",
+    ])
+    (admindir / "info/libfoo1:amd64.list").write_text("")
+    os.utime(admindir / "info/libfoo1:amd64.list", (1700000000, 1700000000))
+
+    config = dataclasses.replace(
+        MkosiConfig.default(),
+        distribution=Distribution.debian,
+        manifest_format=[ManifestFormat.json],
+    )
+    manifest = Manifest(config)
+    manifest.record_packages(tmp_path)
+
+    assert manifest.packages == [
+        PackageManifest("deb", "bar", "2.0", "all", 0),
+        PackageManifest("deb", "libfoo1", "1.0-1+b1", "amd64", 10240),
+    ]
+
+    # Packages are only filtered by their install time when building on top of base trees.
+    manifest = Manifest(dataclasses.replace(config, base_trees=[tmp_path]))
+    manifest.record_packages(tmp_path)
+    assert manifest.packages == []
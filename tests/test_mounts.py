@@ -0,0 +1,29 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import os
+import stat
+from pathlib import Path
+
+import pytest
+
+from mkosi.mounts import delete_whiteout_files
+
+
+def test_delete_whiteout_files(tmp_path: Path) -> None:
+    (tmp_path / "a/b").mkdir(parents=True)
+
+    try:
+        os.mknod(tmp_path / "a/b/whiteout", stat.S_IFCHR | 0o600, os.makedev(0, 0))
+    except PermissionError:
+        pytest.skip("Creating device nodes requires CAP_MKNOD")
+
+    os.mknod(tmp_path / "a/null", stat.S_IFCHR | 0o600, os.makedev(1, 3))
+    os.mkfifo(tmp_path / "a/fifo")
+    (tmp_path / "a/file").touch()
+    (tmp_path / "a/link").symlink_to("b/whiteout")
+
+    delete_whiteout_files(tmp_path)
+
+    assert sorted(p.relative_to(tmp_path) for p in tmp_path.rglob("*")) == [
+        Path("a"), Path("a/b"), Path("a/fifo"), Path("a/file"), Path("a/link"), Path("a/null"),
+    ]
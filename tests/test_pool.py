@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import os
+from pathlib import Path
+
+from mkosi.distributions import PackageType
+from mkosi.pool import (
+    gc_package_pool,
+    pool_entries,
+    populate_package_cache,
+    sync_package_pool,
+)
+
+
+def test_sync_package_pool(tmp_path: Path) -> None:
+    pool = tmp_path / "pool"
+    a = tmp_path / "a/apt/archives"
+    b = tmp_path / "b/apt/archives"
+
+    for d in (a, b):
+        (d / "partial").mkdir(parents=True)
+        (d / "foo_1.0_amd64.deb").write_text("foo")
+        (d / "partial/bar_1.0_amd64.deb").write_text("bar")
+        (d / "lock").write_text("")
+
+    sync_package_pool(pool, tmp_path / "a")
+    sync_package_pool(pool, tmp_path / "b")
+
+    [entry] = pool_entries(pool)
+    assert entry.name == "foo_1.0_amd64.deb"
+    assert entry.nlink == 3
+    assert (a / "foo_1.0_amd64.deb").samefile(entry.path)
+    assert (b / "foo_1.0_amd64.deb").samefile(entry.path)
+
+
+def test_populate_package_cache(tmp_path: Path) -> None:
+    pool = tmp_path / "pool"
+
+    for i, (name, content) in enumerate([
+        ("foo_1.0_amd64.deb", "foo"),
+        ("bar_1.0_amd64.deb", "bar"),
+        ("bar_1.0_amd64.deb", "other bar"),
+        ("baz-1.0-1.fc39.x86_64.rpm", "baz"),
+    ]):
+        d = tmp_path / f"cache{i}/apt/archives"
+        d.mkdir(parents=True)
+        (d / name).write_text(content)
+        sync_package_pool(pool, tmp_path / f"cache{i}")
+
+    populate_package_cache(pool, tmp_path / "new", PackageType.deb)
+
+    # Packages of which the pool has multiple different versions are ambiguous and not linked.
+    assert os.listdir(tmp_path / "new/apt/archives") == ["foo_1.0_amd64.deb"]
+
+
+def test_gc_package_pool(tmp_path: Path) -> None:
+    pool = tmp_path / "pool"
+    cache = tmp_path / "cache"
+    (cache / "pacman/pkg").mkdir(parents=True)
+
+    for i in range(4):
+        p = cache / f"pacman/pkg/foo{i}-1.0-1-x86_64.pkg.tar.zst"
+        p.write_bytes(b"x" * 100)
+        os.utime(p, (i, i))
+        (cache / f"pacman/pkg/foo{i}-1.0-1-x86_64.pkg.tar.zst.sig").write_text("")
+
+    sync_package_pool(pool, cache)
+
+    for i, entry in enumerate(sorted(pool_entries(pool), key=lambda e: e.name)):
+        os.utime(entry.path, (i, i))
+
+    removed = gc_package_pool(pool, 250, caches=[cache])
+
+    assert sorted(e.name for e in removed) == ["foo0-1.0-1-x86_64.pkg.tar.zst", "foo1-1.0-1-x86_64.pkg.tar.zst"]
+    assert sorted(e.name for e in pool_entries(pool)) == [
+        "foo2-1.0-1-x86_64.pkg.tar.zst",
+        "foo3-1.0-1-x86_64.pkg.tar.zst",
+    ]
+    assert sorted(p.name for p in (cache / "pacman/pkg").iterdir() if not p.name.endswith(".sig")) == [
+        "foo2-1.0-1-x86_64.pkg.tar.zst",
+        "foo3-1.0-1-x86_64.pkg.tar.zst",
+    ]
@@ -0,0 +1,26 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from mkosi.run import run, spawn
+from tests import stderr_on_pty
+
+
+def test_run_from_threads() -> None:
+    with stderr_on_pty(), ThreadPoolExecutor(max_workers=4) as pool:
+        for f in [pool.submit(run, ["true"], stdout=subprocess.DEVNULL) for _ in range(8)]:
+            assert f.result().returncode == 0
+
+    with stderr_on_pty():
+        assert run(["true"], stdout=subprocess.DEVNULL).returncode == 0
+
+
+def test_spawn_from_threads() -> None:
+    def wait() -> int:
+        with spawn(["true"], stdout=subprocess.DEVNULL, foreground=True) as proc:
+            return proc.wait()
+
+    with stderr_on_pty(), ThreadPoolExecutor(max_workers=4) as pool:
+        for f in [pool.submit(wait) for _ in range(8)]:
+            assert f.result() == 0
@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import os
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from mkosi.tree import glob_tree, walk_tree
+
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    for p in ("usr/lib/a.pyc", "usr/lib/b.py", "usr/share/doc/abc/README", "usr/share/doc/def", "etc/.hidden"):
+        (tmp_path / p).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / p).write_text(p)
+
+    (tmp_path / "lib").symlink_to("usr/lib")
+    (tmp_path / "usr/lib/loop").symlink_to("..")
+
+    return tmp_path
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_walk_tree(tree: Path, parallel: bool) -> None:
+    entries = []
+
+    def visit(dirfd: int, entry: os.DirEntry[str], context: Path) -> Optional[Path]:
+        entries.append(context / entry.name)
+        return context / entry.name if entry.is_dir(follow_symlinks=False) else None
+
+    walk_tree(tree, visit, Path(), parallel=parallel)
+
+    assert sorted(entries) == sorted(p.relative_to(tree) for p in tree.rglob("*"))
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "usr/lib/*.pyc",
+        "**/*.pyc",
+        "usr/share/doc/*",
+        "usr/share/doc",
+        "lib/*.py",
+        "**/.hidden",
+        "etc/*",
+        "usr/**/README",
+        "usr/share/doc/**",
+        "usr/*/doc/abc/README",
+        "nonexistent/*",
+    ]
+)
+def test_glob_tree(tree: Path, pattern: str) -> None:
+    expected = sorted(tree.glob(pattern))
+    # Descendants of matching directories are not matched again.
+    expected = [p for p in expected if not any(p.is_relative_to(q) and p != q for q in expected)]
+
+    assert sorted(glob_tree(tree, [pattern])) == expected
+
+
+def test_glob_tree_multiple(tree: Path) -> None:
+    assert sorted(glob_tree(tree, ["**/*.pyc", "usr/share/doc/*", "etc"])) == [
+        tree / "etc",
+        tree / "usr/lib/a.pyc",
+        tree / "usr/share/doc/abc",
+        tree / "usr/share/doc/def",
+    ]
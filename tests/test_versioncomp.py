@@ -1,4 +1,5 @@
 # SPDX-License-Identifier: LGPL-2.1+
+import functools
 import itertools
 
 import pytest
@@ -51,6 +52,21 @@ def test_generic_version_spec() -> None:
     assert GenericVersion("+1") == GenericVersion("1")
     assert GenericVersion("1+") < GenericVersion("1.2")
     assert GenericVersion("1+2+3") > GenericVersion("1.3.3")
+    assert GenericVersion("1.") < GenericVersion("1.0")
+    assert GenericVersion("1^") < GenericVersion("1^0")
+    assert GenericVersion("1+2") > GenericVersion("1a")
+    assert GenericVersion("1+0") < GenericVersion("1a")
+    assert GenericVersion("1+0a") == GenericVersion("1a")
+    assert GenericVersion("a+b") < GenericVersion("ab")
+
+
+def test_generic_version_key() -> None:
+    versions = ["1.0", "1.0~rc1", "1.0-1", "1.0^git1", "1.0.1", "1.0a", "1+0", "1!2", "0~", "", "1.0"]
+    expected = [str(v) for v in sorted(GenericVersion(v) for v in versions)]
+
+    assert sorted(versions, key=lambda v: GenericVersion(v).key) == expected
+    assert sorted(versions, key=functools.cmp_to_key(GenericVersion.compare_versions)) == expected
+    assert hash(GenericVersion("1.01")) == hash(GenericVersion("1.1"))
 
 
 @pytest.mark.parametrize(